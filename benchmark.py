@@ -0,0 +1,928 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import database
+from database import temp_database
+
+# 合成数据使用的备注，覆盖各种关系关键词
+SAMPLE_REMARKS = ['数学老师', '公司同事', '部门领导', '好朋友', '父母', '大学同学', '客户', '']
+
+# 本次运行的全部结果（report 追加，--json 时写入文件）
+RESULTS = []
+
+# 与基准结果相比变慢超过这个比例时标记为回归
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+
+
+def make_wechat_contacts(count, seed=0):
+    """生成与 WeChatDBFinder.extract_contacts 输出结构一致的合成 rcontact 联系人"""
+    rng = random.Random(seed)
+    contacts = []
+    for i in range(count):
+        nickname = f'昵称{i}'
+        remark = rng.choice(SAMPLE_REMARKS)
+        contacts.append({
+            'nickname': nickname,
+            'alias': f'alias_{i}',
+            'remark': remark,
+            'display_name': f'联系人{i}'
+        })
+    return contacts
+
+
+def report(name, size, seconds, **extra):
+    """打印单项基准结果并记录到 RESULTS"""
+    rate = size / seconds if seconds > 0 else float('inf')
+    details = ''.join(f', {key}={value}' for key, value in extra.items())
+    print(f'{name:<28} n={size:<8} {seconds * 1000:10.1f} ms  {rate:12.0f} 条/秒{details}')
+    RESULTS.append({'name': name, 'size': size, 'seconds': seconds,
+                    'rate': rate if seconds > 0 else None, 'extra': extra})
+
+
+def bench_save_chat(args):
+    """逐条保存聊天记录：每次新建连接 vs 复用长连接"""
+    from chat_manager import ChatManager
+
+    chat_manager = ChatManager()
+    for size in args.sizes:
+        with temp_database():
+            start = time.perf_counter()
+            for i in range(size):
+                conn = database.get_db_connection()
+                conn.execute('INSERT INTO chats (contact_id, content) VALUES (?, ?)', (i % 100, f'消息{i}'))
+                conn.commit()
+                conn.close()
+            report('save_chat (per-call conn)', size, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for i in range(size):
+                chat_manager.save_chat(i % 100, f'消息{i}')
+            report('save_chat (pooled)', size, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for i in range(size):
+                chat_manager.get_chats_by_contact_id(i % 100)
+            report('get_chats (pooled)', size, time.perf_counter() - start)
+
+
+def bench_chat_writer(args):
+    """高频写入聊天记录：逐条 save_chat（每条一次提交）vs ChatWriter 成组提交（单线程、4 个线程、协程提交）"""
+    import asyncio
+    import threading
+    from chat_analyzer import ChatAnalyzer
+    from chat_manager import ChatManager
+
+    for size in args.sizes:
+        messages = make_messages(size)
+        for synchronous in ('NORMAL', 'FULL'):
+            with temp_database():
+                conn = database.get_connection()
+                contact_ids = insert_contacts(conn, 100)
+                # 写入线程和当前线程使用各自的连接，同步级别需在每条连接上设置
+                database.connection_manager.pragmas['synchronous'] = synchronous
+                database.connection_manager.close()
+                try:
+                    chat_manager = ChatManager(analyzer=ChatAnalyzer())
+
+                    # 逐条提交太慢，最多写 1 万条
+                    count = min(size, 10000)
+                    start = time.perf_counter()
+                    for i in range(count):
+                        chat_manager.save_chat(contact_ids[i % 100], messages[i])
+                    report(f'save_chat ({synchronous})', count, time.perf_counter() - start)
+
+                    with chat_manager.open_writer() as writer:
+                        start = time.perf_counter()
+                        futures = [writer.submit(contact_ids[i % 100], content) for i, content in enumerate(messages)]
+                        futures[-1].result()
+                        report(f'writer 1 thread ({synchronous})', size, time.perf_counter() - start,
+                               batches=writer.batches)
+
+                    with chat_manager.open_writer() as writer:
+                        def produce(offset):
+                            return [writer.submit(contact_ids[i % 100], messages[i]) for i in range(offset, size, 4)]
+
+                        start = time.perf_counter()
+                        threads = [threading.Thread(target=produce, args=(offset,)) for offset in range(4)]
+                        for thread in threads:
+                            thread.start()
+                        for thread in threads:
+                            thread.join()
+                        writer.flush()
+                        report(f'writer 4 threads ({synchronous})', size, time.perf_counter() - start,
+                               batches=writer.batches)
+
+                    with chat_manager.open_writer() as writer:
+                        async def save_all():
+                            await asyncio.gather(*(writer.save_async(contact_ids[i % 100], content)
+                                                   for i, content in enumerate(messages)))
+
+                        start = time.perf_counter()
+                        asyncio.run(save_all())
+                        report(f'writer asyncio ({synchronous})', size, time.perf_counter() - start,
+                               batches=writer.batches)
+                finally:
+                    database.connection_manager.pragmas['synchronous'] = database.DEFAULT_PRAGMAS['synchronous']
+
+
+def make_messages(count, seed=0):
+    """生成带有关键词和重要事项标记的合成聊天内容"""
+    rng = random.Random(seed)
+    fragments = ['最近项目很忙', '孩子考试考得不错', '记得下周体检', '感谢你的帮助', '今天天气很好',
+                 '这件事务必重要', '周末一起吃饭', '明年的目标是换工作', '生日快乐', '哈哈']
+    return [''.join(rng.choice(fragments) for _ in range(rng.randint(1, 6))) for _ in range(count)]
+
+
+def bench_keyword_scan(args):
+    """关键词匹配：逐词 in 判断计数 vs 字典树正则单次扫描（内置词典和 1000 词扩展词典）"""
+    from keyword_matcher import KeywordMatcher, KEYWORD_CATEGORIES, IMPORTANT_MARKERS
+
+    large = {category: list(words) for category, words in KEYWORD_CATEGORIES.items()}
+    for i in range(1000):
+        large.setdefault(f'扩展{i % 20}', []).append(f'词{i}号')
+
+    for size in args.sizes:
+        messages = make_messages(size)
+        for label, categories in (('builtin', KEYWORD_CATEGORIES), ('1000 words', large)):
+            words = [word for category_words in categories.values() for word in category_words] + IMPORTANT_MARKERS
+            # 逐词 in 判断，命中时再用 find 统计（可重叠的）次数：分析需要的是命中次数而不只是是否命中
+            start = time.perf_counter()
+            for content in messages:
+                for word in words:
+                    if word in content:
+                        position = content.find(word)
+                        while position >= 0:
+                            position = content.find(word, position + 1)
+            report(f'naive in ({label})', size, time.perf_counter() - start)
+
+            matcher = KeywordMatcher(categories)
+            matcher.scan('')
+            start = time.perf_counter()
+            for content in messages:
+                matcher.scan(content)
+            report(f'regex ({label})', size, time.perf_counter() - start)
+
+
+def bench_greeting_regenerate(args):
+    """反复生成同一联系人的拜年微信（模拟 5 次重新生成）：分析结果缓存命中情况"""
+    from chat_analyzer import ChatAnalyzer
+    from greeting_generator import GreetingGenerator
+
+    for size in args.sizes:
+        now = int(time.time())
+        chats = [{'id': i + 1, 'contact_id': 1, 'content': content, 'timestamp': now}
+                 for i, content in enumerate(make_messages(size))]
+        contact = {'id': 1, 'name': '张老师', 'relation': '师生'}
+
+        analyzer = ChatAnalyzer()
+        generator = GreetingGenerator(analyzer=analyzer)
+        start = time.perf_counter()
+        for _ in range(5):
+            generator.generate_greeting(contact, chats)
+        report('generate x5 (cached)', size, time.perf_counter() - start,
+               hits=analyzer.hits, misses=analyzer.misses)
+
+
+def insert_chats(conn, contact_ids, messages, seed=0):
+    """把合成消息随机分配给联系人并批量写入 chats 表"""
+    rng = random.Random(seed)
+    conn.executemany('INSERT INTO chats (contact_id, content) VALUES (?, ?)',
+                     ((rng.choice(contact_ids), content) for content in messages))
+    database.index_pending_chats(conn)
+    conn.commit()
+
+
+def bench_important_matters(args):
+    """重要事项前 K 条：一位联系人的消息全部含重要事项标记时，分析耗时和分析结果占用的内存（应与消息条数无关）"""
+    import tracemalloc
+    from chat_analyzer import ChatAnalyzer
+    from chat_manager import ChatManager
+
+    for size in args.sizes:
+        with temp_database():
+            conn = database.get_connection()
+            insert_chats(conn, [1], ['记得' + message for message in make_messages(size)])
+            chat_manager = ChatManager(analyzer=ChatAnalyzer())
+
+            start = time.perf_counter()
+            analysis = chat_manager.analyze_chats(chat_manager.iter_chats(1))
+            seconds = time.perf_counter() - start
+
+            # 流式分析结束后仍然保留的内存（即分析结果）
+            tracemalloc.start()
+            analysis = chat_manager.analyze_chats(chat_manager.iter_chats(1))
+            retained = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            report('analyze (streamed)', size, seconds, result_bytes=retained,
+                   matters=len(analysis['important_matters']))
+
+            start = time.perf_counter()
+            analysis = chat_manager.analyze_contact(1)
+            report('analyze_contact (cold)', size, time.perf_counter() - start,
+                   state_bytes=len(conn.execute('SELECT important_matters FROM analysis_state').fetchone()[0]))
+
+
+def bench_incremental_analysis(args):
+    """增量分析：全量分析 vs 持久化状态上只折叠新增消息"""
+    from chat_analyzer import ChatAnalyzer
+    from chat_manager import ChatManager
+
+    for size in args.sizes:
+        with temp_database():
+            conn = database.get_connection()
+            insert_chats(conn, [1], make_messages(size))
+            chat_manager = ChatManager(analyzer=ChatAnalyzer())
+
+            start = time.perf_counter()
+            chat_manager.analyze_chats(chat_manager.get_chats_by_contact_id(1))
+            report('full analysis', size, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            chat_manager.analyze_contact(1)
+            report('incremental (cold)', size, time.perf_counter() - start)
+
+            for content in make_messages(10, seed=1):
+                chat_manager.save_chat(1, content)
+            start = time.perf_counter()
+            chat_manager.analyze_contact(1)
+            report('incremental (+10 new)', size, time.perf_counter() - start)
+
+
+def insert_contacts(conn, count):
+    """批量写入合成联系人，返回联系人 id 列表"""
+    from contact_relation import classify_many
+
+    contacts = [{'name': contact['display_name'], 'notes': contact['remark'] or contact['nickname']}
+                for contact in make_wechat_contacts(count)]
+    rows = [(contact['name'], '', relation, contact['notes'])
+            for contact, relation in zip(contacts, classify_many(contacts))]
+    conn.executemany('INSERT INTO contacts (name, phone, relation, notes) VALUES (?, ?, ?, ?)', rows)
+    conn.commit()
+    return [row[0] for row in conn.execute('SELECT id FROM contacts ORDER BY id')]
+
+
+def bench_batch_greetings(args):
+    """批量生成拜年微信草稿：线程池 vs 进程池（每位联系人 10 条聊天记录），首次运行和分析状态已持久化后的再次运行"""
+    from chat_analyzer import ChatAnalyzer
+    from greeting_generator import GreetingGenerator
+
+    for size in args.sizes:
+        for use_processes in (False, True):
+            with temp_database():
+                conn = database.get_connection()
+                contact_ids = insert_contacts(conn, size)
+                insert_chats(conn, contact_ids, make_messages(size * 10))
+                generator = GreetingGenerator(analyzer=ChatAnalyzer())
+                stats = generator.generate_batch(workers=args.workers, use_processes=use_processes)
+                report(f"batch greetings ({stats['mode']})", size, stats['seconds'], workers=stats['workers'])
+
+                # 第二次运行时聊天分析状态已持久化，主要是渲染和写入的开销
+                generator.analyzer.invalidate()
+                stats = generator.generate_batch(workers=args.workers, use_processes=use_processes)
+                report(f"  re-run ({stats['mode']})", size, stats['seconds'], workers=stats['workers'])
+
+
+def bench_template_render(args):
+    """模板渲染：链式 str.replace vs 预编译模板一次 join"""
+    from greeting_generator import GreetingGenerator, DEFAULT_SLOT_VALUES
+
+    generator = GreetingGenerator()
+    sources = [template.source for templates in generator.templates.values() for template in templates]
+    compiled = [template for templates in generator.templates.values() for template in templates]
+    values = dict(DEFAULT_SLOT_VALUES, title='张老师', name='张老师')
+
+    for size in args.sizes:
+        start = time.perf_counter()
+        for i in range(size):
+            greeting = sources[i % len(sources)]
+            for slot, value in values.items():
+                greeting = greeting.replace('{' + slot + '}', value)
+        report('chained str.replace', size, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(size):
+            compiled[i % len(compiled)].render(values)
+        report('compiled template', size, time.perf_counter() - start)
+
+
+def make_wechat_msg_db(path, contact_count, message_count, seed=0):
+    """生成模拟微信电脑版 MSG.db 的合成数据库：rcontact 联系人表和 MSG 消息表"""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE rcontact (UserName TEXT PRIMARY KEY, Alias TEXT, NickName TEXT, Remark TEXT)')
+    conn.execute('''
+        CREATE TABLE MSG (
+            localId INTEGER PRIMARY KEY AUTOINCREMENT,
+            StrTalker TEXT,
+            StrContent TEXT,
+            CreateTime INTEGER,
+            IsSender INTEGER,
+            Type INTEGER
+        )
+    ''')
+    # 备注名各不相同（备注名是本地联系人的姓名，相同时会被合并为一位联系人）
+    conn.executemany('INSERT INTO rcontact VALUES (?, ?, ?, ?)',
+                     ((f'wxid_{i}', f'alias_{i}', f'昵称{i}', f'{remark}{i}' if remark else '')
+                      for i, remark in ((i, rng.choice(SAMPLE_REMARKS)) for i in range(contact_count))))
+    fragments = make_messages(1000, seed)
+    start_time = int(time.time()) - 365 * 86400
+    step = 365 * 86400 / max(message_count, 1)
+    conn.executemany('INSERT INTO MSG (StrTalker, StrContent, CreateTime, IsSender, Type) VALUES (?, ?, ?, ?, 1)',
+                     ((f'wxid_{rng.randrange(contact_count)}', fragments[i % len(fragments)],
+                       start_time + int(i * step), i % 2) for i in range(message_count)))
+    conn.commit()
+    conn.close()
+    return path
+
+
+def bench_message_stream(args):
+    """流式读取微信消息表：吞吐量和峰值内存"""
+    import tracemalloc
+    from wechatDBFinder import WeChatDBFinder
+
+    finder = WeChatDBFinder()
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = make_wechat_msg_db(os.path.join(tmp, 'MSG0.db'), 1000, size)
+            start = time.perf_counter()
+            count = sum(1 for _ in finder.iter_messages(db_path))
+            seconds = time.perf_counter() - start
+
+            # tracemalloc 本身开销很大，单独跑一遍测峰值内存
+            tracemalloc.start()
+            sum(1 for _ in finder.iter_messages(db_path))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            report('iter_messages', count, seconds, peak_kb=peak // 1024)
+
+
+def bench_import_chats(args):
+    """微信聊天记录导入：首次全量导入、无新消息时的重复运行、追加 1% 新消息后的增量导入"""
+    from chat_importer import ChatImporter
+    from contact_sync import ContactSync
+    from wechatDBFinder import WeChatDBFinder
+
+    finder = WeChatDBFinder()
+    for size in args.sizes:
+        with temp_database() as local_path:
+            db_path = make_wechat_msg_db(os.path.join(os.path.dirname(local_path), 'MSG0.db'), 1000, size)
+            ContactSync(finder=finder).sync([db_path])
+            importer = ChatImporter(finder=finder)
+
+            stats = importer.import_messages(db_path)
+            report('import chats (full)', size, stats['seconds'], imported=stats['imported'])
+
+            stats = importer.import_messages(db_path)
+            report('import chats (no change)', size, stats['seconds'], imported=stats['imported'])
+
+            conn = sqlite3.connect(db_path)
+            conn.executemany('INSERT INTO MSG (StrTalker, StrContent, CreateTime, IsSender, Type) VALUES (?, ?, ?, 0, 1)',
+                             ((f'wxid_{i % 1000}', '新消息', int(time.time())) for i in range(size // 100)))
+            conn.commit()
+            conn.close()
+            stats = importer.import_messages(db_path)
+            report('import chats (+1%)', size, stats['seconds'], imported=stats['imported'])
+
+
+def make_wechat_files_tree(root, account_count, dbs_per_account=12):
+    """生成 WeChat Files/<微信号>/Msg/*.db 结构的模拟目录树（每个账号另有若干无关文件和目录）"""
+    for i in range(account_count):
+        account = os.path.join(root, f'wxid_{i:06d}')
+        msg_dir = os.path.join(account, 'Msg')
+        os.makedirs(os.path.join(account, 'FileStorage', 'Image'))
+        os.makedirs(os.path.join(msg_dir, 'Multi'))
+        for j in range(dbs_per_account):
+            open(os.path.join(msg_dir, f'MSG{j}.db'), 'wb').close()
+        for name in ('MicroMsg.db', 'Misc.db', 'config.data', 'Sns.db-wal'):
+            open(os.path.join(msg_dir, name), 'wb').close()
+
+
+def bench_discovery(args):
+    """微信数据库查找：串行与并发扫描、无缓存（冷启动）与目录 mtime 缓存命中（热启动）"""
+    from wechatDBFinder import WeChatDBFinder
+
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            root = os.path.join(tmp, 'WeChat Files')
+            make_wechat_files_tree(root, size)
+            roots = [(root, 1, 'Msg')]
+            cache_path = os.path.join(tmp, 'wechat_paths.json')
+
+            for workers in (1, args.workers or 8):
+                start = time.perf_counter()
+                paths = WeChatDBFinder(search_roots=roots, cache_path='', max_workers=workers).wechat_db_paths
+                report(f'discovery (cold, {workers} workers)', size, time.perf_counter() - start, files=len(paths))
+
+            WeChatDBFinder(search_roots=roots, cache_path=cache_path).get_wechat_db_paths()
+            start = time.perf_counter()
+            paths = WeChatDBFinder(search_roots=roots, cache_path=cache_path).get_wechat_db_paths()
+            report('discovery (warm cache)', size, time.perf_counter() - start, files=len(paths))
+
+            # 一个账号新增数据库后只重新列出该目录
+            open(os.path.join(root, 'wxid_000000', 'Msg', 'MSG99.db'), 'wb').close()
+            start = time.perf_counter()
+            paths = WeChatDBFinder(search_roots=roots, cache_path=cache_path).get_wechat_db_paths()
+            report('discovery (1 dir changed)', size, time.perf_counter() - start, files=len(paths))
+
+
+# 在子进程中启动交互程序：本地数据库和微信数据目录都指向临时目录
+STARTUP_SCRIPT = '''
+import sys
+import database
+import wechatDBFinder
+database.DB_PATH = sys.argv[1]
+wechatDBFinder.PATH_CACHE_FILE = ''
+import index
+index.main(['--sync', sys.argv[2]])
+'''
+
+
+def bench_startup(args):
+    """交互程序启动到显示第一个菜单的耗时（进程启动计时），微信数据库含 n 位联系人"""
+    import subprocess
+    import sys
+
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            home = os.path.join(tmp, 'home')
+            msg_dir = os.path.join(home, '.wine', 'drive_c', 'users', 'home', 'Documents', 'WeChat Files', 'wxid_me', 'Msg')
+            os.makedirs(msg_dir)
+            make_wechat_msg_db(os.path.join(msg_dir, 'MSG0.db'), size, 0)
+            env = dict(os.environ, HOME=home, PYTHONUNBUFFERED='1', PYTHONIOENCODING='utf-8')
+
+            for mode in ('foreground', 'background'):
+                db_path = os.path.join(tmp, f'{mode}.db')
+                start = time.perf_counter()
+                proc = subprocess.Popen([sys.executable, '-c', STARTUP_SCRIPT, db_path, mode],
+                                        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, encoding='utf-8')
+                for line in proc.stdout:
+                    if '请选择操作' in line:
+                        break
+                seconds = time.perf_counter() - start
+                proc.communicate('7\n')
+                report(f'time to first menu ({mode})', size, seconds)
+
+
+def bench_relation_classify(args):
+    """关系判断：重复备注（命中缓存）与互不相同的备注（每条都扫描正则）"""
+    from contact_relation import RelationClassifier
+
+    for size in args.sizes:
+        repeated = [{'name': contact['display_name'], 'notes': contact['remark'] or contact['nickname']}
+                    for contact in make_wechat_contacts(size)]
+        unique = [{'name': contact['name'], 'notes': f"{contact['notes']}{i}"} for i, contact in enumerate(repeated)]
+
+        for label, contacts in (('repeated notes', repeated), ('unique notes', unique)):
+            classifier = RelationClassifier()
+            start = time.perf_counter()
+            classifier.classify_many(contacts)
+            report(f'classify_many ({label})', size, time.perf_counter() - start)
+
+
+def bench_chat_search(args):
+    """聊天记录搜索：FTS5 全文索引与 LIKE 全表扫描（分页取第一页和命中总数）"""
+    from chat_manager import ChatManager
+
+    manager = ChatManager()
+    for size in args.sizes:
+        with temp_database():
+            conn = database.get_connection()
+            contact_ids = insert_contacts(conn, 1000)
+            # 少量包含罕见词的消息，用于测试选择性高的查询
+            insert_chats(conn, contact_ids, make_messages(size) + ['记得带上毕业论文答辩材料'] * 10)
+
+            for query in ('答辩', '务必', '天气 生日', '"换工作"'):
+                start = time.perf_counter()
+                found = manager.search_chats(query, page_size=20)
+                report(f'search fts ({query})', size, time.perf_counter() - start, hits=found['total'])
+
+            # 去掉全文索引后同样的查询走 LIKE
+            conn.execute('DROP TABLE chats_fts')
+            conn.commit()
+            for query in ('答辩', '务必', '天气 生日'):
+                start = time.perf_counter()
+                found = manager.search_chats(query, page_size=20)
+                report(f'search like ({query})', size, time.perf_counter() - start, hits=found['total'])
+
+
+def bench_chat_listing(args):
+    """单个联系人的聊天记录读取：fetchall 全量载入与 iter_chats 键集分页流式读取（耗时和峰值内存）"""
+    import tracemalloc
+    from chat_manager import ChatManager
+
+    manager = ChatManager()
+    for size in args.sizes:
+        with temp_database():
+            conn = database.get_connection()
+            insert_chats(conn, insert_contacts(conn, 1), make_messages(size))
+
+            for label, read in (('fetchall', lambda: len(manager.get_chats_by_contact_id(1))),
+                                ('iter_chats', lambda: sum(1 for _ in manager.iter_chats(1)))):
+                start = time.perf_counter()
+                count = read()
+                seconds = time.perf_counter() - start
+                tracemalloc.start()
+                read()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                report(f'list chats ({label})', count, seconds, peak_kb=peak // 1024)
+
+            start = time.perf_counter()
+            rows, after = manager.get_chats_page(1, 20)
+            for _ in range(size // 20 - 1):
+                rows, after = manager.get_chats_page(1, 20, after)
+            report('page through (keyset, 20/page)', size, time.perf_counter() - start)
+
+
+def bench_contact_directory(args):
+    """联系人目录：载入耗时、每位联系人的内存，以及按姓名查找与数据库查询的对比"""
+    import tracemalloc
+    from contact_directory import ContactDirectory
+
+    for size in args.sizes:
+        with temp_database():
+            conn = database.get_connection()
+            insert_contacts(conn, size)
+            names = [f'联系人{i}' for i in range(0, size, max(1, size // 1000))]
+
+            directory = ContactDirectory()
+            start = time.perf_counter()
+            directory.load()
+            seconds = time.perf_counter() - start
+
+            # 载入完成后仍然保留的内存（临时对象已释放）
+            tracemalloc.start()
+            measured = ContactDirectory()
+            measured.load()
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del measured
+            report('load directory', size, seconds, bytes_per_contact=current // size)
+
+            start = time.perf_counter()
+            for name in names:
+                conn.execute('SELECT * FROM contacts WHERE name = ?', (name,)).fetchone()
+            report('lookup sqlite (indexed)', len(names), time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for name in names:
+                directory.get(name)
+            report('lookup directory (exact)', len(names), time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for name in names:
+                directory.prefix(name[:4])
+            report('lookup directory (prefix)', len(names), time.perf_counter() - start)
+
+            typos = names[:20]
+            directory.fuzzy(typos[0])  # 建立字对索引
+            start = time.perf_counter()
+            for name in typos:
+                directory.fuzzy(name[:-1] + '人')
+            report('lookup directory (fuzzy)', len(typos), time.perf_counter() - start)
+
+
+def bench_profiling_overhead(args):
+    """分阶段计时的开销：以最频繁的计时点（每条拜年微信的模板渲染）比较不计时、未启用和启用三种情况"""
+    import profiling
+    from chat_analyzer import ImportantMatter
+    from greeting_generator import GreetingGenerator
+
+    generator = GreetingGenerator()
+    templates = [template for templates in generator.templates.values() for template in templates]
+    contact = {'id': 1, 'name': '张老师', 'relation': '师生'}
+    analysis = {'important_matters': [ImportantMatter(1.0, 0, 1, '记得下周交论文')], 'keywords': {}}
+    undecorated = GreetingGenerator._render.__wrapped__
+
+    for size in args.sizes:
+        start = time.perf_counter()
+        for i in range(size):
+            undecorated(generator, templates[i % len(templates)], contact, analysis)
+        report('render (no timer)', size, time.perf_counter() - start)
+
+        for label, enabled in (('render (profiling off)', False), ('render (profiling on)', True)):
+            profiling.profiler.reset()
+            if enabled:
+                profiling.profiler.enable(report_at_exit=False)
+            start = time.perf_counter()
+            for i in range(size):
+                generator._render(templates[i % len(templates)], contact, analysis)
+            report(label, size, time.perf_counter() - start)
+            profiling.profiler.disable()
+
+
+def bench_multi_source(args):
+    """多个微信数据库（8 个，联系人有一半重复）的首次联系人同步：逐个读取与线程池并发读取后按微信 id 合并"""
+    from contact_sync import ContactSync
+    from wechatDBFinder import WeChatDBFinder
+
+    finder = WeChatDBFinder(cache_path='')
+    for size in args.sizes:
+        for workers in (1, args.workers or 8):
+            with temp_database() as local_path:
+                paths = []
+                for i in range(8):
+                    path = make_wechat_msg_db(os.path.join(os.path.dirname(local_path), f'MSG{i}.db'), size, 100, seed=i)
+                    if i % 2:
+                        # 奇数号数据库的联系人与前一个不重复
+                        conn = sqlite3.connect(path)
+                        conn.execute("UPDATE rcontact SET UserName = UserName || '_' || ?", (i,))
+                        conn.commit()
+                        conn.close()
+                    paths.append(path)
+
+                start = time.perf_counter()
+                counts = ContactSync(finder=finder, max_workers=workers).sync(paths)
+                report(f'sync all ({workers} workers)', size * len(paths), time.perf_counter() - start,
+                       inserted=counts['inserted'])
+
+
+def bench_contact_sync(args):
+    """微信联系人增量同步：首次同步、源数据库未变、只有消息变化、新增 1% 联系人、1% 联系人修改备注，对比清空同步状态后的整表同步"""
+    from contact_sync import ContactSync
+    from wechatDBFinder import WeChatDBFinder
+
+    finder = WeChatDBFinder(cache_path='')
+    for size in args.sizes:
+        with temp_database() as local_path:
+            db_path = make_wechat_msg_db(os.path.join(os.path.dirname(local_path), 'MSG0.db'), size, 1000)
+            sync = ContactSync(finder=finder)
+
+            start = time.perf_counter()
+            counts = sync.sync([db_path])
+            report('sync (first)', size, time.perf_counter() - start, inserted=counts['inserted'])
+
+            start = time.perf_counter()
+            sync.sync([db_path])
+            report('sync (source unchanged)', size, time.perf_counter() - start)
+
+            source = sqlite3.connect(db_path)
+            source.execute("INSERT INTO MSG (StrTalker, StrContent, CreateTime, IsSender, Type) VALUES ('wxid_0', '新年好', 0, 0, 1)")
+            source.commit()
+            start = time.perf_counter()
+            counts = sync.sync([db_path])
+            report('sync (messages changed)', size, time.perf_counter() - start, updated=counts['updated'])
+
+            source.executemany('INSERT INTO rcontact VALUES (?, ?, ?, ?)',
+                               ((f'wxid_new_{i}', '', f'新朋友{i}', '') for i in range(max(size // 100, 1))))
+            source.commit()
+            start = time.perf_counter()
+            counts = sync.sync([db_path])
+            report('sync (1% contacts added)', size, time.perf_counter() - start, inserted=counts['inserted'])
+
+            source.execute("UPDATE rcontact SET Remark = Remark || '(新)' WHERE rowid % 100 = 0")
+            source.commit()
+            source.close()
+            start = time.perf_counter()
+            counts = sync.sync([db_path])
+            report('sync (1% remarks edited)', size, time.perf_counter() - start, updated=counts['updated'])
+
+            # 对照：清空同步状态后整表读取并写入全部联系人
+            conn = database.get_connection()
+            conn.execute('DELETE FROM contact_sync_rows')
+            conn.execute('DELETE FROM contact_sync_state')
+            conn.commit()
+            start = time.perf_counter()
+            counts = sync.sync([db_path])
+            report('full re-sync (no state)', size, time.perf_counter() - start, updated=counts['updated'])
+
+
+def bench_category_matrix(args):
+    """联系人 × 分类矩阵（1000 位联系人）：逐个联系人分析后排名 vs 一次构建矩阵，以及保存后内存映射载入和整列排名"""
+    from chat_analyzer import ChatAnalyzer
+    from contact_matrix import CategoryMatrix, np
+
+    for size in args.sizes:
+        with temp_database() as local_path:
+            conn = database.get_connection()
+            contact_ids = insert_contacts(conn, 1000)
+            insert_chats(conn, contact_ids, make_messages(size))
+
+            analyzer = ChatAnalyzer()
+            start = time.perf_counter()
+            totals = {contact_id: sum(analyzer.analyze_contact(contact_id)['category_counts'].values())
+                      for contact_id in contact_ids}
+            sorted(totals, key=totals.get, reverse=True)[:20]
+            report('per-contact analysis + rank', size, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            matrix = CategoryMatrix.build(conn)
+            report('build matrix', size, time.perf_counter() - start, backend='numpy' if np else 'array')
+
+            path = os.path.join(os.path.dirname(local_path), 'category_matrix.npy')
+            matrix.save(path)
+            start = time.perf_counter()
+            loaded = CategoryMatrix.load(path)
+            loaded.is_current(conn)
+            report('load matrix (mmap)', size, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for category in (None,) + loaded.categories:
+                loaded.top(20, category=category)
+            report('top-20 (all categories)', len(loaded.categories) + 1, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for contact_id in contact_ids:
+                loaded.summary(contact_id)
+            report('per-contact summary', len(contact_ids), time.perf_counter() - start)
+
+
+def bench_pipeline(args):
+    """完整流程：合成微信数据库（规模为消息条数，每 100 条消息一位联系人）到批量生成拜年微信，逐阶段计时
+
+    阶段依次为读取微信联系人和消息、关系判断、同步联系人和导入聊天记录、读取聊天记录、聊天分析和批量生成。
+    """
+    from chat_analyzer import ChatAnalyzer
+    from chat_importer import ChatImporter
+    from chat_manager import ChatManager
+    from contact_relation import RelationClassifier
+    from contact_sync import ContactSync
+    from greeting_generator import GreetingGenerator
+    from wechatDBFinder import WeChatDBFinder
+
+    finder = WeChatDBFinder(cache_path='')
+    for size in args.sizes:
+        contact_count = max(10, min(size // 100, 10000))
+        with temp_database() as local_path:
+            db_path = make_wechat_msg_db(os.path.join(os.path.dirname(local_path), 'MSG0.db'), contact_count, size)
+
+            start = time.perf_counter()
+            wechat_contacts = list(finder.iter_contacts(db_path))
+            report('extract contacts', len(wechat_contacts), time.perf_counter() - start)
+
+            start = time.perf_counter()
+            count = sum(1 for _ in finder.iter_messages(db_path))
+            report('extract messages', count, time.perf_counter() - start)
+
+            contacts = [{'name': contact['display_name'], 'notes': contact['remark'] or contact['nickname']}
+                        for contact in wechat_contacts]
+            start = time.perf_counter()
+            RelationClassifier().classify_many(contacts)
+            report('classify relations', len(contacts), time.perf_counter() - start)
+
+            start = time.perf_counter()
+            ContactSync(finder=finder).sync([db_path])
+            report('sync contacts', len(wechat_contacts), time.perf_counter() - start)
+
+            stats = ChatImporter(finder=finder).import_messages(db_path)
+            report('import chats', stats['imported'], stats['seconds'])
+
+            contact_ids = [row[0] for row in database.get_connection().execute('SELECT id FROM contacts ORDER BY id')]
+            manager = ChatManager(analyzer=ChatAnalyzer())
+            start = time.perf_counter()
+            for contact_id in contact_ids:
+                manager.get_recent_chats(contact_id, 20)
+            report('fetch recent chats (20)', len(contact_ids), time.perf_counter() - start)
+
+            start = time.perf_counter()
+            count = sum(1 for contact_id in contact_ids for _ in manager.iter_chats(contact_id))
+            report('fetch all chats (stream)', count, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for contact_id in contact_ids:
+                manager.analyze_contact(contact_id)
+            report('analyze contacts (first)', len(contact_ids), time.perf_counter() - start)
+
+            stats = GreetingGenerator(analyzer=ChatAnalyzer()).generate_batch(workers=args.workers)
+            report('batch greetings', stats['total'], stats['seconds'], workers=stats['workers'])
+
+
+BENCHMARKS = {
+    'save-chat': (bench_save_chat, [1000]),
+    'chat-writer': (bench_chat_writer, [10000, 100000]),
+    'keyword-scan': (bench_keyword_scan, [100000]),
+    'greeting-regenerate': (bench_greeting_regenerate, [10000, 100000]),
+    'incremental-analysis': (bench_incremental_analysis, [10000, 100000]),
+    'important-matters': (bench_important_matters, [10000, 100000]),
+    'batch-greetings': (bench_batch_greetings, [1000, 10000]),
+    'template-render': (bench_template_render, [100000]),
+    'message-stream': (bench_message_stream, [100000, 1000000]),
+    'import-chats': (bench_import_chats, [100000, 1000000]),
+    'discovery': (bench_discovery, [100, 500]),
+    'startup': (bench_startup, [1000, 100000]),
+    'relation-classify': (bench_relation_classify, [100000]),
+    'chat-search': (bench_chat_search, [100000, 1000000]),
+    'chat-listing': (bench_chat_listing, [100000]),
+    'contact-directory': (bench_contact_directory, [100000]),
+    'profiling-overhead': (bench_profiling_overhead, [100000]),
+    'multi-source': (bench_multi_source, [10000]),
+    'contact-sync': (bench_contact_sync, [10000, 100000]),
+    'category-matrix': (bench_category_matrix, [100000, 1000000]),
+    'pipeline': (bench_pipeline, [1000, 100000]),
+}
+
+
+def result_key(result):
+    return result['benchmark'], result['name'], result['size']
+
+
+def save_results(path, results, args):
+    """把本次运行的结果和运行环境写入 JSON 文件"""
+    import json
+    import platform
+    import subprocess
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    data = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sqlite': sqlite3.sqlite_version,
+        'benchmarks': args.benchmarks,
+        'workers': args.workers,
+        'results': results
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def load_results(path):
+    import json
+
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare_results(baseline, current, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """按 (基准项目, 结果名称, 规模) 对比两次运行的耗时并打印，返回变慢超过 threshold 的项目列表"""
+    previous = {result_key(result): result for result in baseline['results']}
+    regressions = []
+    print(f"\n对比基准 {baseline.get('commit') or '?'} ({baseline.get('created', '?')}) -> "
+          f"{current.get('commit') or '?'} ({current.get('created', '?')})")
+    for result in current['results']:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        change = (result['seconds'] - old['seconds']) / old['seconds'] if old['seconds'] > 0 else 0.0
+        mark = ''
+        if change > threshold:
+            mark = '  ⚠ 回归'
+            regressions.append(result)
+        elif change < -threshold:
+            mark = '  ✓ 提升'
+        print(f"{result['benchmark'] + ' / ' + result['name']:<48} n={result['size']:<8} "
+              f"{old['seconds'] * 1000:10.1f} ms -> {result['seconds'] * 1000:10.1f} ms  {change:+7.1%}{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='拜年微信生成程序性能基准')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='要运行的基准项目（可指定多个）：' + '、'.join(sorted(BENCHMARKS)))
+    parser.add_argument('--sizes', type=int, nargs='+', help='数据规模（可指定多个）')
+    parser.add_argument('--workers', type=int, default=None, help='并行基准使用的工作线程/进程数')
+    parser.add_argument('--json', metavar='PATH', help='把结果和运行环境写入 JSON 文件，用于不同版本之间对比')
+    parser.add_argument('--compare', nargs='+', metavar='JSON',
+                        help='与之前保存的结果对比：给一个文件时与本次运行对比，给两个文件时只对比这两个文件')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help='变慢超过这个比例时标记为回归（默认 0.10）')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"未知的基准项目: {', '.join(unknown)}")
+    if args.compare and len(args.compare) > 2:
+        parser.error('--compare 最多指定两个文件')
+    if not args.benchmarks and not (args.compare and len(args.compare) == 2):
+        parser.error('请指定要运行的基准项目，或用 --compare 指定两个结果文件')
+
+    if args.compare and len(args.compare) == 2:
+        regressions = compare_results(load_results(args.compare[0]), load_results(args.compare[1]), args.threshold)
+        return 1 if regressions else 0
+
+    sizes = args.sizes
+    for name in args.benchmarks:
+        func, default_sizes = BENCHMARKS[name]
+        args.sizes = sizes or default_sizes
+        first = len(RESULTS)
+        func(args)
+        for result in RESULTS[first:]:
+            result['benchmark'] = name
+    args.sizes = sizes
+
+    if args.json:
+        save_results(args.json, RESULTS, args)
+    if args.compare:
+        current = {'commit': None, 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': RESULTS}
+        if args.json:
+            current = load_results(args.json)
+        return 1 if compare_results(load_results(args.compare[0]), current, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import heapq
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+import profiling
+from database import get_connection, transaction
+from keyword_matcher import get_default_matcher, IMPORTANT_CATEGORY
+
+# 最近活动的时间范围（秒）和最多保留的条数
+RECENT_WINDOW = 30 * 24 * 3600
+RECENT_LIMIT = 20
+
+# 每位联系人保留评分最高的重要事项条数，以及重要事项和最近活动保留的字数
+IMPORTANT_TOP_K = 5
+SNIPPET_LENGTH = 60
+
+# 重要事项标记的强度（未列出的标记为 1）
+MARKER_WEIGHTS = {'务必': 3.0, '重要': 2.0, '记得': 1.0}
+
+# 近期得分：消息比该联系人最新的一条消息每早这么多秒扣 1 分（最新的消息为 0 分）
+RECENCY_UNIT = 30 * 24 * 3600
+
+# 一条重要事项：评分、消息时间、聊天 id（同分时的次序）和截断后的片段；按元组比较即按评分排序
+ImportantMatter = namedtuple('ImportantMatter', ['score', 'timestamp', 'chat_id', 'snippet'])
+
+
+def push_bounded(heap, item, limit):
+    """把 item 放入最多保留 limit 项的最小堆，已满时只替换掉最小的一项"""
+    if len(heap) < limit:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+
+def make_snippet(content, markers=()):
+    """截取不超过 SNIPPET_LENGTH 字的片段；内容较长时从第一个重要事项标记前不远处开始截取"""
+    if len(content) <= SNIPPET_LENGTH:
+        return content
+    positions = [content.find(marker) for marker in markers if marker in content]
+    start = min(positions) - SNIPPET_LENGTH // 4 if positions else 0
+    start = max(0, min(start, len(content) - SNIPPET_LENGTH))
+    return content[start:start + SNIPPET_LENGTH]
+
+
+def score_matter(content, result, timestamp):
+    """重要事项的排序分：标记强度 + 关键词密度（每 10 字的命中次数）+ 消息时间 / RECENCY_UNIT
+
+    与评分只差一个常数（最新消息时间 / RECENCY_UNIT），排名不随新消息变化，堆和持久化状态中保存的都是排序分，
+    输出时由 rank_matters 换算为评分。
+    """
+    markers = result.words[IMPORTANT_CATEGORY]
+    strength = sum(MARKER_WEIGHTS.get(marker, 1.0) for marker in markers)
+    # 同一标记重复出现只加半分
+    strength += (result.counts[IMPORTANT_CATEGORY] - len(markers)) * 0.5
+    keyword_hits = sum(count for category, count in result.counts.items() if category != IMPORTANT_CATEGORY)
+    density = keyword_hits * 10 / max(10, len(content))
+    return strength + density + timestamp / RECENCY_UNIT
+
+
+def recent_snippets(recent):
+    """recent（按时间从新到旧的 (消息时间, 片段)）中仍在最近活动时间范围内的片段"""
+    cutoff = int(time.time()) - RECENT_WINDOW
+    return [snippet for timestamp, snippet in recent if timestamp > cutoff]
+
+
+def rank_matters(heap, newest):
+    """按评分从高到低排列堆中的重要事项，近期得分换算为相对 newest（最新消息时间）的扣分"""
+    offset = (newest or 0) / RECENCY_UNIT
+    return [matter._replace(score=matter.score - offset) for matter in sorted(heap, reverse=True)]
+
+
+class ChatAnalyzer:
+    """聊天记录分析器（ChatManager 和 GreetingGenerator 共用）
+
+    分析结果按 (联系人 id, 最大聊天 id, 聊天条数) 缓存，并按 LRU 淘汰，
+    同一份聊天记录反复生成拜年微信时只分析一次。返回的结果是共享的，调用方不要修改。
+    最近活动与当前时间有关：缓存中另存最新的 RECENT_LIMIT 条 (消息时间, 片段)，命中时按当前时间重新筛选，
+    有活动移出时间范围时换成新的结果。
+    analyze_contact 直接读取数据库，关键词统计和重要事项持久化在 analysis_state 表中，
+    每次只扫描上次分析之后新增的聊天记录。
+    重要事项只在有界的最小堆中保留评分最高的 IMPORTANT_TOP_K 条片段（ImportantMatter，按评分从高到低），
+    最近活动只保留最新的 RECENT_LIMIT 条片段，每位联系人占用的内存与聊天记录条数无关。
+    """
+
+    def __init__(self, matcher=None, cache_size=256):
+        self.matcher = matcher or get_default_matcher()
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @profiling.timed('analysis')
+    def analyze(self, chats, contact_id=None):
+        """分析聊天记录（提取关键词和重要事项），命中缓存时直接返回
+
+        chats 为迭代器（如 ChatManager.iter_chats）时边读边分析，不缓存也不把记录放进列表。
+        """
+        if chats is not None and not isinstance(chats, (list, tuple)):
+            return self._analyze(chats)[0]
+        chats = list(chats or [])
+        key = self._cache_key(chats, contact_id)
+        result = self._cache_get(key)
+        if result is None:
+            result, recent = self._analyze(chats)
+            self._cache_put(key, result, recent)
+        return result
+
+    @profiling.timed('analysis')
+    def analyze_contact(self, contact_id):
+        """增量分析联系人的全部聊天记录：折叠新增消息到持久化状态，再读取最近一个月的消息"""
+        conn = get_connection()
+        max_id, count, newest = conn.execute('SELECT MAX(id), COUNT(*), MAX(timestamp) FROM chats WHERE contact_id = ?',
+                                             (contact_id,)).fetchone()
+        key = (contact_id, max_id, count, 'db') if count else None
+        result = self._cache_get(key)
+        if result is not None:
+            return result
+
+        state = self._load_state(conn, contact_id)
+        last_chat_id = state['last_chat_id']
+        rows = conn.execute('SELECT id, content, timestamp FROM chats WHERE contact_id = ? AND id > ? ORDER BY id',
+                            (contact_id, last_chat_id))
+        for row in rows:
+            self._fold(state, row['content'], row['timestamp'], row['id'])
+            last_chat_id = row['id']
+
+        if last_chat_id != state['last_chat_id']:
+            state['last_chat_id'] = last_chat_id
+            self._save_state(contact_id, state)
+
+        # 最新的几条消息由 (contact_id, timestamp) 索引直接定位，再筛选出最近一个月的
+        recent = [(row['timestamp'], make_snippet(row['content'] or '')) for row in conn.execute(
+            'SELECT content, timestamp FROM chats WHERE contact_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?',
+            (contact_id, RECENT_LIMIT))]
+
+        result = {
+            'keywords': state['keywords'],
+            'category_counts': state['category_counts'],
+            'important_matters': rank_matters(state['important_matters'], newest),
+            'recent_activities': recent_snippets(recent)
+        }
+        self._cache_put(key, result, recent)
+        return result
+
+    def invalidate(self, contact_id=None):
+        """清除某个联系人（不指定时清除全部）的缓存结果"""
+        with self._lock:
+            if contact_id is None:
+                self._cache.clear()
+                return
+            for key in [key for key in self._cache if key[0] == contact_id]:
+                del self._cache[key]
+
+    def _cache_get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            result, recent = entry
+            activities = recent_snippets(recent)
+            if len(activities) != len(result['recent_activities']):
+                result = dict(result, recent_activities=activities)
+                self._cache[key] = (result, recent)
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def _cache_put(self, key, result, recent):
+        if key is None:
+            return
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = (result, recent)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _load_state(self, conn, contact_id):
+        """读取联系人的增量分析状态，没有时返回空状态"""
+        row = conn.execute('SELECT * FROM analysis_state WHERE contact_id = ?', (contact_id,)).fetchone()
+        if row is None:
+            keywords, category_counts, important_matters, last_chat_id = [], {}, [], 0
+        else:
+            keywords = json.loads(row['keywords'])
+            category_counts = json.loads(row['category_counts'])
+            important_matters = [ImportantMatter(*matter) for matter in json.loads(row['important_matters'])]
+            heapq.heapify(important_matters)
+            last_chat_id = row['last_chat_id']
+        return {
+            'keywords': keywords,
+            'seen': set(keywords),
+            'category_counts': category_counts,
+            'important_matters': important_matters,
+            'last_chat_id': last_chat_id
+        }
+
+    def _save_state(self, contact_id, state):
+        with transaction() as conn:
+            conn.execute('''
+                INSERT INTO analysis_state (contact_id, last_chat_id, keywords, category_counts, important_matters)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(contact_id) DO UPDATE SET
+                    last_chat_id = excluded.last_chat_id,
+                    keywords = excluded.keywords,
+                    category_counts = excluded.category_counts,
+                    important_matters = excluded.important_matters,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (contact_id, state['last_chat_id'],
+                  json.dumps(state['keywords'], ensure_ascii=False),
+                  json.dumps(state['category_counts'], ensure_ascii=False),
+                  json.dumps(sorted(state['important_matters'], reverse=True), ensure_ascii=False)))
+
+    def _fold(self, state, content, timestamp, chat_id):
+        """把一条消息计入关键词统计；是重要事项时评分后放入前 K 条的堆中"""
+        content = content or ''
+        result = self.matcher.scan(content)
+        keywords = state['keywords']
+        seen = state['seen']
+        category_counts = state['category_counts']
+
+        # 提取关键词（按首次出现顺序去重）
+        for category, words in result.words.items():
+            if category == IMPORTANT_CATEGORY:
+                continue
+            category_counts[category] = category_counts.get(category, 0) + result.counts[category]
+            for word in words:
+                if word not in seen:
+                    seen.add(word)
+                    keywords.append(word)
+
+        if result.counts.get(IMPORTANT_CATEGORY):
+            matter = ImportantMatter(score_matter(content, result, timestamp), timestamp, chat_id,
+                                     make_snippet(content, result.words[IMPORTANT_CATEGORY]))
+            push_bounded(state['important_matters'], matter, IMPORTANT_TOP_K)
+
+    def _cache_key(self, chats, contact_id):
+        """缓存键 (联系人 id, 最大聊天 id, 聊天条数, 来源)；聊天记录没有 id 时不缓存"""
+        if not chats:
+            return None
+        try:
+            if contact_id is None:
+                contact_id = chats[0]['contact_id']
+            max_id = max(chat['id'] for chat in chats)
+        except (KeyError, IndexError, TypeError):
+            return None
+        if contact_id is None:
+            return None
+        return (contact_id, max_id, len(chats), 'chats')
+
+    def _analyze(self, chats):
+        """分析聊天记录，返回 (结果, 最新的 RECENT_LIMIT 条 (消息时间, 片段))"""
+        state = {'keywords': [], 'seen': set(), 'category_counts': {}, 'important_matters': []}
+        recent = []
+        newest = None
+
+        for position, chat in enumerate(chats):
+            content = chat['content']
+            timestamp = chat['timestamp']
+            try:
+                chat_id = chat['id']
+            except (KeyError, IndexError):
+                chat_id = position
+
+            # 提取关键词和重要事项
+            self._fold(state, content, timestamp, chat_id)
+            if newest is None or timestamp > newest:
+                newest = timestamp
+
+            # 只保留最新的 RECENT_LIMIT 条（timestamp 为整数秒），最近活动是其中一个月内的
+            push_bounded(recent, (timestamp, chat_id, content), RECENT_LIMIT)
+
+        recent = [(timestamp, make_snippet(content or '')) for timestamp, _, content in sorted(recent, reverse=True)]
+        result = {
+            'keywords': state['keywords'],
+            'category_counts': state['category_counts'],
+            'important_matters': rank_matters(state['important_matters'], newest),
+            'recent_activities': recent_snippets(recent)
+        }
+        return result, recent
+
+
+# 全局共享的分析器
+default_analyzer = ChatAnalyzer()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import profiling
+from database import get_connection, index_pending_chats
+from wechatDBFinder import WeChatDBFinder
+
+# 微信文本消息的类型值
+TEXT_MESSAGE_TYPE = 1
+
+
+def normalize_create_time(create_time):
+    """把微信的 CreateTime（秒或毫秒时间戳）转换为 chats.timestamp 使用的整数秒"""
+    if create_time is None:
+        return None
+    create_time = int(create_time)
+    if create_time > 100000000000:
+        create_time //= 1000
+    return create_time
+
+
+class ChatImporter:
+    """把微信消息表中的聊天记录导入本地 chats 表
+
+    消息按 talker（微信 id）映射到本地联系人，保留原始发送时间，用 executemany 分批写入，
+    每 commit_every 条提交一次大事务。每个源数据库、每张消息表的导入进度（最后的消息 id 和时间）
+    与数据在同一事务中记录在 import_state 表，重复运行时只复制新增的消息。
+    进度会越过没有对应本地联系人的消息，这些会话及其跳过的最后一条消息 id 记录在 import_unmapped 表；
+    之后该会话能映射到联系人时（如新增了联系人），先补导它在进度之前被跳过的消息。
+    每次提交前用一条语句为本事务写入的消息建立全文索引。
+    """
+
+    def __init__(self, finder=None, batch_size=5000, commit_every=100000, text_only=True):
+        self.finder = finder or WeChatDBFinder()
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.text_only = text_only
+
+    def load_state(self, source):
+        """读取某个源数据库各消息表的导入进度 {表名: 最后导入的消息 id}"""
+        conn = get_connection()
+        rows = conn.execute('SELECT table_name, last_local_id FROM import_state WHERE source = ?', (source,))
+        return {row['table_name']: row['last_local_id'] for row in rows}
+
+    def load_unmapped(self, source):
+        """读取某个源数据库中因没有对应联系人而跳过的会话 {(表名, talker): 跳过的最后一条消息 id}"""
+        conn = get_connection()
+        rows = conn.execute('SELECT table_name, talker, last_local_id FROM import_unmapped WHERE source = ?', (source,))
+        return {(row['table_name'], row['talker']): row['last_local_id'] for row in rows}
+
+    def build_contact_map(self, db_path):
+        """建立 talker -> 本地联系人 id 的映射：优先用微信 id，其次用源库 rcontact 中的显示名称匹配本地姓名"""
+        conn = get_connection()
+        by_wechat_id = {}
+        by_name = {}
+        for row in conn.execute('SELECT id, name, wechat_id FROM contacts ORDER BY id'):
+            if row['wechat_id']:
+                by_wechat_id[row['wechat_id']] = row['id']
+            by_name.setdefault(row['name'], row['id'])
+
+        contact_map = dict(by_wechat_id)
+        for contact in self.finder.iter_contacts(db_path):
+            username = contact['username']
+            if username and username not in contact_map and contact['display_name'] in by_name:
+                contact_map[username] = by_name[contact['display_name']]
+        return contact_map
+
+    @profiling.timed('import.chats')
+    def import_messages(self, db_path, progress=None):
+        """导入一个微信数据库中的全部新消息，返回导入统计
+
+        没有对应本地联系人的消息（如群聊）和非文本消息计入统计后跳过，进度同样越过它们；
+        此前跳过、现在已能映射到联系人的会话先补导（计入 imported 和 backfilled）。
+        progress(已导入条数, 已用秒数) 在每次提交后调用。
+        """
+        source = os.path.abspath(db_path)
+        start = time.perf_counter()
+        stats = {'imported': 0, 'backfilled': 0, 'unmapped': 0, 'skipped': 0, 'tables': {}}
+
+        contact_map = self.build_contact_map(db_path)
+        state = self.load_state(source)
+        resolved = {key: last_id for key, last_id in self.load_unmapped(source).items() if key[1] in contact_map}
+        # 每张表的进度：表名 -> [最后消息 id, 最后消息时间, 未提交的导入条数]
+        marks = {}
+        # 本次跳过的会话：(表名, talker) -> 最后一条消息 id
+        unmapped = {}
+        batch = []
+        uncommitted = 0
+
+        conn = get_connection()
+        try:
+            for message, backfill in self._iter_messages(db_path, state, resolved):
+                if not backfill:
+                    mark = marks.setdefault(message.table, [0, 0, 0])
+                    mark[0] = message.local_id
+                    mark[1] = message.create_time or mark[1]
+
+                if not message.content or self.text_only and message.msg_type not in (None, TEXT_MESSAGE_TYPE):
+                    if not backfill:
+                        stats['skipped'] += 1
+                    continue
+                contact_id = contact_map.get(message.talker)
+                if contact_id is None:
+                    stats['unmapped'] += 1
+                    unmapped[message.table, message.talker] = message.local_id
+                    continue
+
+                batch.append((contact_id, message.content, normalize_create_time(message.create_time)))
+                if backfill:
+                    stats['backfilled'] += 1
+                else:
+                    mark[2] += 1
+                stats['tables'][message.table] = stats['tables'].get(message.table, 0) + 1
+
+                if len(batch) >= self.batch_size:
+                    self._insert(conn, batch)
+                    uncommitted += len(batch)
+                    batch = []
+                    # 补导的消息与删除对应的未映射记录在同一事务中提交，补导期间不分段提交
+                    if uncommitted >= self.commit_every and not backfill:
+                        self._commit(conn, source, marks, unmapped, resolved)
+                        resolved = {}
+                        stats['imported'] += uncommitted
+                        uncommitted = 0
+                        if progress:
+                            progress(stats['imported'], time.perf_counter() - start)
+
+            self._insert(conn, batch)
+            uncommitted += len(batch)
+            self._commit(conn, source, marks, unmapped, resolved)
+            stats['imported'] += uncommitted
+        except BaseException:
+            conn.rollback()
+            raise
+
+        stats['seconds'] = time.perf_counter() - start
+        profiling.count('chats.imported', stats['imported'])
+        if progress:
+            progress(stats['imported'], stats['seconds'])
+        return stats
+
+    def _iter_messages(self, db_path, state, resolved):
+        """依次产出 (消息, 是否补导)：先是 resolved 中各会话在进度之前被跳过的消息，再是进度之后的新消息"""
+        by_table = {}
+        for (table, talker), last_id in resolved.items():
+            by_table.setdefault(table, {})[talker] = last_id
+        for table, talkers in by_table.items():
+            for message in self.finder.iter_messages(db_path, batch_size=self.batch_size, tables=[table],
+                                                     until_ids={table: max(talkers.values())}, talkers=sorted(talkers)):
+                if message.local_id <= talkers[message.talker]:
+                    yield message, True
+        for message in self.finder.iter_messages(db_path, batch_size=self.batch_size, after_ids=state):
+            yield message, False
+
+    def _insert(self, conn, batch):
+        if not batch:
+            return
+        conn.executemany("INSERT INTO chats (contact_id, content, timestamp) "
+                         "VALUES (?, ?, COALESCE(?, CAST(strftime('%s', 'now') AS INTEGER)))", batch)
+
+    def _commit(self, conn, source, marks, unmapped, resolved):
+        """为本事务写入的消息建立全文索引，记录各消息表的导入进度和跳过的会话，并与已写入的消息一起提交"""
+        index_pending_chats(conn)
+        conn.executemany('''
+            INSERT INTO import_state (source, table_name, last_local_id, last_create_time, imported_count)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(source, table_name) DO UPDATE SET
+                last_local_id = excluded.last_local_id,
+                last_create_time = excluded.last_create_time,
+                imported_count = import_state.imported_count + excluded.imported_count,
+                updated_at = CURRENT_TIMESTAMP
+        ''', [(source, table, mark[0], mark[1], mark[2]) for table, mark in marks.items()])
+        # 已补导的会话不再记录；此后又跳过的消息重新记入
+        conn.executemany('DELETE FROM import_unmapped WHERE source = ? AND table_name = ? AND talker = ?',
+                         [(source, table, talker) for table, talker in resolved])
+        conn.executemany('''
+            INSERT INTO import_unmapped (source, table_name, talker, last_local_id) VALUES (?, ?, ?, ?)
+            ON CONFLICT(source, table_name, talker) DO UPDATE SET
+                last_local_id = MAX(last_local_id, excluded.last_local_id)
+        ''', [(source, table, talker, last_id) for (table, talker), last_id in unmapped.items()])
+        conn.commit()
+        for mark in marks.values():
+            mark[2] = 0
+        unmapped.clear()
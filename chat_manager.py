@@ -3,75 +3,227 @@
 
 import sqlite3
 import os
+import re
+import time
 import datetime
-from database import get_db_connection
+import profiling
+from database import get_connection, transaction, fts_available, fts_segment, index_pending_chats, reindex_chats
+from chat_analyzer import default_analyzer
+
+# 搜索词：双引号括起的短语或以空白分隔的词
+SEARCH_TERM = re.compile(r'"([^"]+)"|(\S+)')
+
+# 按 id 删除聊天记录时每条语句的 id 个数（不超过 SQLite 的参数个数上限）
+DELETE_CHUNK_SIZE = 500
+
+
+def parse_search_terms(text):
+    """把搜索文字拆分为词和短语列表"""
+    return [phrase or word for phrase, word in SEARCH_TERM.findall(text or '')]
+
+
+def build_match_query(terms):
+    """把搜索词转换为 FTS5 MATCH 表达式：每个词按索引的分词方式（汉字单字）转换为短语，多个词同时命中
+
+    没有可检索字符（例如只有标点）的词被忽略，全部被忽略时返回 None。
+    """
+    phrases = []
+    for term in terms:
+        tokens = re.findall(r'\w+', fts_segment(term))
+        if tokens:
+            phrases.append('"' + ' '.join(tokens) + '"')
+    return ' AND '.join(phrases) or None
+
+
+def to_epoch(value):
+    """把 datetime（无时区时按本地时间）或整数秒统一为 chats.timestamp 使用的整数秒"""
+    if isinstance(value, datetime.datetime):
+        return int(value.timestamp())
+    return int(value)
+
+
+def format_timestamp(timestamp):
+    """把 chats.timestamp（整数秒）格式化为本地时间文字"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def _like_pattern(term):
+    return '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
 
 class ChatManager:
-    def __init__(self):
-        pass
+    def __init__(self, analyzer=None):
+        self.analyzer = analyzer or default_analyzer
 
     def save_chat(self, contact_id, content):
-        """保存聊天记录"""
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO chats (contact_id, content) VALUES (?, ?)', (contact_id, content))
-        conn.commit()
-        chat_id = cursor.lastrowid
-        conn.close()
-        return chat_id
+        """保存聊天记录（每次调用提交一次；大量写入时请用 open_writer）"""
+        with transaction() as conn:
+            cursor = conn.execute('INSERT INTO chats (contact_id, content) VALUES (?, ?)', (contact_id, content))
+            index_pending_chats(conn)
+        self.analyzer.invalidate(contact_id)
+        return cursor.lastrowid
+
+    def update_chat(self, chat_id, content):
+        """修改一条聊天记录的内容，同一事务中更新全文索引；返回是否找到了这条记录"""
+        with transaction() as conn:
+            row = conn.execute('SELECT contact_id, content FROM chats WHERE id = ?', (chat_id,)).fetchone()
+            if row is None:
+                return False
+            conn.execute('UPDATE chats SET content = ? WHERE id = ?', (content, chat_id))
+            reindex_chats(conn, [(chat_id, row['content'])])
+            self._reset_analysis(conn, [row['contact_id']])
+        return True
+
+    def delete_chats(self, chat_ids):
+        """删除聊天记录，同一事务中从全文索引中删除；返回删除的条数"""
+        chat_ids = list(chat_ids)
+        rows = []
+        with transaction() as conn:
+            for i in range(0, len(chat_ids), DELETE_CHUNK_SIZE):
+                chunk = chat_ids[i:i + DELETE_CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows += conn.execute(f'SELECT id, contact_id, content FROM chats WHERE id IN ({placeholders})',
+                                     chunk).fetchall()
+                conn.execute(f'DELETE FROM chats WHERE id IN ({placeholders})', chunk)
+            reindex_chats(conn, [(row['id'], row['content']) for row in rows])
+            self._reset_analysis(conn, {row['contact_id'] for row in rows})
+        return len(rows)
 
+    def _reset_analysis(self, conn, contact_ids):
+        """已分析过的聊天记录被修改或删除后，清除这些联系人的增量分析状态和缓存，下次分析时重新扫描"""
+        conn.executemany('DELETE FROM analysis_state WHERE contact_id = ?', [(contact_id,) for contact_id in contact_ids])
+        for contact_id in contact_ids:
+            self.analyzer.invalidate(contact_id)
+
+    def open_writer(self, **options):
+        """打开成组提交的聊天记录写入队列（ChatWriter），用完后 close() 或用 with 语句"""
+        from chat_writer import ChatWriter
+
+        return ChatWriter(analyzer=self.analyzer, **options)
+
+    @profiling.timed('chat_fetch')
     def get_chats_by_contact_id(self, contact_id):
-        """获取联系人的聊天记录"""
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM chats WHERE contact_id = ? ORDER BY timestamp DESC', (contact_id,))
-        chats = cursor.fetchall()
-        conn.close()
-        return chats
+        """获取联系人的全部聊天记录（从新到旧）；记录较多时请用 get_chats_page 或 iter_chats"""
+        conn = get_connection()
+        cursor = conn.execute('SELECT * FROM chats WHERE contact_id = ? ORDER BY timestamp DESC, id DESC', (contact_id,))
+        return cursor.fetchall()
+
+    def count_chats(self, contact_id):
+        """联系人的聊天记录条数（只读索引）"""
+        return get_connection().execute('SELECT COUNT(*) FROM chats WHERE contact_id = ?', (contact_id,)).fetchone()[0]
+
+    @profiling.timed('chat_fetch')
+    def get_chats_page(self, contact_id, page_size=20, after=None):
+        """按时间从新到旧取一页聊天记录（键集分页）
+
+        after 为上一页返回的游标 (timestamp, id)，从它之后继续取，不传时取第一页。
+        返回 (本页记录, 下一页游标)，没有更多记录时游标为 None。
+        按 (contact_id, timestamp) 索引定位，翻到多深都不需要跳过前面的行。
+        """
+        conn = get_connection()
+        if after is None:
+            rows = conn.execute('SELECT * FROM chats WHERE contact_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?',
+                                (contact_id, page_size)).fetchall()
+        else:
+            # (timestamp, id) < 游标 拆成“同一时间、id 更小”和“时间更早”两段，两段都能在索引上直接定位；
+            # 写成行值比较时 SQLite 只用 timestamp 列定位，同一秒的大量记录会被逐行跳过
+            rows = conn.execute('''
+                SELECT * FROM (
+                    SELECT * FROM chats WHERE contact_id = :contact_id AND timestamp = :timestamp AND id < :id
+                    ORDER BY id DESC LIMIT :limit
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT * FROM chats WHERE contact_id = :contact_id AND timestamp < :timestamp
+                    ORDER BY timestamp DESC, id DESC LIMIT :limit
+                )
+                ORDER BY timestamp DESC, id DESC LIMIT :limit
+            ''', {'contact_id': contact_id, 'timestamp': after[0], 'id': after[1], 'limit': page_size}).fetchall()
+        cursor = (rows[-1]['timestamp'], rows[-1]['id']) if len(rows) == page_size else None
+        return rows, cursor
+
+    def iter_chats(self, contact_id, page_size=500):
+        """逐页读取联系人的聊天记录并逐条产出（从新到旧），内存中最多只有一页"""
+        after = None
+        while True:
+            rows, after = self.get_chats_page(contact_id, page_size, after)
+            yield from rows
+            if after is None:
+                return
+
+    @profiling.timed('chat_fetch')
+    def get_chats_between(self, contact_id, since=None, until=None, limit=None):
+        """取联系人在 [since, until) 时间范围内的聊天记录（从新到旧），since/until 为整数秒或 datetime
+
+        时间条件和条数限制都交给 SQLite，由 (contact_id, timestamp) 索引直接定位范围。
+        """
+        where = ['contact_id = ?']
+        params = [contact_id]
+        if since is not None:
+            where.append('timestamp >= ?')
+            params.append(to_epoch(since))
+        if until is not None:
+            where.append('timestamp < ?')
+            params.append(to_epoch(until))
+        params.append(-1 if limit is None else limit)
+        conn = get_connection()
+        return conn.execute(f'''
+            SELECT * FROM chats WHERE {' AND '.join(where)}
+            ORDER BY timestamp DESC, id DESC LIMIT ?
+        ''', params).fetchall()
+
+    def get_recent_chats(self, contact_id, limit=20):
+        """取联系人最近的 limit 条聊天记录（从新到旧）"""
+        return self.get_chats_between(contact_id, limit=limit)
+
+    def search_chats(self, text, page=1, page_size=20, contact_id=None):
+        """在全部（或指定联系人的）聊天记录中搜索关键词或短语，按相关度排序并分页
+
+        返回 {'total': 命中总数, 'page': 页码, 'pages': 总页数, 'results': 本页记录}，
+        记录包含 id、contact_id、name（联系人姓名）、content、timestamp。
+        只读，不写数据库（索引由写入聊天记录的程序维护）；数据库没有全文索引时退回 LIKE 查询（按时间从新到旧排序）。
+        """
+        page = max(1, page)
+        terms = parse_search_terms(text)
+        conn = get_connection()
+
+        if fts_available(conn):
+            match = build_match_query(terms)
+            if match is None:
+                return {'total': 0, 'page': page, 'pages': 0, 'results': []}
+            source = 'chats_fts JOIN chats c ON c.id = chats_fts.rowid'
+            where = ['chats_fts MATCH ?']
+            params = [match]
+            order = 'bm25(chats_fts), c.id DESC'
+        else:
+            terms = [term for term in terms if term.strip()]
+            if not terms:
+                return {'total': 0, 'page': page, 'pages': 0, 'results': []}
+            source = 'chats c'
+            where = ["c.content LIKE ? ESCAPE '\\'"] * len(terms)
+            params = [_like_pattern(term) for term in terms]
+            order = 'c.id DESC'
+
+        if contact_id is not None:
+            where.append('c.contact_id = ?')
+            params.append(contact_id)
+        where = ' AND '.join(where)
+
+        total = conn.execute(f'SELECT COUNT(*) FROM {source} WHERE {where}', params).fetchone()[0]
+        results = conn.execute(f'''
+            SELECT c.id, c.contact_id, ct.name, c.content, c.timestamp
+            FROM {source}
+            LEFT JOIN contacts ct ON ct.id = c.contact_id
+            WHERE {where}
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+        ''', params + [page_size, (page - 1) * page_size]).fetchall()
+        return {'total': total, 'page': page, 'pages': -(-total // page_size), 'results': results}
 
     def analyze_chats(self, chats):
-        """分析聊天记录（提取关键词和重要事项）"""
-        if not chats:
-            return {
-                'keywords': [],
-                'important_matters': [],
-                'recent_activities': []
-            }
-
-        keywords = []
-        important_matters = []
-        recent_activities = []
-
-        keyword_patterns = [
-            {'pattern': ['工作', '项目', '任务'], 'category': '工作'},
-            {'pattern': ['健康', '身体', '生病'], 'category': '健康'},
-            {'pattern': ['家庭', '孩子', '父母'], 'category': '家庭'},
-            {'pattern': ['学习', '考试', '毕业'], 'category': '学习'},
-            {'pattern': ['生日', '节日', '庆祝'], 'category': '节日'},
-            {'pattern': ['帮助', '支持', '感谢'], 'category': '情感'},
-            {'pattern': ['计划', '目标', '未来'], 'category': '规划'}
-        ]
-
-        for chat in chats:
-            content = chat['content']
-            # 提取关键词
-            for pattern in keyword_patterns:
-                for word in pattern['pattern']:
-                    if word in content and word not in keywords:
-                        keywords.append(word)
-
-            # 提取重要事项
-            if '重要' in content or '记得' in content or '务必' in content:
-                important_matters.append(content)
-
-            # 提取最近活动（一个月内）
-            timestamp = datetime.datetime.fromisoformat(chat['timestamp'])
-            one_month_ago = datetime.datetime.now() - datetime.timedelta(days=30)
-            if timestamp > one_month_ago:
-                recent_activities.append(content)
-
-        return {
-            'keywords': keywords,
-            'important_matters': important_matters,
-            'recent_activities': recent_activities
-        }
\ No newline at end of file
+        """分析聊天记录（提取关键词和重要事项）；chats 可以是 iter_chats 返回的迭代器"""
+        return self.analyzer.analyze(chats)
+
+    def analyze_contact(self, contact_id):
+        """增量分析联系人在数据库中的全部聊天记录"""
+        return self.analyzer.analyze_contact(contact_id)
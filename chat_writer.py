@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import profiling
+from database import get_connection, release_connection, index_pending_chats
+from chat_analyzer import default_analyzer
+
+# 写入线程的停止标记
+_STOP = None
+
+
+class ChatWriter:
+    """聊天记录的成组提交写入队列
+
+    任意线程（或协程，见 save_async）提交的聊天记录由一个写入线程攒批写入：
+    攒够 batch_size 条，或第一条等待超过 flush_interval 秒时，在一个 BEGIN IMMEDIATE 事务中批量插入，
+    提交前用 index_pending_chats 一次性建立全文索引，整批只提交一次。
+    submit 返回 Future，写入提交后得到新聊天记录的 id，写入失败时整批的 Future 都得到该异常。
+    队列有上限，写入跟不上时 submit 阻塞。close() 和解释器退出时先写完队列中已提交的记录再停止，并关闭写入线程的连接。
+    """
+
+    def __init__(self, batch_size=500, flush_interval=0.05, max_pending=10000, analyzer=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.analyzer = analyzer or default_analyzer
+        self.batches = 0
+        self.rows = 0
+        self._queue = queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        self._closed = False
+        # 守护线程：解释器退出时不等待它，由 atexit 中的 close() 写完剩余记录
+        self._thread = threading.Thread(target=self._run, name='chat-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def submit(self, contact_id, content, timestamp=None):
+        """提交一条聊天记录，返回 Future（结果为新聊天记录的 id）；timestamp 为整数秒，默认为写入时间"""
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('聊天记录写入队列已关闭')
+            self._queue.put((future, contact_id, content, timestamp))
+        return future
+
+    def submit_many(self, chats):
+        """提交多条 (contact_id, content) 或 (contact_id, content, timestamp)，返回 Future 列表"""
+        return [self.submit(*chat) for chat in chats]
+
+    async def save_async(self, contact_id, content, timestamp=None):
+        """在协程中提交一条聊天记录并等待写入，返回新聊天记录的 id"""
+        import asyncio
+
+        return await asyncio.wrap_future(self.submit(contact_id, content, timestamp))
+
+    def flush(self, timeout=None):
+        """立即写入已提交的全部记录，并等待写入完成"""
+        marker = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('聊天记录写入队列已关闭')
+            self._queue.put(marker)
+        marker.result(timeout)
+
+    def close(self, timeout=None):
+        """停止接受新记录，写完已提交的记录后结束写入线程（可重复调用）"""
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(_STOP)
+        atexit.unregister(self.close)
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            while True:
+                batch, markers, stop = self._collect()
+                if batch:
+                    self._write(batch)
+                for marker in markers:
+                    marker.set_result(None)
+                if stop:
+                    return
+        finally:
+            # 写入线程的连接随线程结束关闭
+            release_connection()
+
+    def _collect(self):
+        """取出下一批：等待第一条，之后攒到 batch_size 条或 flush_interval 秒；遇到 flush 或停止标记时立即写入"""
+        batch = []
+        markers = []
+        item = self._queue.get()
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            if item is _STOP:
+                return batch, markers, True
+            if isinstance(item, Future):
+                markers.append(item)
+                return batch, markers, False
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                return batch, markers, False
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                return batch, markers, False
+
+    def _write(self, batch):
+        # 已取消的记录不再写入
+        batch = [item for item in batch if item[0].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        conn = get_connection()
+        try:
+            with profiling.stage('write.chats'):
+                conn.execute('BEGIN IMMEDIATE')
+                after_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM chats').fetchone()[0]
+                conn.executemany('''
+                    INSERT INTO chats (contact_id, content, timestamp)
+                    VALUES (?, ?, COALESCE(?, CAST(strftime('%s', 'now') AS INTEGER)))
+                ''', [(contact_id, content, timestamp) for _, contact_id, content, timestamp in batch])
+                index_pending_chats(conn)
+                # 持有写锁期间没有其它写入，id 大于 after_id 的就是本批按插入顺序分配的 id
+                ids = [row[0] for row in conn.execute('SELECT id FROM chats WHERE id > ? ORDER BY id', (after_id,))]
+                conn.commit()
+        except BaseException as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for future, *_ in batch:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.rows += len(batch)
+        profiling.count('write.rows', len(batch))
+        for contact_id in {item[1] for item in batch}:
+            self.analyzer.invalidate(contact_id)
+        for (future, *_), chat_id in zip(batch, ids):
+            future.set_result(chat_id)
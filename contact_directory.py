@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+from bisect import bisect_left, insort
+from collections import Counter
+import database
+
+try:
+    from pypinyin import lazy_pinyin
+except ImportError:  # 可选依赖：没有安装时不提供拼音查找
+    lazy_pinyin = None
+
+# 联系人记录在内存中保留的字段（与 contacts 表同名）
+CONTACT_FIELDS = ('id', 'name', 'phone', 'relation', 'notes', 'wechat_id')
+
+
+class ContactRecord:
+    """内存中的联系人记录
+
+    使用 __slots__，每条记录没有实例字典；支持 contact['name'] 形式的读取，
+    可以直接替代 sqlite3.Row 传给 ChatManager 和 GreetingGenerator。
+    """
+
+    __slots__ = CONTACT_FIELDS
+
+    def __init__(self, id, name, phone=None, relation=None, notes=None, wechat_id=None):
+        self.id = id
+        self.name = name
+        self.phone = phone
+        self.relation = relation
+        self.notes = notes
+        self.wechat_id = wechat_id
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def keys(self):
+        return list(CONTACT_FIELDS)
+
+    def __repr__(self):
+        return f'ContactRecord(id={self.id!r}, name={self.name!r}, relation={self.relation!r})'
+
+
+def name_grams(name):
+    """模糊查找使用的相邻字对（首尾加边界符，单字姓名也有字对）"""
+    padded = f'^{name}$'
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+
+def name_to_pinyin(name):
+    """姓名的拼音查找键：(全拼, 首字母)，如 张老师 -> ('zhanglaoshi', 'zls')；没有安装 pypinyin 时返回 None"""
+    if lazy_pinyin is None:
+        return None
+    syllables = [syllable.lower() for syllable in lazy_pinyin(name) if syllable.strip()]
+    return ''.join(syllables), ''.join(syllable[0] for syllable in syllables)
+
+
+class ContactDirectory:
+    """常驻内存的联系人目录，按姓名查找联系人时不访问数据库
+
+    首次查找时从 contacts 表整体载入一次，之后由写入方调用 add/update 保持一致，
+    批量写入（如微信联系人导入）后调用 invalidate，下次查找时重新载入。
+    - 精确查找：姓名 -> 记录的字典，同名时取 id 最小的一条（与按姓名查询数据库的结果一致）
+    - 前缀查找：排序的姓名列表上二分定位
+    - 拼音查找：安装了 pypinyin 时按全拼或首字母前缀查找，拼音索引在第一次使用时建立
+    - 模糊查找：先用相邻字对索引挑出少量候选，再按 difflib 相似度排序，用于姓名输错时给出建议
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded_path = None
+        self._by_id = {}
+        self._by_name = {}
+        self._names = []
+        self._pinyin = None
+        self._grams = None
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._by_id)
+
+    def __iter__(self):
+        """按登记顺序（载入时按 id）遍历全部联系人"""
+        self._ensure_loaded()
+        with self._lock:
+            return iter(list(self._by_id.values()))
+
+    def load(self, conn=None):
+        """从数据库整体载入联系人（替换当前内容）"""
+        conn = conn or database.get_connection()
+        rows = conn.execute(f'SELECT {", ".join(CONTACT_FIELDS)} FROM contacts ORDER BY id')
+        by_id = {}
+        by_name = {}
+        relations = {}
+        for row in rows:
+            record = ContactRecord(*row)
+            # 关系只有少数几种取值，同一取值共用一个字符串对象
+            record.relation = relations.setdefault(record.relation, record.relation)
+            by_id[record.id] = record
+            by_name.setdefault(record.name, record)
+        with self._lock:
+            self._by_id = by_id
+            self._by_name = by_name
+            self._names = sorted(by_name)
+            self._pinyin = None
+            self._grams = None
+            self._loaded_path = database.DB_PATH
+
+    def invalidate(self):
+        """丢弃已载入的内容，下次查找时重新载入（批量写入联系人后调用）"""
+        with self._lock:
+            self._loaded_path = None
+
+    def _ensure_loaded(self):
+        # 本地数据库路径变化（测试、基准切换数据库）时同样重新载入
+        if self._loaded_path != database.DB_PATH:
+            with self._lock:
+                if self._loaded_path != database.DB_PATH:
+                    self.load()
+
+    def add(self, record):
+        """登记新写入数据库的联系人（record 为 ContactRecord 或含 CONTACT_FIELDS 的映射）"""
+        if not isinstance(record, ContactRecord):
+            record = ContactRecord(**{field: record[field] for field in record.keys() if field in CONTACT_FIELDS})
+        self._ensure_loaded()
+        with self._lock:
+            self._by_id[record.id] = record
+            self._index_name(record)
+
+    def update(self, contact_id, **fields):
+        """更新已登记联系人的字段（与数据库中的 UPDATE 同时调用），返回更新后的记录；联系人不存在时返回 None"""
+        self._ensure_loaded()
+        with self._lock:
+            record = self._by_id.get(contact_id)
+            if record is None:
+                return None
+            old_name = record.name
+            for field, value in fields.items():
+                if field not in CONTACT_FIELDS or field == 'id':
+                    raise KeyError(field)
+                setattr(record, field, value)
+            if record.name != old_name:
+                self._unindex_name(old_name, record)
+                self._index_name(record)
+            return record
+
+    def _index_name(self, record):
+        current = self._by_name.get(record.name)
+        if current is not None:
+            if record.id < current.id:
+                self._by_name[record.name] = record
+            return
+        self._by_name[record.name] = record
+        insort(self._names, record.name)
+        if self._pinyin is not None:
+            self._add_pinyin(record.name)
+        if self._grams is not None:
+            self._add_grams(record.name)
+
+    def _unindex_name(self, name, record):
+        if self._by_name.get(name) is not record:
+            return
+        # 改名的是同名联系人中 id 最小的一位：改由剩下的同名联系人占用这个姓名（少见，逐条查找）
+        others = [other for other in self._by_id.values() if other.name == name]
+        if others:
+            self._by_name[name] = min(others, key=lambda other: other.id)
+            return
+        del self._by_name[name]
+        del self._names[bisect_left(self._names, name)]
+        if self._pinyin is not None:
+            self._pinyin = [entry for entry in self._pinyin if entry[1] != name]
+        if self._grams is not None:
+            for gram in name_grams(name):
+                self._grams[gram].remove(name)
+
+    def _add_pinyin(self, name):
+        keys = name_to_pinyin(name)
+        for key in set(keys):
+            if key:
+                insort(self._pinyin, (key, name))
+
+    def _add_grams(self, name):
+        for gram in name_grams(name):
+            self._grams.setdefault(gram, []).append(name)
+
+    def get(self, name):
+        """按姓名精确查找，找不到时返回 None"""
+        self._ensure_loaded()
+        return self._by_name.get(name)
+
+    def get_by_id(self, contact_id):
+        self._ensure_loaded()
+        return self._by_id.get(contact_id)
+
+    def prefix(self, prefix, limit=10):
+        """姓名以 prefix 开头的联系人（按姓名排序，最多 limit 位）"""
+        self._ensure_loaded()
+        with self._lock:
+            names = self._names
+            i = bisect_left(names, prefix)
+            matches = []
+            while i < len(names) and names[i].startswith(prefix) and len(matches) < limit:
+                matches.append(self._by_name[names[i]])
+                i += 1
+            return matches
+
+    def pinyin(self, query, limit=10):
+        """按拼音全拼或首字母前缀查找（如 zhang、zls）；没有安装 pypinyin 时返回空列表"""
+        if lazy_pinyin is None:
+            return []
+        self._ensure_loaded()
+        query = query.lower().replace(' ', '')
+        if not query:
+            return []
+        with self._lock:
+            if self._pinyin is None:
+                self._pinyin = sorted((key, name) for name in self._names for key in set(name_to_pinyin(name)) if key)
+            i = bisect_left(self._pinyin, (query,))
+            matches = {}
+            while i < len(self._pinyin) and self._pinyin[i][0].startswith(query) and len(matches) < limit:
+                name = self._pinyin[i][1]
+                matches.setdefault(name, self._by_name[name])
+                i += 1
+            return list(matches.values())
+
+    def fuzzy(self, query, limit=5, cutoff=0.5, candidates=100):
+        """按相似度查找与 query 接近的联系人（姓名输错时给出建议），按相似度从高到低排列
+
+        difflib 逐个比较全部姓名太慢（10 万位联系人约 1 秒），先按共有字对数挑出最多 candidates 个候选；
+        几乎所有姓名都有的字对（如共同的姓氏）不参与计数，只在查询中没有其它字对时使用。
+        字对索引在第一次模糊查找时建立。
+        """
+        import difflib
+
+        self._ensure_loaded()
+        with self._lock:
+            if self._grams is None:
+                self._grams = {}
+                for name in self._names:
+                    self._add_grams(name)
+            postings = [self._grams[gram] for gram in name_grams(query) if gram in self._grams]
+            common = max(1000, len(self._names) // 10)
+            postings = [names for names in postings if len(names) <= common] or postings
+            shared = Counter()
+            for names in postings:
+                shared.update(names)
+            names = difflib.get_close_matches(query, [name for name, _ in shared.most_common(candidates)],
+                                              n=limit, cutoff=cutoff)
+            return [self._by_name[name] for name in names]
+
+    def suggest(self, query, limit=5):
+        """为找不到的姓名给出候选：前缀、拼音和模糊查找的结果依次合并去重"""
+        suggestions = {}
+        for records in (self.prefix(query, limit), self.pinyin(query, limit), self.fuzzy(query, limit)):
+            for record in records:
+                suggestions.setdefault(record.id, record)
+        return list(suggestions.values())[:limit]
+
+
+# 交互菜单和导入共用的联系人目录
+default_directory = ContactDirectory()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import ast
+import heapq
+import json
+import os
+import sys
+import time
+from array import array
+import database
+import profiling
+from keyword_matcher import KEYWORD_CATEGORIES, IMPORTANT_CATEGORY, get_default_matcher
+
+try:
+    import numpy as np
+except ImportError:  # 可选依赖：没有安装时矩阵保存在 array 中，排名逐行计算
+    np = None
+
+# 联系人 × 分类矩阵的默认保存位置（另有同名 .json 记录分类和对应的聊天记录版本）
+MATRIX_PATH = os.path.join(os.path.dirname(__file__), 'data', 'category_matrix.npy')
+
+# 近期权重的半衰期（秒）：一条消息的权重为 0.5 ** (距构建时间 / 半衰期)
+HALF_LIFE = 90 * 24 * 3600
+
+# 矩阵的分类列：关键词分类，以及重要事项标记
+CATEGORIES = tuple(KEYWORD_CATEGORIES) + (IMPORTANT_CATEGORY,)
+
+# 每行开头的固定列：联系人 id、消息条数、最后一条消息的时间；之后是各分类的命中次数和近期加权次数
+ID, MESSAGES, LAST_TIMESTAMP = 0, 1, 2
+FIXED_COLUMNS = 3
+
+# .npy 文件头（版本 1.0）：魔数、版本号、头部长度，头部补齐到 64 字节的整数倍
+NPY_MAGIC = b'\x93NUMPY'
+
+
+def write_npy(path, data, rows, columns):
+    """把行优先的 float64 数据（array('d')）写成 .npy 文件（版本 1.0），numpy 可以直接 np.load"""
+    header = f"{{'descr': '<f8', 'fortran_order': False, 'shape': ({rows}, {columns}), }}"
+    padding = 64 - (len(NPY_MAGIC) + 4 + len(header) + 1) % 64
+    header = (header + ' ' * (padding % 64) + '\n').encode('latin1')
+    if sys.byteorder != 'little':
+        data = array('d', data)
+        data.byteswap()
+    with open(path, 'wb') as f:
+        f.write(NPY_MAGIC + b'\x01\x00' + len(header).to_bytes(2, 'little') + header)
+        f.write(data.tobytes())
+
+
+def read_npy(path):
+    """不依赖 numpy 读取 float64 二维 .npy 文件：返回 (按 float64 解释的只读内存映射, 行数, 列数)
+
+    小端机器上直接映射文件，不复制数据；大端机器上读入 array 后转换字节序。
+    """
+    import mmap
+
+    with open(path, 'rb') as f:
+        prefix = f.read(8)
+        if prefix[:6] != NPY_MAGIC:
+            raise ValueError(f'不是 .npy 文件: {path}')
+        size_bytes = 2 if prefix[6] == 1 else 4
+        header_length = int.from_bytes(f.read(size_bytes), 'little')
+        header = ast.literal_eval(f.read(header_length).decode('latin1'))
+        if header['descr'] != '<f8' or header['fortran_order'] or len(header['shape']) != 2:
+            raise ValueError(f'不支持的矩阵格式: {header}')
+        rows, columns = header['shape']
+        offset = 8 + size_bytes + header_length
+        if sys.byteorder != 'little':
+            f.seek(offset)
+            data = array('d')
+            data.frombytes(f.read(rows * columns * 8))
+            data.byteswap()
+            return data, rows, columns
+        if rows * columns == 0:
+            return array('d'), rows, columns
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped)[offset:offset + rows * columns * 8].cast('d'), rows, columns
+
+
+def corpus_version(conn):
+    """聊天记录和联系人的版本 (最大聊天 id, 聊天条数, 联系人数)，用于判断保存的矩阵是否过期"""
+    max_id, count = conn.execute('SELECT COALESCE(MAX(id), 0), COUNT(*) FROM chats').fetchone()
+    return [max_id, count, conn.execute('SELECT COUNT(*) FROM contacts').fetchone()[0]]
+
+
+class CategoryMatrix:
+    """全部联系人 × 关键词分类的统计矩阵
+
+    单次流式读取整个 chats 表，每条消息用关键词匹配器扫描一次，累加到一个行优先的 float64 矩阵：
+    每行是一位联系人，依次为联系人 id、消息条数、最后一条消息时间、各分类命中次数、各分类近期加权次数。
+    安装了 numpy 时矩阵为 ndarray，排名和汇总是整列运算（argpartition）；否则保存在 array 中逐行计算。
+    保存为 .npy 文件，重新载入时内存映射，不需要重新扫描聊天记录。
+    近期权重以构建时间为基准按半衰期衰减；基准时间整体后移只会让全部权重乘以同一个系数，排名不变。
+    """
+
+    def __init__(self, data, contact_ids, categories=CATEGORIES, built_at=None, half_life=HALF_LIFE, version=None):
+        self.data = data
+        self.contact_ids = list(contact_ids)
+        self.categories = tuple(categories)
+        self.built_at = built_at if built_at is not None else int(time.time())
+        self.half_life = half_life
+        self.version = version
+        self.width = FIXED_COLUMNS + 2 * len(self.categories)
+        self._rows = {contact_id: row for row, contact_id in enumerate(self.contact_ids)}
+        self._columns = {category: column for column, category in enumerate(self.categories)}
+
+    def __len__(self):
+        return len(self.contact_ids)
+
+    @classmethod
+    @profiling.timed('analysis')
+    def build(cls, conn=None, matcher=None, now=None, half_life=HALF_LIFE, batch_size=5000):
+        """扫描整个 chats 表构建矩阵（没有聊天记录的联系人对应全零行）"""
+        conn = conn or database.get_connection()
+        matcher = matcher or get_default_matcher()
+        now = int(time.time()) if now is None else int(now)
+        version = corpus_version(conn)
+        contact_ids = [row[0] for row in conn.execute('SELECT id FROM contacts ORDER BY id')]
+
+        categories = CATEGORIES
+        width = FIXED_COLUMNS + 2 * len(categories)
+        offsets = {contact_id: row * width for row, contact_id in enumerate(contact_ids)}
+        count_columns = {category: FIXED_COLUMNS + column for column, category in enumerate(categories)}
+        weight_shift = len(categories)
+        data = array('d', bytes(8 * width * len(contact_ids)))
+        for contact_id, offset in offsets.items():
+            data[offset + ID] = contact_id
+
+        scan = matcher.scan
+        decay = 0.5 ** (1 / half_life)
+        cursor = conn.execute('SELECT contact_id, timestamp, content FROM chats')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for contact_id, timestamp, content in rows:
+                offset = offsets.get(contact_id)
+                if offset is None:
+                    continue
+                data[offset + MESSAGES] += 1
+                if timestamp > data[offset + LAST_TIMESTAMP]:
+                    data[offset + LAST_TIMESTAMP] = timestamp
+                counts = scan(content).counts
+                if not counts:
+                    continue
+                weight = decay ** max(0, now - timestamp)
+                for category, hits in counts.items():
+                    column = offset + count_columns[category]
+                    data[column] += hits
+                    data[column + weight_shift] += hits * weight
+
+        if np is not None:
+            data = np.frombuffer(data, dtype=np.float64).reshape(len(contact_ids), width)
+        return cls(data, contact_ids, categories, now, half_life, version)
+
+    @classmethod
+    def load(cls, path=MATRIX_PATH):
+        """载入保存的矩阵（内存映射，只读）"""
+        with open(os.path.splitext(path)[0] + '.json', encoding='utf-8') as f:
+            meta = json.load(f)
+        if np is not None:
+            data = np.load(path, mmap_mode='r')
+            contact_ids = [int(contact_id) for contact_id in data[:, ID]]
+        else:
+            data, rows, columns = read_npy(path)
+            contact_ids = [int(data[row * columns + ID]) for row in range(rows)]
+        return cls(data, contact_ids, meta['categories'], meta['built_at'], meta['half_life'], meta['version'])
+
+    @classmethod
+    def load_or_build(cls, path=MATRIX_PATH, conn=None):
+        """保存的矩阵与当前聊天记录一致时直接载入，否则重新构建并保存"""
+        conn = conn or database.get_connection()
+        try:
+            matrix = cls.load(path)
+        except (OSError, ValueError, KeyError):
+            matrix = None
+        if matrix is not None and matrix.is_current(conn):
+            return matrix
+        matrix = cls.build(conn)
+        matrix.save(path)
+        return matrix
+
+    def is_current(self, conn=None):
+        """矩阵是否与当前的分类、聊天记录和联系人一致（之后有新增或删除时需要重新构建）"""
+        conn = conn or database.get_connection()
+        return self.categories == CATEGORIES and self.version == corpus_version(conn)
+
+    def save(self, path=MATRIX_PATH):
+        """保存为 .npy 文件（numpy 可直接读取）和同名的 .json 元数据
+
+        先写临时文件再替换：已载入的旧矩阵仍映射着原来的文件，不会读到写了一半的内容。
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp_path = path + '.tmp'
+        if np is not None:
+            with open(temp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(self.data, dtype=np.float64))
+        else:
+            write_npy(temp_path, self.data, len(self.contact_ids), self.width)
+        os.replace(temp_path, path)
+        meta = {'categories': list(self.categories), 'built_at': self.built_at,
+                'half_life': self.half_life, 'version': self.version}
+        with open(os.path.splitext(path)[0] + '.json', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+    def _row(self, contact_id):
+        row = self._rows.get(contact_id)
+        if row is None:
+            return None
+        if np is not None:
+            return self.data[row]
+        return self.data[row * self.width:(row + 1) * self.width]
+
+    def summary(self, contact_id, limit=3):
+        """单个联系人的汇总：消息条数、最后消息时间、各分类命中次数和近期加权次数，以及加权次数最高的分类"""
+        values = self._row(contact_id)
+        if values is None:
+            return None
+        k = len(self.categories)
+        counts = {category: int(values[FIXED_COLUMNS + i]) for i, category in enumerate(self.categories)}
+        weights = {category: float(values[FIXED_COLUMNS + k + i]) for i, category in enumerate(self.categories)}
+        return {
+            'messages': int(values[MESSAGES]),
+            'last_timestamp': int(values[LAST_TIMESTAMP]) or None,
+            'category_counts': {category: count for category, count in counts.items() if count},
+            'category_weights': {category: weight for category, weight in weights.items() if weight},
+            'top_categories': [category for category in sorted(weights, key=weights.get, reverse=True)
+                               if weights[category]][:limit]
+        }
+
+    def _score_columns(self, category, weighted):
+        base = FIXED_COLUMNS + (len(self.categories) if weighted else 0)
+        if category is None:
+            return range(base, base + len(self.categories))
+        if category not in self._columns:
+            raise KeyError(category)
+        return range(base + self._columns[category], base + self._columns[category] + 1)
+
+    def scores(self, category=None, weighted=True):
+        """每位联系人的得分列表（与 contact_ids 顺序一致）：某个分类或全部分类的（近期加权）命中次数"""
+        columns = self._score_columns(category, weighted)
+        if np is not None:
+            return self.data[:, columns.start:columns.stop].sum(axis=1).tolist()
+        width = self.width
+        data = self.data
+        return [sum(data[row * width + columns.start:row * width + columns.stop])
+                for row in range(len(self.contact_ids))]
+
+    def top(self, n=10, category=None, weighted=True):
+        """得分最高的 n 位联系人 [(联系人 id, 得分)]，按得分从高到低；得分为 0 的联系人不参与排名"""
+        if n <= 0 or not self.contact_ids:
+            return []
+        columns = self._score_columns(category, weighted)
+        if np is not None:
+            scores = self.data[:, columns.start:columns.stop].sum(axis=1)
+            candidates = np.flatnonzero(scores > 0)
+            if len(candidates) > n:
+                candidates = candidates[np.argpartition(-scores[candidates], n - 1)[:n]]
+            # 按得分从高到低，同分时 id 小的在前
+            ordered = candidates[np.lexsort((candidates, -scores[candidates]))]
+            return [(self.contact_ids[row], float(scores[row])) for row in ordered]
+        ranked = heapq.nsmallest(n, ((-score, row) for row, score in enumerate(self.scores(category, weighted))
+                                     if score > 0))
+        return [(self.contact_ids[row], -score) for score, row in ranked]
+
+    def category_totals(self, weighted=False):
+        """全部联系人合计的各分类（近期加权）命中次数"""
+        columns = self._score_columns(None, weighted)
+        if np is not None:
+            totals = self.data[:, columns.start:columns.stop].sum(axis=0).tolist()
+        else:
+            width = self.width
+            totals = [sum(self.data[column::width]) for column in columns]
+        return dict(zip(self.categories, totals))
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import re
+from functools import lru_cache
+
 # 关系类型定义
 RELATION_TYPES = {
     'TEACHER': '师生',
@@ -12,29 +15,85 @@ RELATION_TYPES = {
     'OTHER': '其他'
 }
 
+# 关系判断规则：(关系, 备注中的关键词, 优先级)，备注命中多个关系时取优先级数值最小的
+RELATION_RULES = [
+    (RELATION_TYPES['TEACHER'], ['老师', '导师'], 10),
+    (RELATION_TYPES['COLLEAGUE'], ['同事', '工作'], 20),
+    (RELATION_TYPES['SUPERIOR'], ['领导', '上司', '下属'], 30),
+    (RELATION_TYPES['FRIEND'], ['朋友', '好友'], 40),
+    (RELATION_TYPES['FAMILY'], ['家人', '父母', '子女', '兄弟姐妹', '配偶'], 50),
+    (RELATION_TYPES['CLASSMATE'], ['同学', '校友'], 60)
+]
+
+
+class RelationClassifier:
+    """基于规则表的关系判断器
+
+    全部规则的关键词按优先级编译进一个正则（前瞻匹配，可找出重叠的命中），每条备注只扫描一遍；
+    相同备注的判断结果按备注文字缓存（微信备注大量重复）。规则可以在运行时追加。
+    """
+
+    def __init__(self, rules=None, cache_size=65536):
+        self.cache_size = cache_size
+        self._keywords = {}  # 关键词 -> (优先级, 关系)，同一关键词属于多个关系时保留优先级最高的
+        self._pattern = None
+        self._classify_notes = None
+        for relation, keywords, priority in (RELATION_RULES if rules is None else rules):
+            self.add_rule(relation, keywords, priority)
+
+    def add_rule(self, relation, keywords, priority):
+        """追加一条规则（关系、关键词列表、优先级）"""
+        for keyword in keywords:
+            if not keyword:
+                raise ValueError('关键词不能为空')
+            current = self._keywords.get(keyword)
+            if current is None or priority < current[0]:
+                self._keywords[keyword] = (priority, relation)
+        self._pattern = None
+        self._classify_notes = None
+
+    def _compile(self):
+        # 同一位置可匹配多个关键词时正则取第一个分支，因此分支按优先级排列
+        keywords = sorted(self._keywords, key=lambda keyword: self._keywords[keyword])
+        if keywords:
+            self._pattern = re.compile('(?=(' + '|'.join(re.escape(keyword) for keyword in keywords) + '))')
+        else:
+            self._pattern = re.compile('(?!)')
+        return self._pattern
+
+    def _match(self, notes):
+        hits = (self._pattern or self._compile()).findall(notes.lower())
+        if not hits:
+            return RELATION_TYPES['OTHER']
+        return min(self._keywords[keyword] for keyword in hits)[1]
+
+    def classify(self, contact):
+        """判断单个联系人的关系（已设置 relation 的联系人保持不变）"""
+        relation = contact.get('relation', '')
+        if relation:
+            return relation
+        if self._classify_notes is None:
+            # 规则变化后重新建立备注缓存
+            self._classify_notes = lru_cache(maxsize=self.cache_size)(self._match)
+        return self._classify_notes(contact.get('notes') or '')
+
+    def classify_many(self, contacts):
+        """一次判断一批联系人的关系，返回与输入顺序对应的关系列表"""
+        classify = self.classify
+        return [classify(contact) for contact in contacts]
+
+
+default_classifier = RelationClassifier()
+
+
 def determine_relation(contact):
     """根据联系人信息判断关系"""
-    name = contact.get('name', '')
-    notes = contact.get('notes', '').lower()
-    relation = contact.get('relation', '')
-
-    if relation:
-        return relation
-
-    if '老师' in notes or '导师' in notes:
-        return RELATION_TYPES['TEACHER']
-    if '同事' in notes or '工作' in notes:
-        return RELATION_TYPES['COLLEAGUE']
-    if '领导' in notes or '上司' in notes or '下属' in notes:
-        return RELATION_TYPES['SUPERIOR']
-    if '朋友' in notes or '好友' in notes:
-        return RELATION_TYPES['FRIEND']
-    if '家人' in notes or '父母' in notes or '子女' in notes or '兄弟姐妹' in notes or '配偶' in notes:
-        return RELATION_TYPES['FAMILY']
-    if '同学' in notes or '校友' in notes:
-        return RELATION_TYPES['CLASSMATE']
-
-    return RELATION_TYPES['OTHER']
+    return default_classifier.classify(contact)
+
+
+def classify_many(contacts):
+    """批量判断联系人关系（导入时使用），返回关系列表"""
+    return default_classifier.classify_many(contacts)
 
 def get_title_by_relation(relation, name):
     """根据关系获取称谓"""
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import time
+import zlib
+from operator import itemgetter, methodcaller
+import profiling
+from contact_relation import RELATION_TYPES, classify_many
+from database import get_connection, transaction
+from wechatDBFinder import (CONTACT_COLUMNS, USERNAME_CHUNK_SIZE, WeChatDBFinder, contact_from_row, merge_contacts,
+                            open_readonly, quote_identifier)
+
+# 联系人表内容摘要中字段和行的分隔符（与 WeChatDBFinder.contact_rows_text / iter_contact_fields 在 SQL 中的拼接方式一致）
+FIELD_SEPARATOR = '\x1f'
+ROW_SEPARATOR = '\x1e'
+
+
+def file_fingerprint(db_path):
+    """源数据库的文件指纹 (大小, mtime, WAL 大小, WAL mtime)；WAL 文件不存在时对应项为 0"""
+    stat = os.stat(db_path)
+    try:
+        wal = os.stat(db_path + '-wal')
+        wal_size, wal_mtime = wal.st_size, wal.st_mtime_ns
+    except OSError:
+        wal_size, wal_mtime = 0, 0
+    return stat.st_size, stat.st_mtime_ns, wal_size, wal_mtime
+
+
+def text_digest(text):
+    """联系人表拼接内容的 64 位摘要（blake2b，跨进程稳定）"""
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+def select_in(conn, sql, values, params=()):
+    """按 USERNAME_CHUNK_SIZE 分段执行 sql（其中的 {} 替换为 IN 的占位符），返回第一列的集合"""
+    values = list(values)
+    found = set()
+    for i in range(0, len(values), USERNAME_CHUNK_SIZE):
+        chunk = values[i:i + USERNAME_CHUNK_SIZE]
+        found.update(row[0] for row in conn.execute(sql.format(','.join('?' * len(chunk))), [*params, *chunk]))
+    return found
+
+
+def contact_notes(contact):
+    """写入本地 contacts.notes 的内容：与昵称不同的备注，否则为昵称"""
+    if contact['remark'] and contact['remark'] != contact['nickname']:
+        return contact['remark']
+    return contact['nickname']
+
+
+class ContactSync:
+    """微信联系人增量同步
+
+    每个源数据库记录文件指纹（大小、mtime，以及 WAL 文件的大小和 mtime）、联系人表的 rowid 水位、行数和内容摘要，
+    以及每位联系人（按微信 id）的内容哈希：
+    - 文件指纹与上次相同时不打开源数据库，也不写本地数据库
+    - 文件有变化（通常只是消息表变化）时先比较联系人表的内容摘要（在 SQLite 中拼接，Python 只哈希一次）：
+      行数和水位未变且摘要相同时不逐行比较；水位之前的行摘要不变时只读取水位之后追加的行
+    - 否则读取联系人表逐行计算哈希，只有新增和哈希变化的联系人写入 contacts 表
+      （微信修改备注时 rowid 不变，只看 rowid 水位发现不了修改，所以用摘要和哈希比较）
+    多个源数据库中的同一联系人按数据库顺序合并（先出现的为准），变化的联系人也与未变化的数据库中的记录一起合并。
+    写入按微信 id upsert：新联系人先按姓名关联本地没有微信 id 的同名联系人，否则新增；
+    已关联的联系人姓名跟随微信显示名称，备注只在本地为空时补全，关系只在本地为“其他”时按新内容重新判断。
+    同步状态与联系人在同一事务中提交。
+    """
+
+    def __init__(self, finder=None, max_workers=None):
+        self.finder = finder or WeChatDBFinder()
+        self.max_workers = max_workers
+
+    def load_states(self, conn):
+        """读取全部源数据库的同步状态 {源路径: 状态行}"""
+        return {row['source']: row for row in conn.execute('SELECT * FROM contact_sync_state')}
+
+    def load_hashes(self, conn, source):
+        """读取某个源数据库上次同步时各联系人的内容哈希 {微信 id: 哈希}
+
+        哈希为 'nickname\\x1falias\\x1fremark' 的 crc32（跨进程稳定），微信 id 是键，不参与哈希。
+        """
+        # 不经过 sqlite3.Row，整表载入快约三分之一
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        return dict(cursor.execute('SELECT username, row_hash FROM contact_sync_rows WHERE source = ?', (source,)))
+
+    def known_usernames(self, conn, source, usernames):
+        """usernames 中上次同步时在某个源数据库里出现过的微信 id"""
+        return select_in(conn, 'SELECT username FROM contact_sync_rows WHERE source = ? AND username IN ({})',
+                         usernames, (source,))
+
+    @profiling.timed('import.contacts')
+    def sync(self, db_paths=None):
+        """同步全部（默认为 contact_db_candidates 中的）微信数据库，返回统计
+
+        {'inserted': 新增, 'linked': 按姓名关联, 'updated': 更新, 'unchanged': 内容未变的联系人,
+         'sources': [{'path', 'status', 'mode', 'rows', 'changed', 'deleted', 'seconds', 'error'}]}，
+        status 为 unchanged（文件未变，未读取）、synced、unverified（不是微信数据库）或 error；
+        mode 为 synced 时联系人表的比较方式：digest（摘要相同，未逐行比较）、append（只读取追加的行）或 full。
+        """
+        if db_paths is None:
+            db_paths = self.finder.contact_db_candidates()
+        counts = {'inserted': 0, 'linked': 0, 'updated': 0, 'unchanged': 0, 'sources': []}
+        conn = get_connection()
+        states = self.load_states(conn)
+
+        jobs = []
+        # 可参与合并的源数据库（按顺序）：[源路径, 本次的比较结果（文件未变时为 None）]
+        present = []
+        for db_path in db_paths:
+            source = os.path.abspath(db_path)
+            result = {'path': db_path, 'status': 'unchanged', 'mode': None, 'rows': 0, 'changed': 0, 'deleted': 0,
+                      'seconds': 0.0, 'error': None}
+            counts['sources'].append(result)
+            try:
+                fingerprint = file_fingerprint(db_path)
+            except OSError as e:
+                result.update(status='error', error=f'{type(e).__name__}: {e}')
+                continue
+            state = states.get(source)
+            entry = [source, None]
+            present.append(entry)
+            if state is not None and fingerprint == (state['size'], state['mtime_ns'],
+                                                     state['wal_size'], state['wal_mtime_ns']):
+                continue
+            jobs.append((result, source, fingerprint, state, entry))
+
+        if not jobs:
+            return counts
+
+        # 先比较摘要（在工作线程中执行），只有需要逐行比较的数据库才载入上次的逐行哈希
+        probes = self._map(lambda job: self._probe_source(job[0], job[1], job[3]), jobs)
+        hashes = [self.load_hashes(conn, job[1]) if probe is not None and probe['mode'] == 'full' else None
+                  for job, probe in zip(jobs, probes)]
+        diffs = self._map(lambda args: self._diff_source(*args),
+                          [(job[0], job[1], probe, source_hashes)
+                           for job, probe, source_hashes in zip(jobs, probes, hashes)])
+
+        for (result, source, _, _, entry), diff in zip(jobs, diffs):
+            if diff is None:
+                present.remove(entry)
+                continue
+            if diff['mode'] == 'append' and diff['changed']:
+                # 追加的行中已同步过的微信 id（表中的重复行）与整表比较时一样以先出现的行为准
+                known = self.known_usernames(conn, source, (contact['username'] for contact in diff['changed']))
+                if known:
+                    for username in known:
+                        diff['hashes'].pop(username, None)
+                    diff['changed'] = [contact for contact in diff['changed'] if contact['username'] not in known]
+                    result['changed'] = len(diff['changed'])
+            entry[1] = diff
+
+        changed = self._merge_changed(conn, present)
+        counts['unchanged'] = sum(diff['unchanged'] for diff in diffs if diff is not None)
+        relations = classify_many([{'name': contact['display_name'], 'notes': contact_notes(contact)}
+                                   for contact in changed])
+
+        with transaction() as conn:
+            if changed:
+                self._upsert(conn, changed, relations, counts)
+            for (result, source, fingerprint, _, _), diff in zip(jobs, diffs):
+                if diff is not None:
+                    self._save_state(conn, source, fingerprint, diff)
+
+        if changed:
+            from contact_directory import default_directory
+
+            default_directory.invalidate()
+        return counts
+
+    def _map(self, func, items):
+        """依次对 items 执行 func；有多个数据库且允许多个工作线程时并发执行（结果按输入顺序）"""
+        workers = min(self.max_workers or self.finder.max_workers or 1, len(items))
+        if workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='contact-sync') as executor:
+                return list(executor.map(func, items))
+        return [func(item) for item in items]
+
+    def _probe_source(self, result, source, state):
+        """读取联系人表的水位和行数，与上次的摘要比较，决定比较方式（在工作线程中执行，不访问本地数据库）
+
+        返回 {'mode', 'max_rowid', 'row_count', 'digest', 'after_rowid'}：mode 为 digest 时 digest 已算出，
+        为 append 时 after_rowid 为上次的水位，为 full 时已读取的整表内容放在 'text'（没有读取时 digest 在逐行读取时计算）；
+        不是微信数据库或读取出错时返回 None。
+        """
+        start = time.perf_counter()
+        try:
+            conn = open_readonly(source)
+            try:
+                contact_table = self.finder.find_contact_table(conn)
+                if contact_table is None:
+                    if not self.finder.has_wechat_tables(source):
+                        result['status'] = 'unverified'
+                        return None
+                    return {'mode': 'full', 'max_rowid': 0, 'row_count': 0, 'digest': None, 'after_rowid': None}
+
+                max_rowid, row_count = conn.execute(
+                    f'SELECT COALESCE(MAX(rowid), 0), COUNT(*) FROM {quote_identifier(contact_table)}').fetchone()
+                probe = {'mode': 'full', 'max_rowid': max_rowid, 'row_count': row_count, 'digest': None,
+                         'after_rowid': None}
+                if state is None or state['rows_digest'] is None:
+                    return probe
+                old_max_rowid, old_count, old_digest = state['max_rowid'], state['row_count'], state['rows_digest']
+                if (max_rowid, row_count) == (old_max_rowid, old_count):
+                    # 通常只是消息表有变化：联系人表内容与上次相同时不逐行比较
+                    text = self.finder.contact_rows_text(conn, contact_table)
+                    digest = text_digest(text)
+                    if digest == old_digest:
+                        probe.update(mode='digest', digest=old_digest)
+                    else:
+                        # 内容有修改：逐行比较时直接拆分这次读取的内容，不再读取一遍
+                        probe.update(text=text, digest=digest)
+                elif max_rowid > old_max_rowid and row_count > old_count:
+                    # 水位之前的行没有变化时只需比较之后追加的行；两段拼接起来就是整表内容
+                    prefix = self.finder.contact_rows_text(conn, contact_table, until_rowid=old_max_rowid)
+                    if text_digest(prefix) == old_digest:
+                        suffix = self.finder.contact_rows_text(conn, contact_table, after_rowid=old_max_rowid)
+                        probe.update(mode='append', after_rowid=old_max_rowid,
+                                     digest=text_digest(ROW_SEPARATOR.join(part for part in (prefix, suffix) if part)))
+                return probe
+            finally:
+                conn.close()
+        except Exception as e:
+            result.update(status='error', error=f'{type(e).__name__}: {e}')
+            return None
+        finally:
+            result['seconds'] = time.perf_counter() - start
+
+    def _diff_source(self, result, source, probe, hashes):
+        """按 _probe_source 决定的方式读取联系人表并与上次的哈希比较（在工作线程中执行，不访问本地数据库）
+
+        返回 {'mode', 'changed': 新增或修改的联系人, 'hashes': 变化的哈希, 'deleted': 已删除的微信 id,
+        'unchanged': 未变数, 'max_rowid', 'row_count', 'digest'}；probe 为 None 或读取出错时返回 None。
+        """
+        if probe is None:
+            return None
+        start = time.perf_counter()
+        diff = {'mode': probe['mode'], 'changed': [], 'hashes': {}, 'deleted': [], 'unchanged': 0,
+                'max_rowid': probe['max_rowid'], 'row_count': probe['row_count'], 'digest': probe['digest']}
+        try:
+            if probe['mode'] == 'digest':
+                diff['unchanged'] = probe['row_count']
+            else:
+                # append 时上次同步过的行都没有变化，只需比较追加的行（它们的微信 id 是否已同步过在本地数据库中确认）
+                full = probe['mode'] == 'full'
+                hashes = hashes if full else {}
+                rows = [row for batch in self._field_batches(source, probe) for row in batch]
+                usernames = list(map(itemgetter(0), rows))
+                values = map(zlib.crc32, map(str.encode, map(itemgetter(1), rows)))
+                # 哈希和比较都在 C 层按整表计算：倒序建字典使重复的微信 id 以先出现的行为准，与上次的哈希求差集
+                current = dict(zip(reversed(usernames), reversed(list(values))))
+                current.pop('', None)
+                diff['hashes'] = dict(current.items() - hashes.items())
+                diff['unchanged'] = len(current) - len(diff['hashes'])
+                # 只有变化的行才转换为联系人（按 rowid 顺序）
+                changed = {}
+                for username, fields in rows:
+                    if username in diff['hashes']:
+                        changed.setdefault(username, fields)
+                diff['changed'] = self._contacts_of(source, changed.items())
+                if full:
+                    diff['deleted'] = list(hashes.keys() - current.keys())
+                    if diff['digest'] is None:
+                        diff['digest'] = text_digest(ROW_SEPARATOR.join(map(FIELD_SEPARATOR.join, rows)))
+                else:
+                    diff['unchanged'] = probe['row_count'] - len(rows)
+            result.update(status='synced', mode=diff['mode'], rows=probe['row_count'], changed=len(diff['changed']),
+                          deleted=len(diff['deleted']))
+            return diff
+        except Exception as e:
+            result.update(status='error', error=f'{type(e).__name__}: {e}')
+            return None
+        finally:
+            result['seconds'] += time.perf_counter() - start
+
+    def _field_batches(self, source, probe):
+        """按 rowid 顺序逐批产出 (微信 id, 拼接的字段)：优先拆分 _probe_source 已读取的整表内容，行数对不上（字段含分隔符）时从源数据库读取"""
+        text = probe.get('text')
+        if text is not None:
+            rows = text.split(ROW_SEPARATOR) if text else []
+            if len(rows) == probe['row_count']:
+                yield [(username, fields) for username, _, fields in map(methodcaller('partition', FIELD_SEPARATOR), rows)]
+                return
+        yield from self.finder.iter_contact_fields(source, after_rowid=probe['after_rowid'])
+
+    def _contacts_of(self, source, changed):
+        """把 (微信 id, 拼接的字段) 转换为联系人字典；字段本身含分隔符的（极少见）按微信 id 从源数据库重新读取"""
+        contacts = []
+        ambiguous = []
+        for username, fields in changed:
+            row = (username, *fields.split(FIELD_SEPARATOR))
+            if len(row) == len(CONTACT_COLUMNS):
+                contacts.append(contact_from_row(row))
+            else:
+                ambiguous.append(username)
+        if ambiguous:
+            rows = {}
+            for row in self.finder.iter_contact_rows(source, usernames=ambiguous):
+                rows.setdefault(row[0], row)
+            contacts.extend(contact_from_row(rows[username]) for username in ambiguous if username in rows)
+        return contacts
+
+    def _merge_changed(self, conn, present):
+        """合并各源数据库中变化的联系人（按数据库顺序，先出现的为准）
+
+        只有一个源数据库时直接返回它的变化；有多个时，变化的微信 id 在其它数据库（包括文件未变、本次没有读取的）
+        中的记录也按微信 id 取出一起合并，保证结果与每次整体读取全部数据库时相同。
+        """
+        diffs = [diff for _, diff in present if diff is not None]
+        if len(present) < 2:
+            return merge_contacts(diff['changed'] for diff in diffs)
+        usernames = {contact['username'] for diff in diffs for contact in diff['changed']}
+        if not usernames:
+            return []
+
+        contact_lists = []
+        for source, diff in present:
+            own = {contact['username']: contact for contact in diff['changed']} if diff is not None else {}
+            deleted = set(diff['deleted']) if diff is not None else set()
+            others = [username for username in self.known_usernames(conn, source, usernames)
+                      if username not in own and username not in deleted]
+            contacts = list(own.values())
+            if others:
+                contacts.extend(contact_from_row(row) for row in self.finder.iter_contact_rows(source, usernames=others))
+            contact_lists.append(contacts)
+        return merge_contacts(contact_lists)
+
+    def _upsert(self, conn, contacts, relations, counts):
+        # 只查询本次变化的微信 id（按 wechat_id 索引），不扫描整个 contacts 表
+        known = select_in(conn, 'SELECT wechat_id FROM contacts WHERE wechat_id IN ({})',
+                          (contact['username'] for contact in contacts))
+        unlinked = {row[0] for row in conn.execute('SELECT name FROM contacts WHERE wechat_id IS NULL')}
+
+        # 第一次见到的微信 id：先关联本地没有微信 id 的同名联系人（id 最小的一位）
+        new = [contact for contact in contacts if contact['username'] not in known]
+        before = conn.total_changes
+        conn.executemany('''
+            UPDATE OR IGNORE contacts SET wechat_id = ?
+            WHERE id = (SELECT MIN(id) FROM contacts WHERE name = ? AND wechat_id IS NULL)
+        ''', [(contact['username'], contact['display_name']) for contact in new if contact['display_name'] in unlinked])
+        counts['linked'] += conn.total_changes - before
+        counts['inserted'] += len(new) - (conn.total_changes - before)
+        counts['updated'] += len(contacts) - len(new)
+
+        conn.executemany('''
+            INSERT INTO contacts (name, phone, relation, notes, wechat_id) VALUES (?, '', ?, ?, ?)
+            ON CONFLICT(wechat_id) WHERE wechat_id IS NOT NULL DO UPDATE SET
+                name = excluded.name,
+                notes = CASE WHEN contacts.notes IS NULL OR contacts.notes = '' THEN excluded.notes ELSE contacts.notes END,
+                relation = CASE WHEN contacts.relation IS NULL OR contacts.relation = ?
+                                THEN excluded.relation ELSE contacts.relation END,
+                updated_at = CURRENT_TIMESTAMP
+        ''', [(contact['display_name'], relation, contact_notes(contact), contact['username'], RELATION_TYPES['OTHER'])
+              for contact, relation in zip(contacts, relations)])
+
+    def _save_state(self, conn, source, fingerprint, diff):
+        conn.executemany('INSERT OR REPLACE INTO contact_sync_rows (source, username, row_hash) VALUES (?, ?, ?)',
+                         [(source, username, value) for username, value in diff['hashes'].items()])
+        conn.executemany('DELETE FROM contact_sync_rows WHERE source = ? AND username = ?',
+                         [(source, username) for username in diff['deleted']])
+        conn.execute('''
+            INSERT OR REPLACE INTO contact_sync_state
+                (source, size, mtime_ns, wal_size, wal_mtime_ns, max_rowid, row_count, rows_digest, synced_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (source, *fingerprint, diff['max_rowid'], diff['row_count'], diff['digest']))
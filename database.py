@@ -3,14 +3,329 @@
 
 import sqlite3
 import os
+import re
 import datetime
+import threading
+import atexit
+from contextlib import contextmanager
 
 # 数据库文件路径
 DB_PATH = os.path.join(os.path.dirname(__file__), 'data', 'wechat.db')
 
-def init_database():
-    """初始化数据库"""
-    conn = sqlite3.connect(DB_PATH)
+# 长连接默认使用的 PRAGMA 设置
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',        # 读写并发，提交时不必重写整个数据库文件
+    'synchronous': 'NORMAL',      # WAL 模式下安全且避免每次提交都 fsync
+    'cache_size': -20000,         # 页缓存约 20MB（负数表示 KiB）
+    'mmap_size': 268435456,       # 256MB 内存映射读
+    'temp_store': 'MEMORY'
+}
+
+# 汉字（含扩展区）：全文索引按单字切分
+CJK_CHAR = re.compile('[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\U00020000-\U0002ffff]')
+
+
+class _SegmentTable(dict):
+    """str.translate 使用的映射：汉字 -> 两侧加空格的汉字，其它字符保持不变（首次遇到时计算并缓存）"""
+
+    def __missing__(self, code):
+        char = chr(code)
+        value = f' {char} ' if CJK_CHAR.match(char) else char
+        self[code] = value
+        return value
+
+
+_segment_table = _SegmentTable()
+
+
+def fts_segment(text):
+    """全文索引分词预处理：在每个汉字两侧加空格，使 unicode61 分词器按单字建立索引
+
+    中文没有空格分隔，不处理时一整段汉字会成为一个词，无法检索其中的词语；
+    按单字索引后，词语查询转换为相邻单字的短语查询。建立索引和查询都使用这个函数。
+    """
+    if text is None:
+        return None
+    return text.translate(_segment_table)
+
+
+def register_functions(conn):
+    """在连接上注册建立全文索引时使用的 SQL 函数（只在本程序的语句中使用，表结构和触发器不依赖它）"""
+    conn.create_function('fts_segment', 1, fts_segment, deterministic=True)
+
+
+class ConnectionManager:
+    """SQLite 连接管理器
+
+    每个线程复用一条长连接（按数据库路径区分），连接建立时统一设置 PRAGMA。
+    sqlite3 会按 SQL 文本在连接内缓存已编译的语句，复用连接即可复用预编译语句。
+    """
+
+    def __init__(self, db_path=None, pragmas=None, cached_statements=256):
+        # db_path 为 None 时每次取模块级 DB_PATH，便于测试和基准切换数据库
+        self.db_path = db_path
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _current_path(self):
+        return self.db_path or DB_PATH
+
+    def _connect(self, path):
+        conn = sqlite3.connect(path, cached_statements=self.cached_statements, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        register_functions(conn)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def get_connection(self):
+        """获取当前线程的长连接（不要自行 close）"""
+        path = self._current_path()
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get(path)
+        if conn is None:
+            conn = self._connect(path)
+            connections[path] = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """事务上下文：正常退出时提交，异常时回滚；嵌套使用时只由最外层提交"""
+        conn = self.get_connection()
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        try:
+            yield conn
+            if depth == 0:
+                conn.commit()
+        except BaseException:
+            if depth == 0:
+                conn.rollback()
+            raise
+        finally:
+            self._local.depth = depth
+
+    def release(self):
+        """关闭当前线程打开的全部连接（后台线程退出前调用，避免连接随线程结束而泄漏）"""
+        connections = getattr(self._local, 'connections', None)
+        if not connections:
+            return
+        self._local.connections = {}
+        with self._lock:
+            self._connections = [conn for conn in self._connections if conn not in connections.values()]
+        for conn in connections.values():
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def close(self):
+        """关闭所有线程打开的连接"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+
+# 全局连接管理器
+connection_manager = ConnectionManager()
+atexit.register(connection_manager.close)
+
+
+def get_connection():
+    """获取当前线程复用的数据库长连接"""
+    return connection_manager.get_connection()
+
+
+def transaction():
+    """在复用连接上开启事务"""
+    return connection_manager.transaction()
+
+
+def release_connection():
+    """关闭当前线程的数据库连接（在线程退出前调用）"""
+    connection_manager.release()
+
+
+def fts_available(conn):
+    """数据库中是否已建立聊天记录全文索引（SQLite 未编译 FTS5 时迁移会跳过建立）"""
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chats_fts'").fetchone() is not None
+
+
+def create_chats_fts(conn):
+    """建立聊天记录全文索引：无内容（contentless）FTS5 表，只存索引，原文仍在 chats 表中；
+    索引由写入聊天记录的程序维护（见 index_pending_chats），并为已有聊天记录建立索引"""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE chats_fts USING fts5(content, content='', tokenize='unicode61')")
+    except sqlite3.OperationalError as e:
+        if 'fts5' not in str(e):
+            raise
+        print(f"当前 SQLite 不支持 FTS5，聊天记录搜索将使用 LIKE 查询: {e}")
+        return
+    conn.execute('INSERT INTO chats_fts (rowid, content) SELECT id, fts_segment(content) FROM chats WHERE content IS NOT NULL')
+
+
+def convert_chat_timestamps(conn):
+    """把 chats.timestamp 从 UTC 时间文本改为整数时间戳（Unix 秒）
+
+    SQLite 不能修改列类型，需要重建表：复制数据时转换时间，保留原有 id 和自增序号
+    （增量分析和全文索引都依赖聊天记录 id），再重建索引。
+    """
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'chats'").fetchone()
+    conn.execute('''
+        CREATE TABLE chats_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            contact_id INTEGER,
+            content TEXT,
+            timestamp INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            FOREIGN KEY (contact_id) REFERENCES contacts(id)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO chats_new (id, contact_id, content, timestamp)
+        SELECT id, contact_id, content,
+               CASE WHEN typeof(timestamp) IN ('integer', 'real') THEN CAST(timestamp AS INTEGER)
+                    ELSE COALESCE(CAST(strftime('%s', timestamp) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER))
+               END
+        FROM chats
+    ''')
+    conn.execute('DROP TABLE chats')
+    conn.execute('ALTER TABLE chats_new RENAME TO chats')
+    if sequence is not None:
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'chats'", (sequence[0],))
+    conn.execute('CREATE INDEX idx_chats_contact_timestamp ON chats (contact_id, timestamp)')
+
+
+def index_pending_chats(conn):
+    """为还没有全文索引的聊天记录（id 大于索引中最大 rowid 的）建立索引（一条 INSERT ... SELECT）
+
+    chats 的 id 自增且不重复使用，索引中最大的 rowid 之后的记录就是还没有索引的，包括其它程序直接写入的记录。
+    写入聊天记录的程序在同一事务中调用，其它程序写入的记录也在下次写入时一并建立索引。
+    修改或删除已有的聊天记录时用 reindex_chats。
+    """
+    if not fts_available(conn):
+        return
+    last_id = conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM chats_fts').fetchone()[0]
+    # 先确认有未索引的记录，没有时不开启写事务
+    if conn.execute('SELECT 1 FROM chats WHERE id > ? AND content IS NOT NULL LIMIT 1', (last_id,)).fetchone():
+        conn.execute('INSERT INTO chats_fts (rowid, content) SELECT id, fts_segment(content) FROM chats '
+                     'WHERE id > ? AND content IS NOT NULL', (last_id,))
+
+
+def reindex_chats(conn, rows):
+    """修改或删除聊天记录后更新全文索引（与修改在同一事务中调用）
+
+    rows 为 (id, 修改前的内容)：无内容表只能按建立索引时的内容删除旧索引，再按 chats 中现在的内容重新建立，
+    已删除的记录只删除索引。id 大于索引中最大 rowid 的记录还没有索引，留给 index_pending_chats。
+    """
+    if not fts_available(conn):
+        return
+    last_id = conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM chats_fts').fetchone()[0]
+    rows = [(chat_id, content) for chat_id, content in rows if chat_id <= last_id]
+    conn.executemany("INSERT INTO chats_fts (chats_fts, rowid, content) VALUES ('delete', ?, fts_segment(?))",
+                     [(chat_id, content) for chat_id, content in rows if content is not None])
+    conn.executemany('INSERT INTO chats_fts (rowid, content) SELECT id, fts_segment(content) FROM chats '
+                     'WHERE id = ? AND content IS NOT NULL', [(chat_id,) for chat_id, _ in rows])
+
+
+# 数据库迁移：按顺序排列的 (版本号, 说明, 步骤列表)，已应用的版本记录在 PRAGMA user_version 中。
+# 步骤可以是 SQL 语句，也可以是接收连接参数的函数。
+MIGRATIONS = [
+    (1, '添加聊天、联系人、拜年微信表的查询索引', [
+        # 按联系人取聊天记录并按时间排序；索引自带 rowid，计数和取最大 id 时无需回表
+        'CREATE INDEX IF NOT EXISTS idx_chats_contact_timestamp ON chats (contact_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_contacts_name ON contacts (name)',
+        'CREATE INDEX IF NOT EXISTS idx_greetings_contact_id ON greetings (contact_id)'
+    ]),
+    (2, '添加增量聊天分析状态表', [
+        # important_matters 为评分最高的前几条重要事项 [排序分, 消息时间, 聊天 id, 片段] 的 JSON 列表
+        '''
+        CREATE TABLE IF NOT EXISTS analysis_state (
+            contact_id INTEGER PRIMARY KEY,
+            last_chat_id INTEGER NOT NULL DEFAULT 0,
+            keywords TEXT NOT NULL DEFAULT '[]',
+            category_counts TEXT NOT NULL DEFAULT '{}',
+            important_matters TEXT NOT NULL DEFAULT '[]',
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (contact_id) REFERENCES contacts(id)
+        )
+        '''
+    ]),
+    (3, '添加联系人微信 id 和聊天记录导入进度表', [
+        'ALTER TABLE contacts ADD COLUMN wechat_id TEXT',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_contacts_wechat_id ON contacts (wechat_id) WHERE wechat_id IS NOT NULL',
+        '''
+        CREATE TABLE IF NOT EXISTS import_state (
+            source TEXT NOT NULL,
+            table_name TEXT NOT NULL,
+            last_local_id INTEGER NOT NULL DEFAULT 0,
+            last_create_time INTEGER NOT NULL DEFAULT 0,
+            imported_count INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (source, table_name)
+        )
+        '''
+    ]),
+    (4, '添加聊天记录全文索引', [create_chats_fts]),
+    (5, '聊天记录时间改为整数时间戳', [convert_chat_timestamps]),
+    (6, '添加微信联系人增量同步状态表', [
+        # 每个源数据库的文件指纹、联系人表的 rowid 水位和按 rowid 顺序的内容摘要
+        # （文件有变化但联系人表未变或只追加了行时不必逐行比较）
+        '''
+        CREATE TABLE IF NOT EXISTS contact_sync_state (
+            source TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            wal_size INTEGER NOT NULL DEFAULT 0,
+            wal_mtime_ns INTEGER NOT NULL DEFAULT 0,
+            max_rowid INTEGER NOT NULL DEFAULT 0,
+            row_count INTEGER NOT NULL DEFAULT 0,
+            rows_digest INTEGER,
+            synced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # 每个源数据库中每位联系人上次同步时的内容哈希
+        '''
+        CREATE TABLE IF NOT EXISTS contact_sync_rows (
+            source TEXT NOT NULL,
+            username TEXT NOT NULL,
+            row_hash INTEGER NOT NULL,
+            PRIMARY KEY (source, username)
+        ) WITHOUT ROWID
+        '''
+    ]),
+    (7, '添加聊天记录导入时未映射会话的记录表', [
+        # 每个源数据库、每张消息表中因没有对应联系人而跳过的会话，及其被跳过的最后一条消息 id
+        '''
+        CREATE TABLE IF NOT EXISTS import_unmapped (
+            source TEXT NOT NULL,
+            table_name TEXT NOT NULL,
+            talker TEXT NOT NULL,
+            last_local_id INTEGER NOT NULL,
+            PRIMARY KEY (source, table_name, talker)
+        ) WITHOUT ROWID
+        '''
+    ])
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def create_tables(conn):
+    """创建基础表结构（版本 0）"""
     cursor = conn.cursor()
 
     # 创建联系人表
@@ -49,12 +364,69 @@ def init_database():
         )
     ''')
 
-    conn.commit()
-    conn.close()
+
+def get_schema_version(conn):
+    """读取数据库当前的迁移版本"""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, target=None):
+    """把数据库升级到 target 版本（默认最新），每个版本在独立事务中执行，返回已应用的版本列表"""
+    target = SCHEMA_VERSION if target is None else target
+    applied = []
+    for version, description, steps in MIGRATIONS:
+        if version > target or version <= get_schema_version(conn):
+            continue
+        try:
+            # DDL 不会隐式开启事务，显式 BEGIN 保证一个版本的所有步骤要么全部生效要么全部回滚
+            if not conn.in_transaction:
+                conn.execute('BEGIN')
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"数据库已升级到版本 {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+def init_database():
+    """初始化数据库（创建表并升级到最新版本）"""
+    with transaction() as conn:
+        create_tables(conn)
+    migrate(get_connection())
+
     print("数据库初始化成功")
 
+@contextmanager
+def temp_database(init=True):
+    """把本地数据库临时切换到临时目录中的新文件（测试和基准使用），返回新数据库文件路径
+
+    init 为 True 时先建表并迁移到最新版本；临时目录中可以放其它测试文件。退出时关闭全部连接并恢复原路径。
+    """
+    import tempfile
+
+    global DB_PATH
+    original = DB_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        DB_PATH = os.path.join(tmp, 'wechat.db')
+        try:
+            if init:
+                init_database()
+            yield DB_PATH
+        finally:
+            connection_manager.close()
+            DB_PATH = original
+
 def get_db_connection():
-    """获取数据库连接"""
+    """获取独立的数据库连接（调用方负责关闭，常规读写请使用 get_connection/transaction）"""
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
-    return conn
\ No newline at end of file
+    register_functions(conn)
+    return conn
@@ -1,13 +1,46 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import queue
+import random
+import threading
+import time
+from operator import attrgetter
+import profiling
 from contact_relation import get_title_by_relation
-import datetime
+from chat_analyzer import default_analyzer
+from database import get_connection, transaction
+from template_engine import compile_templates, load_template_file
+
+# 模板占位符的默认取值（没有可回忆的重要事项时使用）
+DEFAULT_SLOT_VALUES = {
+    'topic': '工作和生活',
+    'project': '合作项目',
+    'work': '工作',
+    'activity': '活动',
+    'memory': '往事',
+    'achievement': '工作中',
+    'difficulty': '技术',
+    'progress': '显著进步',
+    'experience': '旅行',
+    'moment': '节日',
+    'event': '家庭聚会',
+    'reunion': '同学聚会'
+}
+
+# 用聊天中的重要事项填充的占位符
+TOPIC_SLOTS = ('topic', 'project', 'work', 'activity', 'memory')
+
+# 模板中允许使用的全部占位符
+TEMPLATE_SLOTS = frozenset(DEFAULT_SLOT_VALUES) | {'title', 'name'}
 
 class GreetingGenerator:
-    def __init__(self):
+    def __init__(self, analyzer=None, template_path=None):
+        self.analyzer = analyzer or default_analyzer
+
         # 不同关系的拜年模板
-        self.templates = {
+        templates = {
             '师生': [
                 '{title}您好！值此龙年新春佳节之际，我想向您致以最诚挚的问候！感谢您一直以来对我的谆谆教导和关怀，您的言传身教让我受益匪浅。\n\n今年我们在{topic}方面有过很多交流，您的指导让我在{achievement}上取得了进步。新的一年里，我会继续努力学习，不辜负您的期望。\n\n祝您新年快乐，身体健康，工作顺利，阖家幸福！',
                 '尊敬的{title}：\n\n龙年大吉！感谢您这一年来对我的关心和帮助。记得我们在{topic}上的深入交流，您的见解让我茅塞顿开。\n\n新的一年，希望能继续得到您的指导。祝您新春快乐，万事如意！'
@@ -38,76 +71,241 @@ class GreetingGenerator:
             ]
         }
 
-    def generate_greeting(self, contact, chats):
-        """根据关系和聊天记录生成拜年微信"""
-        name = contact['name']
-        relation = contact['relation']
-        title = get_title_by_relation(relation, name)
+        # 外部模板库按关系覆盖内置模板
+        if template_path:
+            templates.update(load_template_file(template_path))
+
+        # 模板在构造时编译一次，未知占位符此时报错
+        self.templates = compile_templates(templates, TEMPLATE_SLOTS)
+
+    def generate_greeting(self, contact, chats=None):
+        """根据关系和聊天记录生成拜年微信（不传 chats 时从数据库增量分析该联系人的聊天记录）"""
+        if chats is None:
+            chat_analysis = self.analyzer.analyze_contact(contact['id'])
+        else:
+            chat_analysis = self.analyze_chats(chats)
+
+        return self.render_greeting(contact, chat_analysis)
+
+    def render_greeting(self, contact, chat_analysis):
+        """根据关系和聊天分析结果渲染拜年微信（不访问数据库，可在工作进程中执行）"""
+        template = random.choice(self.templates.get(contact['relation']) or self.templates['其他'])
+        return self._render(template, contact, chat_analysis)
+
+    def iter_candidates(self, contact, chats=None):
+        """按随机顺序依次产出该联系人互不相同的拜年微信候选
+
+        聊天分析在调用时立即完成（只做一次），返回的迭代器只做渲染、不访问数据库；
+        每个模板最多使用一次，渲染结果相同的候选也只产出一次，因此候选最多 candidate_limit(contact) 条。
+        """
+        if chats is None:
+            chat_analysis = self.analyzer.analyze_contact(contact['id'])
+        else:
+            chat_analysis = self.analyze_chats(chats)
 
-        chat_analysis = self.analyze_chats(chats)
+        templates = list(self.templates.get(contact['relation']) or self.templates['其他'])
+        random.shuffle(templates)
+        return self._iter_rendered(templates, contact, chat_analysis)
 
-        available_templates = self.templates.get(relation, self.templates['其他'])
-        import random
-        template = random.choice(available_templates)
+    def candidate_limit(self, contact):
+        """该联系人最多能产出的不同候选数（即其关系的模板数）"""
+        return len(self.templates.get(contact['relation']) or self.templates['其他'])
 
-        greeting = template.replace('{title}', title).replace('{name}', name)
+    def _iter_rendered(self, templates, contact, chat_analysis):
+        seen = set()
+        for template in templates:
+            greeting = self._render(template, contact, chat_analysis)
+            if greeting not in seen:
+                seen.add(greeting)
+                yield greeting
 
+    def prefetch_candidates(self, contact, prefetch=3):
+        """在后台线程中预先渲染候选，返回 CandidateQueue（用户阅读当前候选时下一条已准备好）
+
+        聊天分析在调用线程中完成，后台线程只渲染模板，不打开数据库连接。
+        """
+        return CandidateQueue(self.iter_candidates(contact), prefetch)
+
+    @profiling.timed('render')
+    def _render(self, template, contact, chat_analysis):
+        name = contact['name']
+        title = get_title_by_relation(contact['relation'], name)
+
+        values = dict(DEFAULT_SLOT_VALUES, title=title, name=name)
         if chat_analysis['important_matters']:
-            greeting = greeting.replace('{topic}', chat_analysis['important_matters'][0][:20] + '...')
-            greeting = greeting.replace('{project}', chat_analysis['important_matters'][0][:20] + '...')
-            greeting = greeting.replace('{work}', chat_analysis['important_matters'][0][:20] + '...')
-            greeting = greeting.replace('{activity}', chat_analysis['important_matters'][0][:20] + '...')
-            greeting = greeting.replace('{memory}', chat_analysis['important_matters'][0][:20] + '...')
+            # 话题取评分最高的重要事项（而不是最先出现的一条）
+            best = max(chat_analysis['important_matters'], key=attrgetter('score'))
+            topic = best.snippet[:20] + '...'
+            for slot in TOPIC_SLOTS:
+                values[slot] = topic
+
+        return template.render(values)
+
+    def generate_batch(self, contact_ids=None, workers=None, use_processes=False, chunk_size=200, progress=None):
+        """为全部（或指定的）联系人批量生成拜年微信草稿
+
+        联系人按 id 分块读取并在主线程增量分析，渲染交给线程池或进程池并行执行，
+        渲染上一块的同时分析下一块；每块结果在一个事务中批量写入 greetings 表（状态为 draft）。
+        progress(已完成数, 总数, 已用秒数) 在每块写入后调用。返回生成统计。
+        """
+        conn = get_connection()
+        if contact_ids is None:
+            total = conn.execute('SELECT COUNT(*) FROM contacts').fetchone()[0]
+        else:
+            contact_ids = sorted(set(contact_ids))
+            total = len(contact_ids)
+
+        # 执行器模块较重，交互模式只在批量生成时才载入
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+        workers = workers or os.cpu_count() or 1
+        if use_processes:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker,
+                                           initargs=(self.templates,))
+            render = _render_in_worker
         else:
-            greeting = greeting.replace('{topic}', '工作和生活')
-            greeting = greeting.replace('{project}', '合作项目')
-            greeting = greeting.replace('{work}', '工作')
-            greeting = greeting.replace('{activity}', '活动')
-            greeting = greeting.replace('{memory}', '往事')
-
-        greeting = greeting.replace('{achievement}', '工作中')
-        greeting = greeting.replace('{difficulty}', '技术')
-        greeting = greeting.replace('{progress}', '显著进步')
-        greeting = greeting.replace('{experience}', '旅行')
-        greeting = greeting.replace('{moment}', '节日')
-        greeting = greeting.replace('{event}', '家庭聚会')
-        greeting = greeting.replace('{reunion}', '同学聚会')
-
-        return greeting
+            executor = ThreadPoolExecutor(max_workers=workers)
+            render = _render_job_with(self)
+
+        start = time.perf_counter()
+        generated = 0
+        pending = None
+        try:
+            for chunk in self._iter_contact_chunks(conn, contact_ids, chunk_size):
+                # 整块联系人的分析状态在同一个事务中保存
+                with transaction():
+                    jobs = [(contact, self.analyzer.analyze_contact(contact['id'])) for contact in chunk]
+                results = executor.map(render, jobs, chunksize=max(1, len(jobs) // (workers * 4)))
+                if pending is not None:
+                    generated += self._save_drafts(*pending)
+                    if progress:
+                        progress(generated, total, time.perf_counter() - start)
+                pending = (chunk, results)
+            if pending is not None:
+                generated += self._save_drafts(*pending)
+                if progress:
+                    progress(generated, total, time.perf_counter() - start)
+        finally:
+            executor.shutdown()
+
+        seconds = time.perf_counter() - start
+        return {
+            'total': total,
+            'generated': generated,
+            'seconds': seconds,
+            'rate': generated / seconds if seconds > 0 else 0.0,
+            'workers': workers,
+            'mode': 'process' if use_processes else 'thread'
+        }
+
+    def _iter_contact_chunks(self, conn, contact_ids, chunk_size):
+        """按 id 键集分页逐块读取联系人，避免一次载入全部联系人"""
+        if contact_ids is not None:
+            for i in range(0, len(contact_ids), chunk_size):
+                ids = contact_ids[i:i + chunk_size]
+                placeholders = ','.join('?' * len(ids))
+                rows = conn.execute(f'SELECT id, name, relation FROM contacts WHERE id IN ({placeholders}) ORDER BY id',
+                                    ids).fetchall()
+                if rows:
+                    yield [dict(row) for row in rows]
+            return
+
+        last_id = 0
+        while True:
+            rows = conn.execute('SELECT id, name, relation FROM contacts WHERE id > ? ORDER BY id LIMIT ?',
+                                (last_id, chunk_size)).fetchall()
+            if not rows:
+                return
+            yield [dict(row) for row in rows]
+            last_id = rows[-1]['id']
+
+    def _save_drafts(self, contacts, greetings):
+        """把一块生成结果作为草稿批量写入 greetings 表"""
+        rows = [(contact['id'], greeting, 'draft') for contact, greeting in zip(contacts, greetings)]
+        with transaction() as conn:
+            conn.executemany('INSERT INTO greetings (contact_id, content, status) VALUES (?, ?, ?)', rows)
+        return len(rows)
 
     def analyze_chats(self, chats):
         """分析聊天记录"""
-        keywords = []
-        important_matters = []
-        recent_activities = []
-
-        keyword_patterns = [
-            {'pattern': ['工作', '项目', '任务'], 'category': '工作'},
-            {'pattern': ['健康', '身体', '生病'], 'category': '健康'},
-            {'pattern': ['家庭', '孩子', '父母'], 'category': '家庭'},
-            {'pattern': ['学习', '考试', '毕业'], 'category': '学习'},
-            {'pattern': ['生日', '节日', '庆祝'], 'category': '节日'},
-            {'pattern': ['帮助', '支持', '感谢'], 'category': '情感'},
-            {'pattern': ['计划', '目标', '未来'], 'category': '规划'}
-        ]
-
-        for chat in chats:
-            content = chat['content']
-            for pattern in keyword_patterns:
-                for word in pattern['pattern']:
-                    if word in content and word not in keywords:
-                        keywords.append(word)
-
-            if '重要' in content or '记得' in content or '务必' in content:
-                important_matters.append(content)
-
-            timestamp = datetime.datetime.fromisoformat(chat['timestamp'])
-            one_month_ago = datetime.datetime.now() - datetime.timedelta(days=30)
-            if timestamp > one_month_ago:
-                recent_activities.append(content)
+        return self.analyzer.analyze(chats)
 
-        return {
-            'keywords': keywords,
-            'important_matters': important_matters,
-            'recent_activities': recent_activities
-        }
\ No newline at end of file
+
+# 进程池中每个工作进程各自持有一个生成器实例
+_worker_generator = None
+
+
+class CandidateQueue:
+    """由后台线程填充的候选队列
+
+    线程最多领先消费者 prefetch 条；get() 在候选用完时返回 None，生成过程中的异常在 get() 中重新抛出。
+    """
+
+    _DONE = object()
+
+    def __init__(self, candidates, prefetch=3):
+        self._queue = queue.Queue(maxsize=max(1, prefetch))
+        self._closed = threading.Event()
+        self._finished = False
+        self._thread = threading.Thread(target=self._fill, args=(candidates,), name='greeting-prefetch', daemon=True)
+        self._thread.start()
+
+    def _fill(self, candidates):
+        try:
+            for candidate in candidates:
+                if not self._put(candidate):
+                    return
+        except Exception as e:
+            self._put(e)
+        self._put(self._DONE)
+
+    def _put(self, item):
+        # 队列满时等待消费者，close() 后放弃
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self):
+        """取下一条候选（尚未生成时等待），没有更多候选时返回 None"""
+        if self._finished:
+            return None
+        item = self._queue.get()
+        if item is self._DONE:
+            self._finished = True
+            return None
+        if isinstance(item, Exception):
+            self._finished = True
+            raise item
+        return item
+
+    def close(self):
+        """停止预取（后台线程在下一次放入候选时退出）"""
+        self._closed.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _init_render_worker(templates):
+    global _worker_generator
+    _worker_generator = GreetingGenerator()
+    _worker_generator.templates = templates
+
+
+def _render_in_worker(job):
+    contact, chat_analysis = job
+    return _worker_generator.render_greeting(contact, chat_analysis)
+
+
+def _render_job_with(generator):
+    def render(job):
+        contact, chat_analysis = job
+        return generator.render_greeting(contact, chat_analysis)
+    return render
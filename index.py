@@ -1,71 +1,93 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os
+import argparse
+import sqlite3
+import threading
+import profiling
 from database import init_database
 from contact_relation import determine_relation
-from chat_manager import ChatManager
-from greeting_generator import GreetingGenerator
+from chat_manager import ChatManager, format_timestamp
+from contact_directory import ContactRecord, default_directory
 from user_interaction import UserInteraction
-from database import get_db_connection
-from wechatDBFinder import WeChatDBFinder
-
-def main():
+from database import release_connection, transaction
+
+# 生成器（并发执行器、模板编译）和微信数据库查找在首次使用时才载入，菜单无需等待
+
+def parse_args(argv=None):
+    """解析命令行参数；不带子命令时进入交互菜单"""
+    parser = argparse.ArgumentParser(description='新春拜年微信生成程序')
+    parser.add_argument('--templates', help='外部拜年模板库 JSON 文件（按关系覆盖内置模板）')
+    parser.add_argument('--sync', choices=['background', 'foreground', 'off'], default='background',
+                        help='启动时同步微信联系人的方式：后台（默认，菜单立即显示）、前台（同步完成后显示菜单）或不同步')
+    parser.add_argument('--profile', nargs='?', const='', metavar='JSON',
+                        help='启用分阶段计时：退出时打印各阶段耗时汇总，指定文件时写入 JSON（也可设置环境变量 SPRINGWISH_PROFILE）')
+    parser.add_argument('--profile-stage', choices=sorted(profiling.STAGES), metavar='STAGE',
+                        help='对指定阶段做 cProfile 采样（需同时启用 --profile）：' + '、'.join(sorted(profiling.STAGES)))
+    subparsers = parser.add_subparsers(dest='command')
+
+    batch = subparsers.add_parser('batch', help='为全部联系人批量生成拜年微信草稿')
+    batch.add_argument('--workers', type=int, default=None, help='并行渲染的工作线程/进程数（默认 CPU 核数）')
+    batch.add_argument('--processes', action='store_true', help='使用进程池渲染（默认使用线程池）')
+    batch.add_argument('--chunk-size', type=int, default=200, help='每批读取和写入的联系人数')
+
+    import_chats = subparsers.add_parser('import-chats', help='把微信数据库中的聊天记录导入本地数据库（只导入新增消息）')
+    import_chats.add_argument('db_paths', nargs='*', help='微信数据库文件（默认自动查找）')
+
+    rank = subparsers.add_parser('rank', help='按聊天记录中关键词分类的近期加权次数排列联系人')
+    rank.add_argument('--category', help='只按这个分类排名（默认按全部分类合计）')
+    rank.add_argument('--top', type=int, default=20, help='显示的联系人数')
+    rank.add_argument('--rebuild', action='store_true', help='忽略已保存的矩阵，重新扫描全部聊天记录')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.profile is not None:
+        profiling.profiler.enable(args.profile or None, args.profile_stage)
     ui = UserInteraction()
     chat_manager = ChatManager()
-    generator = GreetingGenerator()
 
-    try:
-        ui.show_info('正在初始化拜年微信生成程序...')
+    # 指定了外部模板时立即加载，模板错误在启动时报告；否则到第一次生成时再加载
+    generator = None
+    if args.templates or args.command == 'batch':
+        generator = load_generator(ui, args.templates)
+        if generator is None:
+            return
 
-        # 首先查找微信数据库
-        finder = WeChatDBFinder()
-        contact_db_paths = finder.find_contacts_db()
-        if contact_db_paths:
-            ui.show_success(f"找到 {len(contact_db_paths)} 个微信数据库文件")
-            # 可以选择一个数据库进行读取
-            db_path = contact_db_paths[0]
-            if finder.verify_db(db_path):
-                ui.show_success("数据库验证成功")
-                # 尝试提取联系人信息
-                contacts_data = finder.extract_contacts(db_path)
-                if contacts_data:
-                    ui.show_success(f"成功提取 {len(contacts_data['contacts'])} 位联系人信息")
-                    # 打印所有联系人信息
-                    print("\n=== 微信联系人列表 ===")
-                    for i, contact in enumerate(contacts_data['contacts']):
-                        if isinstance(contact, dict):
-                            name = contact.get("display_name", "未知")
-                            notes = ""
-                            if contact.get("nickname") and contact.get("nickname") != name:
-                                notes = contact.get("nickname")
-                            elif contact.get("remark") and contact.get("remark") != name:
-                                notes = contact.get("remark")
-
-                            contact_info = f"{i+1}. {name}"
-                            if notes:
-                                contact_info += f" ({notes})"
-                            print(contact_info)
-                    # 将联系人信息导入到本地数据库
-                    import_contacts_from_wechat(contacts_data['contacts'])
-            else:
-                ui.show_error("数据库验证失败")
-        else:
-            ui.show_info("未找到微信数据库，使用本地数据库")
+    if args.command == 'batch':
+        batch_generate(ui, generator, args)
+        return
+    if args.command == 'import-chats':
+        import_chats_from_wechat(ui, args.db_paths)
+        return
+    if args.command == 'rank':
+        rank_contacts(ui, args)
+        return
 
+    try:
+        ui.show_info('正在初始化拜年微信生成程序...')
         init_database()
 
+        sync = WeChatSync()
+        if args.sync == 'background':
+            sync.start()
+        elif args.sync == 'foreground':
+            sync.run()
+            ui.show_info(sync.status)
+
         menu_options = [
             '查看联系人列表',
             '添加新联系人',
             '查看聊天记录',
             '添加聊天记录',
             '生成拜年微信',
+            '搜索聊天记录',
             '退出程序'
         ]
 
         while True:
-            choice = ui.show_menu(menu_options)
+            choice = ui.show_menu(menu_options, status=sync.status if args.sync == 'background' else None)
 
             if choice == 0:
                 # 查看联系人列表
@@ -81,9 +103,18 @@ def main():
                 add_chat(ui, chat_manager)
             elif choice == 4:
                 # 生成拜年微信
+                if generator is None:
+                    generator = load_generator(ui, args.templates)
+                    if generator is None:
+                        continue
                 generate_greeting(ui, chat_manager, generator)
             elif choice == 5:
+                # 搜索聊天记录
+                search_chats(ui, chat_manager)
+            elif choice == 6:
                 # 退出程序
+                if sync.running:
+                    ui.show_info('微信联系人同步尚未完成，已中止（下次启动时重新同步）')
                 ui.show_success('程序已退出')
                 break
 
@@ -92,13 +123,87 @@ def main():
         import traceback
         print(traceback.format_exc())
 
+def load_generator(ui, template_path=None):
+    """载入拜年微信生成器，模板加载失败时显示错误并返回 None"""
+    from greeting_generator import GreetingGenerator
+
+    try:
+        return GreetingGenerator(template_path=template_path)
+    except (OSError, ValueError) as e:
+        ui.show_error(f'加载模板失败: {e}')
+        return None
+
+class WeChatSync:
+    """启动时的微信联系人同步：查找微信数据库、验证并导入联系人
+
+    可以在前台直接调用 run()，也可以用 start() 放到后台线程执行；执行过程不输出信息，
+    进度和结果写在 status 中，由菜单显示。
+    """
+
+    def __init__(self, finder=None):
+        self.finder = finder
+        self.status = '未同步微信联系人'
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """在后台线程中同步（守护线程，退出程序时不等待）"""
+        self.status = '正在后台同步微信联系人...'
+        self._thread = threading.Thread(target=self.run, name='wechat-sync', daemon=True)
+        self._thread.start()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        try:
+            self.status = '正在查找微信数据库...'
+            from contact_sync import ContactSync
+
+            sync = ContactSync(finder=self.finder)
+            contact_db_paths = sync.finder.contact_db_candidates()
+            if not contact_db_paths:
+                self.status = '未找到微信数据库，使用本地数据库'
+                return
+
+            self.status = f'正在同步 {len(contact_db_paths)} 个微信数据库的联系人...'
+            counts = sync.sync(contact_db_paths)
+            statuses = [source['status'] for source in counts['sources']]
+            if all(status in ('unverified', 'error') for status in statuses):
+                self.status = f'微信数据库验证失败: {", ".join(contact_db_paths)}'
+                return
+            if all(status == 'unchanged' for status in statuses):
+                self.status = f'微信联系人无变化（{len(statuses)} 个数据库）'
+                return
+
+            failed = statuses.count('error')
+            failed = f"，{failed} 个数据库读取失败" if failed else ''
+            self.status = (f"微信联系人同步完成：新增 {counts['inserted']} 位，更新 {counts['updated']} 位，"
+                           f"按姓名关联 {counts['linked']} 位{failed}")
+        except Exception as e:
+            self.status = f'微信联系人同步失败: {e}'
+        finally:
+            # 在后台线程中执行时，线程结束后连接不会再被使用
+            release_connection()
+
+def find_contact(ui, name, directory=None):
+    """在内存联系人目录中按姓名查找联系人；找不到时显示错误和相近的姓名，返回 None"""
+    directory = directory or default_directory
+    contact = directory.get(name)
+    if contact is None:
+        ui.show_error(f'未找到联系人 "{name}"')
+        suggestions = directory.suggest(name) if name else []
+        if suggestions:
+            ui.show_info('您要找的是不是: ' + '、'.join(record.name for record in suggestions))
+    return contact
+
 def show_contacts(ui):
     """查看联系人列表"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM contacts')
-    contacts = cursor.fetchall()
-    conn.close()
+    contacts = list(default_directory)
 
     ui.show_info(f'共有 {len(contacts)} 位联系人:')
     for i, contact in enumerate(contacts, 1):
@@ -120,45 +225,65 @@ def add_contact(ui):
     contact = {'name': name, 'phone': phone, 'notes': notes}
     relation = determine_relation(contact)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO contacts (name, phone, relation, notes) VALUES (?, ?, ?, ?)',
-                   (name, phone, relation, notes))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cursor = conn.execute('INSERT INTO contacts (name, phone, relation, notes) VALUES (?, ?, ?, ?)',
+                              (name, phone, relation, notes))
+    default_directory.add(ContactRecord(cursor.lastrowid, name, phone, relation, notes))
 
     ui.show_success(f'联系人 "{name}" 已添加，关系: {relation}')
 
-def show_chats(ui, chat_manager):
-    """查看聊天记录"""
+def show_chats(ui, chat_manager, page_size=20):
+    """查看聊天记录（从新到旧分页显示）"""
     name = ui.get_input('请输入联系人姓名: ')
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM contacts WHERE name = ?', (name,))
-    contact = cursor.fetchone()
-    conn.close()
-
+    contact = find_contact(ui, name)
     if not contact:
-        ui.show_error(f'未找到联系人 "{name}"')
         return
 
-    chats = chat_manager.get_chats_by_contact_id(contact['id'])
-    ui.show_info(f'联系人 "{name}" 的聊天记录 (共 {len(chats)} 条):')
-    for i, chat in enumerate(chats, 1):
-        time = chat['timestamp']
-        print(f'\n{i}. [{time}] {chat["content"]}')
+    total = chat_manager.count_chats(contact['id'])
+    ui.show_info(f'联系人 "{name}" 的聊天记录 (共 {total} 条):')
+
+    # 按页读取和显示，不一次载入全部聊天记录
+    i = 0
+    after = None
+    while True:
+        chats, after = chat_manager.get_chats_page(contact['id'], page_size, after)
+        for chat in chats:
+            i += 1
+            print(f'\n{i}. [{format_timestamp(chat["timestamp"])}] {chat["content"]}')
+        if after is None or i >= total:
+            return
+        if ui.get_input(f'\n已显示 {i}/{total} 条，按回车查看下一页，输入 q 返回菜单: ').lower() == 'q':
+            return
+
+def search_chats(ui, chat_manager, page_size=10):
+    """在全部联系人的聊天记录中搜索（按相关度排序，分页显示）"""
+    text = ui.get_input('请输入搜索内容（多个词用空格分隔，短语加双引号）: ')
+    if not text:
+        ui.show_error('搜索内容不能为空')
+        return
+
+    page = 1
+    while True:
+        found = chat_manager.search_chats(text, page=page, page_size=page_size)
+        if not found['total']:
+            ui.show_info(f'没有找到包含 "{text}" 的聊天记录')
+            return
+
+        ui.show_info(f'找到 {found["total"]} 条聊天记录（第 {page}/{found["pages"]} 页）:')
+        for i, chat in enumerate(found['results'], (page - 1) * page_size + 1):
+            print(f'\n{i}. {chat["name"] or "未知联系人"} [{format_timestamp(chat["timestamp"])}] {chat["content"]}')
+
+        if page >= found['pages']:
+            return
+        if ui.get_input('\n按回车查看下一页，输入 q 返回菜单: ').lower() == 'q':
+            return
+        page += 1
 
 def add_chat(ui, chat_manager):
     """添加聊天记录"""
     name = ui.get_input('请输入联系人姓名: ')
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM contacts WHERE name = ?', (name,))
-    contact = cursor.fetchone()
-    conn.close()
-
+    contact = find_contact(ui, name)
     if not contact:
-        ui.show_error(f'未找到联系人 "{name}"')
         return
 
     content = ui.get_input('请输入聊天内容: ')
@@ -169,81 +294,116 @@ def add_chat(ui, chat_manager):
     chat_manager.save_chat(contact['id'], content)
     ui.show_success('聊天记录已添加')
 
-def import_contacts_from_wechat(wechat_contacts):
-    """从微信数据库导入联系人到本地数据库（针对微信电脑版优化）"""
-    if not wechat_contacts:
-        return
+def import_chats_from_wechat(ui, db_paths=None):
+    """非交互模式：导入微信联系人和聊天记录（按导入进度只复制新增消息）"""
+    from chat_importer import ChatImporter
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    init_database()
+    importer = ChatImporter()
+    if not db_paths:
+        db_paths = importer.finder.find_contacts_db() or []
+    if not db_paths:
+        ui.show_error('未找到微信数据库')
+        return
 
-    added_count = 0
-    for contact in wechat_contacts:
+    # 全部数据库的联系人并发读取，只写入新增和修改过的联系人（按微信 id）
+    from contact_sync import ContactSync
+
+    counts = ContactSync(finder=importer.finder).sync(db_paths)
+    for source in counts['sources']:
+        if source['status'] == 'error':
+            ui.show_error(f"读取失败: {source['path']} ({source['error']})")
+        elif source['status'] == 'unverified':
+            ui.show_error(f"数据库验证失败: {source['path']}")
+        elif source['status'] == 'unchanged':
+            ui.show_info(f"{source['path']}: 联系人无变化")
+        else:
+            ui.show_info(f"{source['path']}: {source['rows']} 位联系人，{source['changed']} 位新增或修改，"
+                         f"耗时 {source['seconds'] * 1000:.0f} 毫秒")
+    ui.show_success(f"联系人同步完成：新增 {counts['inserted']} 位，更新 {counts['updated']} 位，"
+                    f"按姓名关联 {counts['linked']} 位")
+
+    for source in counts['sources']:
+        if source['status'] not in ('synced', 'unchanged'):
+            continue
+        db_path = source['path']
+        ui.show_info(f'正在导入聊天记录: {db_path}')
         try:
-            # 提取姓名和备注（微信电脑版字段结构）
-            if isinstance(contact, dict) and "display_name" in contact:
-                name = contact.get("display_name", "")
-                notes = contact.get("nickname", "")
-                if contact.get("remark") and contact.get("remark") != contact.get("nickname"):
-                    notes = contact.get("remark")
-            else:
-                name = ""
-                notes = ""
-
-            if name:
-                cursor.execute('SELECT id FROM contacts WHERE name = ?', (name,))
-                existing_contact = cursor.fetchone()
-                if not existing_contact:
-                    # 自动判断关系
-                    import_cont = {'name': name, 'notes': notes}
-                    relation = determine_relation(import_cont)
-                    cursor.execute('INSERT INTO contacts (name, phone, relation, notes) VALUES (?, ?, ?, ?)',
-                                  (name, '', relation, notes))
-                    added_count += 1
-        except Exception as e:
-            print(f"导入联系人时出错: {e}")
-
-    conn.commit()
-    conn.close()
-
-    if added_count > 0:
-        print(f"成功导入 {added_count} 位联系人到本地数据库")
+            stats = importer.import_messages(db_path, progress=lambda done, elapsed: ui.show_progress(done, None, elapsed))
+        except sqlite3.DatabaseError as e:
+            # 已提交的部分保留（导入进度同时提交），下次从断点继续
+            ui.show_error(f'导入聊天记录失败: {db_path} ({e})')
+            continue
+        ui.show_success(f"导入 {stats['imported']} 条聊天记录，跳过 {stats['skipped']} 条非文本消息、"
+                        f"{stats['unmapped']} 条无对应联系人的消息，耗时 {stats['seconds']:.2f} 秒")
+
+def batch_generate(ui, generator, args):
+    """非交互模式：为全部联系人批量生成拜年微信草稿"""
+    init_database()
+    ui.show_info('正在为全部联系人批量生成拜年微信草稿...')
+    stats = generator.generate_batch(workers=args.workers, use_processes=args.processes,
+                                     chunk_size=args.chunk_size, progress=ui.show_progress)
+    ui.show_success(f"批量生成完成：{stats['generated']}/{stats['total']} 条草稿，"
+                    f"耗时 {stats['seconds']:.2f} 秒，{stats['rate']:.0f} 条/秒 "
+                    f"({stats['workers']} 个{'进程' if stats['mode'] == 'process' else '线程'})")
+    return stats
+
+def rank_contacts(ui, args):
+    """非交互模式：用联系人 × 分类矩阵排列最值得拜年（最近聊得最多）的联系人"""
+    from contact_matrix import CATEGORIES, CategoryMatrix
+
+    if args.category is not None and args.category not in CATEGORIES:
+        ui.show_error(f"未知分类: {args.category}（可选：{'、'.join(CATEGORIES)}）")
+        return None
+    init_database()
+    if args.rebuild:
+        matrix = CategoryMatrix.build()
+        matrix.save()
+    else:
+        matrix = CategoryMatrix.load_or_build()
+    ranking = matrix.top(args.top, category=args.category)
+    if not ranking:
+        ui.show_info('聊天记录中没有命中关键词分类的联系人')
+        return ranking
+    for rank, (contact_id, score) in enumerate(ranking, 1):
+        contact = default_directory.get_by_id(contact_id)
+        summary = matrix.summary(contact_id)
+        name = contact['name'] if contact else f'#{contact_id}'
+        print(f"{rank:>3}. {name}  得分 {score:.1f}，{summary['messages']} 条消息，"
+              f"话题：{'、'.join(summary['top_categories'])}")
+    return ranking
 
 def generate_greeting(ui, chat_manager, generator):
     """生成拜年微信"""
     name = ui.get_input('请输入联系人姓名: ')
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM contacts WHERE name = ?', (name,))
-    contact = cursor.fetchone()
-    conn.close()
-
+    contact = find_contact(ui, name)
     if not contact:
-        ui.show_error(f'未找到联系人 "{name}"')
         return
 
-    chats = chat_manager.get_chats_by_contact_id(contact['id'])
-
     greeting = None
     is_satisfied = False
     attempts = 0
-    max_attempts = 5
-
-    while not is_satisfied and attempts < max_attempts:
-        greeting = generator.generate_greeting(contact, chats)
-        is_satisfied = ui.show_greeting_and_get_feedback(greeting, contact['name'])
-        attempts += 1
+    # 最多尝试 5 次；每个模板只产出一条不同的候选，模板更少时以模板数为准
+    max_attempts = min(5, generator.candidate_limit(contact))
+
+    # 后台预先生成互不重复的候选，用户回答"不满意"时下一条已经准备好
+    with generator.prefetch_candidates(contact) as candidates:
+        while not is_satisfied and attempts < max_attempts:
+            greeting = candidates.get()
+            if greeting is None:
+                break
+            is_satisfied = ui.show_greeting_and_get_feedback(greeting, contact['name'])
+            attempts += 1
 
     if is_satisfied:
         ui.show_success('拜年微信已生成并保存')
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO greetings (contact_id, content, status) VALUES (?, ?, ?)',
-                       (contact['id'], greeting, 'approved'))
-        conn.commit()
-        conn.close()
-    else:
+        with transaction() as conn:
+            conn.execute('INSERT INTO greetings (contact_id, content, status) VALUES (?, ?, ?)',
+                         (contact['id'], greeting, 'approved'))
+    elif attempts >= 5:
         ui.show_error('已达到最大尝试次数，程序已停止')
+    else:
+        ui.show_error(f'已展示全部 {attempts} 条不同的拜年微信，程序已停止')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+from collections import namedtuple
+
+# 聊天分析使用的关键词分类（分类 -> 关键词）
+KEYWORD_CATEGORIES = {
+    '工作': ['工作', '项目', '任务'],
+    '健康': ['健康', '身体', '生病'],
+    '家庭': ['家庭', '孩子', '父母'],
+    '学习': ['学习', '考试', '毕业'],
+    '节日': ['生日', '节日', '庆祝'],
+    '情感': ['帮助', '支持', '感谢'],
+    '规划': ['计划', '目标', '未来']
+}
+
+# 标记重要事项的词，作为一个独立分类和关键词一起编译
+IMPORTANT_CATEGORY = '重要事项'
+IMPORTANT_MARKERS = ['重要', '记得', '务必']
+
+# 一次扫描的结果：words 为 分类 -> 命中的关键词（按注册顺序去重），counts 为 分类 -> 命中次数
+MatchResult = namedtuple('MatchResult', ['words', 'counts'])
+
+
+class KeywordMatcher:
+    """多模式关键词匹配器
+
+    所有关键词按字典树（公共前缀合并）编译进同一个正则，每条文本只由 re（C 实现）扫描一遍：
+    每个位置取以此开始的最长关键词，同一位置开始的较短关键词都是它的前缀，由预先算好的前缀表补齐，
+    因此重叠的命中也全部计数。关键词可以随时追加，下次匹配时自动重新编译。
+    """
+
+    def __init__(self, categories=None):
+        self._words = []            # 关键词，按注册顺序
+        self._word_index = {}       # 关键词 -> 序号
+        self._word_categories = []  # 序号 -> 所属分类列表
+        self._compiled = None
+        for category, words in (categories or {}).items():
+            self.add_words(category, words)
+
+    @property
+    def words(self):
+        """已注册的全部关键词"""
+        return list(self._words)
+
+    def add_word(self, word, category):
+        """注册一个关键词；同一个词可以属于多个分类"""
+        if not word:
+            raise ValueError('关键词不能为空')
+        index = self._word_index.get(word)
+        if index is None:
+            index = len(self._words)
+            self._word_index[word] = index
+            self._words.append(word)
+            self._word_categories.append([])
+        if category not in self._word_categories[index]:
+            self._word_categories[index].append(category)
+        self._compiled = None
+
+    def add_words(self, category, words):
+        """批量注册同一分类的关键词"""
+        for word in words:
+            self.add_word(word, category)
+
+    def _build(self):
+        """编译正则，并为每个关键词列出同一位置开始时一并命中的关键词（它的全部前缀和它自身，从短到长）
+
+        正则形如 [首字](?<=(?=(字典树)).)：先消耗一个可能开始关键词的字符，re 据此直接跳过其它字符；
+        再退回该字符，用前瞻捕获从这里开始的最长关键词。前瞻不消耗文本，下一次匹配从下一个字符开始，重叠的命中不会漏掉。
+        """
+        words = self._words
+        if words:
+            starts = '[' + ''.join(re.escape(char) for char in sorted({word[0] for word in words})) + ']'
+            pattern = re.compile(starts + '(?<=(?=(' + _trie_pattern(words) + ')).)', re.DOTALL)
+        else:
+            pattern = re.compile('(?!)')
+        word_index = self._word_index
+        prefixes = {word: tuple(word_index[word[:end]] for end in range(1, len(word) + 1) if word[:end] in word_index)
+                    for word in words}
+        self._compiled = (pattern, prefixes)
+        return self._compiled
+
+    def iter_matches(self, text):
+        """按扫描顺序逐个产出 (结束位置, 关键词)：按开始位置先后，同一位置开始的从短到长；重叠的命中也会全部产出"""
+        pattern, prefixes = self._compiled or self._build()
+        words = self._words
+        for match in pattern.finditer(text or ''):
+            start = match.start()
+            for index in prefixes[match.group(1)]:
+                yield start + len(words[index]) - 1, words[index]
+
+    def scan(self, text):
+        """单次扫描文本，返回各分类命中的关键词和命中次数"""
+        pattern, prefixes = self._compiled or self._build()
+        hits = {}
+        for word in pattern.findall(text or ''):
+            for index in prefixes[word]:
+                hits[index] = hits.get(index, 0) + 1
+        if not hits:
+            return MatchResult({}, {})
+
+        words = {}
+        counts = {}
+        for index in sorted(hits):
+            for category in self._word_categories[index]:
+                words.setdefault(category, []).append(self._words[index])
+                counts[category] = counts.get(category, 0) + hits[index]
+        return MatchResult(words, counts)
+
+
+def _trie_pattern(words):
+    """把关键词合并成字典树形状的正则（可选的后缀是贪婪的，因此先尝试更长的关键词）"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in node.items() if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return '(?:' + body + ')?' if '' in node else body
+
+    return build(trie)
+
+
+_default_matcher = None
+
+
+def get_default_matcher():
+    """返回内置关键词和重要事项标记编译出的共享匹配器（只编译一次）"""
+    global _default_matcher
+    if _default_matcher is None:
+        matcher = KeywordMatcher(KEYWORD_CATEGORIES)
+        matcher.add_words(IMPORTANT_CATEGORY, IMPORTANT_MARKERS)
+        _default_matcher = matcher
+    return _default_matcher
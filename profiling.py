@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import threading
+import time
+from array import array
+
+# 设置后启用计时：值为 1/true/yes 时退出时把汇总打印到标准错误，其它值作为 JSON 汇总文件路径
+PROFILE_ENV = 'SPRINGWISH_PROFILE'
+# 设置后对该阶段做 cProfile 函数级采样（如 analysis）
+PROFILE_STAGE_ENV = 'SPRINGWISH_PROFILE_STAGE'
+
+# 流水线中的阶段名称
+STAGES = {
+    'discovery': '查找微信数据库（WeChatDBFinder.get_wechat_db_paths）',
+    'extract.contacts': '读取微信联系人表（每批 fetchmany）',
+    'extract.messages': '读取微信消息表（每批 fetchmany）',
+    'import.contacts': '同步微信联系人（ContactSync.sync）',
+    'import.chats': '导入微信聊天记录（ChatImporter.import_messages）',
+    'chat_fetch': '从本地数据库读取聊天记录（ChatManager）',
+    'write.chats': '成组提交写入聊天记录（ChatWriter 每批）',
+    'analysis': '聊天记录分析（ChatAnalyzer）',
+    'render': '拜年微信模板渲染（GreetingGenerator）'
+}
+
+
+class _NullStage:
+    """未启用时 stage() 返回的共享空上下文，进入和退出都不做任何事"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """一次阶段计时；该阶段被选中做 cProfile 采样且采样器空闲时同时采样"""
+
+    __slots__ = ('profiler', 'name', 'start', 'sampling')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.sampling = False
+
+    def __enter__(self):
+        profiler = self.profiler
+        if profiler.cprofile_stage == self.name and profiler._sampling_lock.acquire(False):
+            self.sampling = True
+            profiler._sampler().enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        if self.sampling:
+            self.profiler._cprofile.disable()
+            self.profiler._sampling_lock.release()
+        self.profiler.record(self.name, seconds)
+        return False
+
+
+def percentile(values, fraction):
+    """已排序数据的百分位数（最近秩法）"""
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * fraction // 1))
+    return values[min(len(values), int(rank)) - 1]
+
+
+class Profiler:
+    """按阶段计时和计数（默认关闭，可选启用）
+
+    启用后每次阶段执行的耗时记录在 array 中，汇总时给出次数、总耗时、p50/p95 和最大值；
+    未启用时 stage() 直接返回共享的空上下文，timed 装饰的函数只多一次布尔判断。
+    计时在各线程中都有效；进程池工作进程中的计时不汇总到主进程。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.output = None
+        self.cprofile_stage = None
+        self._timings = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._sampling_lock = threading.Lock()
+        self._cprofile = None
+        self._exit_registered = False
+
+    def enable(self, output=None, cprofile_stage=None, report_at_exit=True):
+        """启用计时；output 为 JSON 汇总文件路径（None 时打印到标准错误），cprofile_stage 为要采样的阶段"""
+        self.output = output
+        self.cprofile_stage = cprofile_stage
+        self.enabled = True
+        if report_at_exit and not self._exit_registered:
+            import atexit
+
+            atexit.register(self._report_at_exit)
+            self._exit_registered = True
+
+    def enable_from_env(self, environ=None):
+        """按环境变量 SPRINGWISH_PROFILE / SPRINGWISH_PROFILE_STAGE 启用，返回是否启用"""
+        environ = os.environ if environ is None else environ
+        value = environ.get(PROFILE_ENV, '').strip()
+        if not value or value.lower() in ('0', 'false', 'no'):
+            return False
+        output = None if value.lower() in ('1', 'true', 'yes') else value
+        self.enable(output, environ.get(PROFILE_STAGE_ENV) or None)
+        return True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """清空已记录的计时、计数和采样结果"""
+        with self._lock:
+            self._timings = {}
+            self._counters = {}
+            self._cprofile = None
+
+    def stage(self, name):
+        """阶段计时上下文：with profiler.stage('analysis'): ..."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def timed(self, name):
+        """把整个函数作为一个阶段计时的装饰器"""
+        def decorate(func):
+            import functools
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Stage(self, name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def count(self, name, n=1):
+        """累加计数器（如读取的行数）"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def record(self, name, seconds):
+        timings = self._timings.get(name)
+        if timings is None:
+            with self._lock:
+                timings = self._timings.setdefault(name, array('d'))
+        timings.append(seconds)
+
+    def _sampler(self):
+        if self._cprofile is None:
+            import cProfile
+
+            self._cprofile = cProfile.Profile()
+        return self._cprofile
+
+    def summary(self):
+        """汇总：{'stages': {阶段: {count, total, mean, p50, p95, max}}, 'counters': {计数器: 值}}（时间单位为秒）"""
+        with self._lock:
+            timings = {name: sorted(values) for name, values in self._timings.items()}
+            counters = dict(self._counters)
+        stages = {}
+        for name, values in sorted(timings.items()):
+            total = sum(values)
+            stages[name] = {
+                'count': len(values),
+                'total': total,
+                'mean': total / len(values) if values else 0.0,
+                'p50': percentile(values, 0.50),
+                'p95': percentile(values, 0.95),
+                'max': values[-1] if values else 0.0
+            }
+        return {'stages': stages, 'counters': counters}
+
+    def report(self, file=None):
+        """打印各阶段的次数、总耗时和 p50/p95（毫秒）以及计数器"""
+        file = file or sys.stderr
+        summary = self.summary()
+        print(f"\n{'阶段':<20}{'次数':>8}{'总计 ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'最大 ms':>8}", file=file)
+        for name, stats in summary['stages'].items():
+            print(f"{name:<22}{stats['count']:>10}{stats['total'] * 1000:>12.1f}{stats['p50'] * 1000:>10.3f}"
+                  f"{stats['p95'] * 1000:>10.3f}{stats['max'] * 1000:>10.3f}", file=file)
+        for name, value in sorted(summary['counters'].items()):
+            print(f'{name:<22}{value:>10}', file=file)
+        if self._cprofile is not None:
+            import pstats
+
+            print(f'\ncProfile 采样（阶段 {self.cprofile_stage}，按累计耗时前 20 项）:', file=file)
+            pstats.Stats(self._cprofile, stream=file).sort_stats('cumulative').print_stats(20)
+
+    def dump(self, path):
+        """把汇总写入 JSON 文件；有 cProfile 采样时另存为同名的 .prof 文件（可用 pstats/snakeviz 查看）"""
+        import json
+
+        summary = self.summary()
+        summary['cprofile_stage'] = self.cprofile_stage
+        if self._cprofile is not None:
+            summary['cprofile_file'] = os.path.splitext(path)[0] + '.prof'
+            self._cprofile.dump_stats(summary['cprofile_file'])
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        return summary
+
+    def _report_at_exit(self):
+        if not self.enabled:
+            return
+        if self.output:
+            self.dump(self.output)
+        else:
+            self.report()
+
+
+# 全局计时器：各模块用 profiling.stage / profiling.timed / profiling.count 记录
+profiler = Profiler()
+stage = profiler.stage
+timed = profiler.timed
+count = profiler.count
+
+profiler.enable_from_env()
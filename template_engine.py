@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import re
+
+# 占位符格式：{slot_name}
+SLOT_PATTERN = re.compile(r'\{(\w+)\}')
+
+
+class TemplateError(ValueError):
+    """模板格式错误（例如包含未知占位符）"""
+
+
+class Template:
+    """预编译模板
+
+    构造时把模板拆分为文字片段和占位符片段，渲染时只需填入占位符的值并做一次 join，
+    不再对整段文字反复 str.replace。
+    """
+
+    __slots__ = ('source', 'slots', '_parts', '_slot_positions')
+
+    def __init__(self, source, known_slots=None):
+        self.source = source
+        parts = []
+        slot_positions = []
+        position = 0
+        for match in SLOT_PATTERN.finditer(source):
+            if match.start() > position:
+                parts.append(source[position:match.start()])
+            slot_positions.append((len(parts), match.group(1)))
+            parts.append(None)
+            position = match.end()
+        if position < len(source):
+            parts.append(source[position:])
+
+        self._parts = parts
+        self._slot_positions = tuple(slot_positions)
+        self.slots = frozenset(slot for _, slot in slot_positions)
+
+        if known_slots is not None:
+            unknown = self.slots - set(known_slots)
+            if unknown:
+                raise TemplateError(f"模板包含未知占位符: {', '.join(sorted(unknown))}")
+
+    def render(self, values):
+        """用 values（占位符 -> 文字）填充模板"""
+        parts = self._parts[:]
+        for index, slot in self._slot_positions:
+            parts[index] = values[slot]
+        return ''.join(parts)
+
+    def __repr__(self):
+        return f'Template({self.source[:20]!r}...)'
+
+
+def compile_templates(raw_templates, known_slots=None):
+    """把 {关系: [模板文字]} 编译为 {关系: [Template]}，未知占位符在此时报错"""
+    compiled = {}
+    for relation, sources in raw_templates.items():
+        compiled[relation] = []
+        for i, source in enumerate(sources, 1):
+            try:
+                compiled[relation].append(Template(source, known_slots))
+            except TemplateError as e:
+                raise TemplateError(f"关系 '{relation}' 的第 {i} 个模板: {e}") from None
+    return compiled
+
+
+def load_template_file(path):
+    """从 JSON 文件读取模板库，格式为 {关系: [模板文字, ...]}"""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or not all(isinstance(sources, list) for sources in data.values()):
+        raise TemplateError(f'模板文件格式错误（应为 {{关系: [模板, ...]}}）: {path}')
+    return data
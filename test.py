@@ -4,11 +4,61 @@
 import os
 import sys
 import sqlite3
-from database import init_database, DB_PATH, get_db_connection
+from database import init_database, DB_PATH, get_db_connection, get_connection, temp_database
 from contact_relation import determine_relation
 from chat_manager import ChatManager
 from greeting_generator import GreetingGenerator
 
+# 示例联系人和聊天记录（每位联系人 4 条）
+SAMPLE_CONTACTS = [
+    ('张老师', '师生'), ('李经理', '上下级'), ('王同事', '同事'), ('陈朋友', '朋友'), ('刘同学', '同学')
+]
+SAMPLE_CHATS = [
+    [
+        '张老师，我最近在学习Java，遇到了一些问题，您有时间能帮我解答吗？',
+        '当然可以，有什么问题随时问我',
+        '老师，您推荐的那本书我看完了，收获很大，谢谢！',
+        '不客气，学习有什么困难就找我'
+    ],
+    [
+        '李经理，项目进展顺利，预计下周能完成',
+        '好的，辛苦大家了',
+        '李经理，我们遇到了一个技术难题，需要您的支持',
+        '我了解一下情况，明天给你们回复'
+    ],
+    [
+        '王同事，今天的工作进度怎么样？',
+        '进展不错，我们已经完成了大部分任务',
+        '太好了，我们一起努力',
+        '明天我们开个会总结一下'
+    ],
+    [
+        '陈朋友，最近在忙什么？',
+        '我在准备考试，压力很大',
+        '加油，相信你一定能通过',
+        '考完试我们一起出去放松一下'
+    ],
+    [
+        '刘同学，好久不见，最近怎么样？',
+        '我刚换了工作，现在在一家科技公司',
+        '恭喜你，工作顺利！',
+        '有空我们一起聚聚'
+    ]
+]
+
+def add_sample_data(chat_manager):
+    """在当前数据库中写入示例联系人和聊天记录，返回联系人列表（按 id）"""
+    conn = get_connection()
+    for i, (name, relation) in enumerate(SAMPLE_CONTACTS):
+        conn.execute('INSERT INTO contacts (name, phone, relation, notes) VALUES (?, ?, ?, ?)',
+                     (name, f'1380013800{i}', relation, f'这是我的{relation}，关系很好'))
+    conn.commit()
+    contacts = conn.execute('SELECT * FROM contacts ORDER BY id').fetchall()
+    for contact, chats in zip(contacts, SAMPLE_CHATS):
+        for content in chats:
+            chat_manager.save_chat(contact['id'], content)
+    return contacts
+
 def test():
     print('=== 拜年微信生成程序测试 ===\n')
 
@@ -109,5 +159,1033 @@ def test():
         import traceback
         print(traceback.format_exc())
 
+def test_generate_batch():
+    print('\n=== 批量生成测试 ===\n')
+
+    with temp_database():
+        conn = get_connection()
+        generator = GreetingGenerator()
+        contacts = add_sample_data(ChatManager())
+        candidates = {contact['id']: set(generator.iter_candidates(contact)) for contact in contacts}
+
+        def drafts():
+            rows = conn.execute("SELECT contact_id, content FROM greetings WHERE status = 'draft' ORDER BY id").fetchall()
+            conn.execute('DELETE FROM greetings')
+            conn.commit()
+            return rows
+
+        # 线程池：分块读取全部联系人，每块写入后报告进度
+        progress = []
+        stats = generator.generate_batch(workers=2, chunk_size=2, progress=lambda done, total, _: progress.append((done, total)))
+        assert (stats['total'], stats['generated'], stats['mode']) == (5, 5, 'thread')
+        assert progress == [(2, 5), (4, 5), (5, 5)]
+        rows = drafts()
+        assert sorted(row['contact_id'] for row in rows) == sorted(candidates)
+        assert all(row['content'] in candidates[row['contact_id']] for row in rows)
+
+        # 进程池：只生成指定的联系人，重复的 id 只生成一次
+        chosen = [contacts[3]['id'], contacts[0]['id'], contacts[3]['id']]
+        stats = generator.generate_batch(contact_ids=chosen, workers=2, use_processes=True, chunk_size=1)
+        assert (stats['total'], stats['generated'], stats['mode']) == (2, 2, 'process')
+        rows = drafts()
+        assert [row['contact_id'] for row in rows] == sorted(set(chosen))
+        assert all(row['content'] in candidates[row['contact_id']] for row in rows)
+        print('   线程池和进程池批量生成的草稿正确')
+
+def test_keyset_pagination():
+    print('\n=== 键集分页测试 ===\n')
+
+    with temp_database():
+        chat_manager = ChatManager()
+        for contact in add_sample_data(chat_manager):
+            chats = chat_manager.get_chats_by_contact_id(contact['id'])
+            # 键集分页逐页读取的结果与一次读取全部一致，流式分析与列表分析一致
+            pages = []
+            rows, after = chat_manager.get_chats_page(contact['id'], page_size=3)
+            pages.append(rows)
+            while after is not None:
+                rows, after = chat_manager.get_chats_page(contact['id'], page_size=3, after=after)
+                pages.append(rows)
+            assert [chat['id'] for page in pages for chat in page] == [chat['id'] for chat in chats]
+            assert [chat['id'] for chat in chat_manager.iter_chats(contact['id'], page_size=2)] == [chat['id'] for chat in chats]
+            assert chat_manager.analyze_chats(chat_manager.iter_chats(contact['id'], page_size=2)) == chat_manager.analyze_chats(chats)
+        print('   键集分页和流式分析结果一致')
+
+def test_templates():
+    print('\n=== 模板测试 ===\n')
+
+    import json
+    import tempfile
+    from template_engine import Template, TemplateError
+    assert Template('{name}，{topic}快乐').render({'name': '张三', 'topic': '新年'}) == '张三，新年快乐'
+    try:
+        Template('{name}{unknown}', known_slots={'name'})
+        raise AssertionError('未知占位符应在加载时报错')
+    except TemplateError:
+        pass
+    with tempfile.NamedTemporaryFile('w', suffix='.json', encoding='utf-8', delete=False) as f:
+        json.dump({'朋友': ['{name}，新年快乐！']}, f, ensure_ascii=False)
+    try:
+        custom = GreetingGenerator(template_path=f.name)
+        assert custom.generate_greeting({'name': '陈朋友', 'relation': '朋友'}, []) == '陈朋友，新年快乐！'
+    finally:
+        os.remove(f.name)
+    print('   模板编译和外部模板加载正常')
+
+def test_candidate_prefetch():
+    print('\n=== 候选预取测试 ===\n')
+
+    import database
+
+    with temp_database():
+        generator = GreetingGenerator()
+        contact = add_sample_data(ChatManager())[0]
+        # 候选互不重复，后台预取的候选与直接迭代的集合一致
+        candidates = list(generator.iter_candidates(contact))
+        assert len(candidates) == len(set(candidates)) == generator.candidate_limit(contact)
+        with generator.prefetch_candidates(contact, prefetch=1) as queue:
+            prefetched = []
+            greeting = queue.get()
+            while greeting is not None:
+                prefetched.append(greeting)
+                greeting = queue.get()
+        assert sorted(prefetched) == sorted(candidates)
+
+        # 后台线程只渲染，多次预取不会留下新的数据库连接
+        opened = len(database.connection_manager._connections)
+        for _ in range(50):
+            with generator.prefetch_candidates(contact) as queue:
+                queue.get()
+            queue._thread.join()
+        assert len(database.connection_manager._connections) == opened
+        print('   候选拜年微信预取且不重复')
+
+def test_keyword_matcher():
+    print('\n=== 关键词匹配测试 ===\n')
+
+    import random
+    from keyword_matcher import KeywordMatcher, get_default_matcher
+
+    def naive_counts(text, words):
+        # 逐个位置判断，统计可重叠的命中次数
+        return {word: sum(text.startswith(word, i) for i in range(len(text))) for word in words}
+
+    def check(matcher, categories, text):
+        counts = naive_counts(text, matcher.words)
+        result = matcher.scan(text)
+        expected_words = {}
+        expected_counts = {}
+        for category, words in categories.items():
+            hit = [word for word in matcher.words if word in words and counts[word]]
+            if hit:
+                expected_words[category] = hit
+                expected_counts[category] = sum(counts[word] for word in hit)
+        assert result.words == expected_words, (text, result, expected_words)
+        assert result.counts == expected_counts, (text, result, expected_counts)
+        assert sorted(word for _, word in matcher.iter_matches(text)) == \
+            sorted(word for word, count in counts.items() for _ in range(count))
+
+    # 互相重叠的关键词：前缀（重要/重要事项）、后缀（事项/项）、跨越（要事）、自身重叠（哈哈）、同词多分类
+    categories = {'甲': ['重要', '重要事项', '要事', '事项'], '乙': ['项', '哈哈', '重要']}
+    matcher = KeywordMatcher(categories)
+    for text in ['这是重要事项', '哈哈哈哈', '重要重要事项项', '', '无关内容']:
+        check(matcher, categories, text)
+    assert matcher.scan('哈哈哈').counts == {'乙': 2}
+    assert list(matcher.iter_matches('重要事项')) == [(1, '重要'), (3, '重要事项'), (2, '要事'), (3, '事项'), (3, '项')]
+    assert list(KeywordMatcher({'甲': ['重要事项', '重要']}).iter_matches('重要事项')) == [(1, '重要'), (3, '重要事项')]
+
+    rng = random.Random(0)
+    for _ in range(200):
+        text = ''.join(rng.choice('重要事项哈工作\n') for _ in range(rng.randint(0, 30)))
+        check(matcher, categories, text)
+
+    # 追加关键词后重新编译；内置匹配器与逐词计数一致
+    matcher.add_word('作', '丙')
+    categories['丙'] = ['作']
+    check(matcher, categories, '工作重要事项')
+    default = get_default_matcher()
+    assert default.scan('务必记得：工作项目很重要，重要！').counts == {'工作': 2, '重要事项': 4}
+    print('   重叠关键词计数与逐位置匹配一致')
+
+def test_incremental_analysis():
+    print('\n=== 增量分析测试 ===\n')
+
+    with temp_database():
+        chat_manager = ChatManager()
+        contacts = add_sample_data(chat_manager)
+        for contact in contacts:
+            full = chat_manager.analyze_chats(chat_manager.get_chats_by_contact_id(contact['id']))
+            incremental = chat_manager.analyze_contact(contact['id'])
+            assert set(incremental['keywords']) == set(full['keywords'])
+            assert incremental['category_counts'] == full['category_counts']
+            assert incremental['important_matters'] == full['important_matters']
+        contact_id = contacts[0]['id']
+        chat_manager.save_chat(contact_id, '记得明年继续指导我的毕业论文')
+        analysis = chat_manager.analyze_contact(contact_id)
+        assert analysis['important_matters'][0].snippet == '记得明年继续指导我的毕业论文'
+        assert '毕业' in analysis['keywords']
+        print('   增量分析结果与全量分析一致')
+
+def test_time_windows():
+    print('\n=== 时间范围查询测试 ===\n')
+
+    import time
+    with temp_database():
+        chat_manager = ChatManager()
+        contacts = add_sample_data(chat_manager)
+        now = int(time.time())
+        contact_id = contacts[1]['id']
+        assert len(chat_manager.get_chats_between(contact_id, since=now - 3600)) == 4
+        assert chat_manager.get_chats_between(contact_id, until=now - 3600) == []
+        assert [chat['id'] for chat in chat_manager.get_recent_chats(contact_id, 2)] == \
+            [chat['id'] for chat in chat_manager.get_chats_by_contact_id(contact_id)[:2]]
+        assert len(chat_manager.analyze_contact(contact_id)['recent_activities']) == 4
+        print('   时间范围查询正常')
+
+def test_analysis_cache():
+    print('\n=== 分析结果缓存测试 ===\n')
+
+    from chat_analyzer import ChatAnalyzer
+
+    def cached_contacts(analyzer):
+        return [key[0] for key in analyzer._cache]
+
+    with temp_database():
+        analyzer = ChatAnalyzer(cache_size=2)
+        chat_manager = ChatManager(analyzer=analyzer)
+        first, second, third = [contact['id'] for contact in add_sample_data(chat_manager)[:3]]
+
+        # 重复分析命中缓存，返回同一个结果
+        result = chat_manager.analyze_contact(first)
+        assert (analyzer.hits, analyzer.misses) == (0, 1)
+        assert chat_manager.analyze_contact(first) is result
+        assert (analyzer.hits, analyzer.misses) == (1, 1)
+        chats = chat_manager.get_chats_by_contact_id(second)
+        assert chat_manager.analyze_chats(chats) is chat_manager.analyze_chats(chats)
+        assert (analyzer.hits, analyzer.misses) == (2, 2)
+
+        # 最近用过的 first 保留，最久未用的 second 被淘汰
+        chat_manager.analyze_contact(first)
+        chat_manager.analyze_contact(third)
+        assert cached_contacts(analyzer) == [first, third]
+        misses = analyzer.misses
+        chat_manager.analyze_chats(chats)
+        assert analyzer.misses == misses + 1 and cached_contacts(analyzer) == [third, second]
+
+        # save_chat 和写入队列写入后清除该联系人的缓存，再次分析包含新消息
+        chat_manager.save_chat(third, '记得明年继续指导我的毕业论文')
+        assert cached_contacts(analyzer) == [second]
+        assert chat_manager.analyze_contact(third)['important_matters'][0].snippet == '记得明年继续指导我的毕业论文'
+        with chat_manager.open_writer(flush_interval=0.001) as writer:
+            writer.submit(second, '务必参加下周的重要会议').result(timeout=5)
+        assert cached_contacts(analyzer) == [third]
+        assert chat_manager.analyze_contact(second)['important_matters'][0].snippet == '务必参加下周的重要会议'
+
+        # 最近活动按调用时的时间筛选：活动移出时间范围后，命中缓存也不再返回
+        import chat_analyzer
+        assert len(chat_manager.analyze_contact(second)['recent_activities']) == 5
+        hits, misses = analyzer.hits, analyzer.misses
+        chat_analyzer.RECENT_WINDOW, window = 0, chat_analyzer.RECENT_WINDOW
+        try:
+            assert chat_manager.analyze_contact(second)['recent_activities'] == []
+            assert chat_manager.analyze_chats(chats)['recent_activities'] == []
+        finally:
+            chat_analyzer.RECENT_WINDOW = window
+        assert (analyzer.hits, analyzer.misses) == (hits + 1, misses + 1)
+        print('   缓存命中、LRU 淘汰、写入后失效和最近活动按时间筛选正常')
+
+def test_chat_search():
+    print('\n=== 聊天记录搜索测试 ===\n')
+
+    with temp_database():
+        chat_manager = ChatManager()
+        contacts = add_sample_data(chat_manager)
+        chat_manager.save_chat(contacts[0]['id'], '记得明年继续指导我的毕业论文')
+        found = chat_manager.search_chats('论文')
+        assert [chat['content'] for chat in found['results']] == ['记得明年继续指导我的毕业论文']
+        assert found['results'][0]['name'] == contacts[0]['name']
+        assert chat_manager.search_chats('"毕业论文" 明年')['total'] == 1
+        assert chat_manager.search_chats('论明')['total'] == 0
+        assert chat_manager.search_chats('！')['total'] == 0
+        assert chat_manager.search_chats('java')['total'] == 1
+        pages = [chat_manager.search_chats('我们', page=page, page_size=2) for page in (1, 2, 3)]
+        assert pages[0]['total'] == sum(len(page['results']) for page in pages) and pages[0]['pages'] == 3
+        # 搜索只读，不写数据库
+        conn = get_connection()
+        changes = conn.total_changes
+        chat_manager.search_chats('论文')
+        assert conn.total_changes == changes and not conn.in_transaction
+
+        # 修改和删除聊天记录时同一事务中更新全文索引，并清除已过时的增量分析状态
+        contact_id = contacts[0]['id']
+        thesis = found['results'][0]['id']
+        assert chat_manager.analyze_contact(contact_id)['important_matters']
+        assert chat_manager.update_chat(thesis, '明年继续指导我的毕业设计')
+        assert chat_manager.search_chats('论文')['total'] == 0 and chat_manager.search_chats('毕业设计')['total'] == 1
+        assert chat_manager.analyze_contact(contact_id)['important_matters'] == []
+        assert not chat_manager.update_chat(10 ** 6, '不存在的记录')
+        java = chat_manager.search_chats('java')['results'][0]['id']
+        assert chat_manager.delete_chats([thesis, java, 10 ** 6]) == 2
+        assert chat_manager.search_chats('毕业设计')['total'] == chat_manager.search_chats('java')['total'] == 0
+        assert '毕业' not in chat_manager.analyze_contact(contact_id)['keywords']
+        chat_manager.save_chat(contact_id, '我们明年再一起讨论')
+        assert chat_manager.search_chats('我们')['total'] == \
+            conn.execute("SELECT COUNT(*) FROM chats WHERE content LIKE '%我们%'").fetchone()[0] == pages[0]['total'] + 1
+        print('   全文搜索、分页以及修改和删除后的索引更新正常')
+
+def test_relation_rules():
+    print('\n=== 关系规则表测试 ===\n')
+
+    from contact_relation import RelationClassifier, classify_many
+
+    test_contacts = [
+        {'name': '张老师', 'notes': '我的数学老师'},
+        {'name': '李经理', 'notes': '工作上的领导'},
+        {'name': '王同事', 'notes': '公司的同事'},
+        {'name': '刘同学', 'notes': '大学同学'},
+        {'name': '陈朋友', 'notes': '好朋友'},
+        {'name': '赵总', 'notes': '部门经理'}
+    ]
+    assert classify_many(test_contacts) == [determine_relation(contact) for contact in test_contacts]
+    assert determine_relation({'name': '周', 'notes': '工作上认识的好朋友'}) == '同事'
+    assert determine_relation({'name': '周', 'notes': '同学', 'relation': '家人'}) == '家人'
+    classifier = RelationClassifier()
+    classifier.add_rule('客户', ['客户', '甲方'], 5)
+    assert classifier.classify({'name': '吴', 'notes': '甲方老师'}) == '客户'
+    print('   批量判断、优先级和自定义规则正常')
+
+def explain(conn, sql, params=()):
+    """返回查询计划的 detail 列"""
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+def test_transactions():
+    print('\n=== 事务和连接测试 ===\n')
+
+    import threading
+    import database
+    from database import transaction, release_connection
+
+    def count(conn):
+        return conn.execute('SELECT COUNT(*) FROM contacts').fetchone()[0]
+
+    with temp_database():
+        # 嵌套事务只由最外层提交
+        with transaction() as outer:
+            outer.execute("INSERT INTO contacts (name, relation) VALUES ('甲', '朋友')")
+            with transaction() as inner:
+                assert inner is outer
+                inner.execute("INSERT INTO contacts (name, relation) VALUES ('乙', '朋友')")
+            assert outer.in_transaction
+        assert not outer.in_transaction and count(outer) == 2
+
+        # 内层抛出异常时最外层整体回滚
+        try:
+            with transaction() as outer:
+                outer.execute("INSERT INTO contacts (name, relation) VALUES ('丙', '朋友')")
+                with transaction() as inner:
+                    inner.execute("INSERT INTO contacts (name, relation) VALUES ('丁', '朋友')")
+                    raise ValueError('内层失败')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('内层异常应向外传播')
+        assert not outer.in_transaction and count(outer) == 2
+
+        # 每个线程使用自己的连接，看不到其它线程未提交的写入；线程释放连接后不再占用
+        opened = len(database.connection_manager._connections)
+        seen = {}
+        ready = threading.Event()
+        done = threading.Event()
+
+        def worker():
+            conn = get_connection()
+            seen['conn'] = conn
+            try:
+                with transaction():
+                    conn.execute("INSERT INTO contacts (name, relation) VALUES ('戊', '朋友')")
+                    seen['rows'] = count(conn)
+                    ready.set()
+                    done.wait(5)
+            finally:
+                release_connection()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        assert ready.wait(5)
+        assert seen['conn'] is not get_connection()
+        assert seen['rows'] == 3 and count(get_connection()) == 2
+        done.set()
+        thread.join()
+        assert count(get_connection()) == 3
+        assert len(database.connection_manager._connections) == opened
+        print('   嵌套事务、内层回滚和线程隔离正常')
+
+def test_migrations():
+    print('\n=== 数据库迁移测试 ===\n')
+
+    import database
+
+    queries = {
+        'get_chats_by_contact_id': ('SELECT * FROM chats WHERE contact_id = ? ORDER BY timestamp DESC', (1,)),
+        'contact_by_name': ('SELECT * FROM contacts WHERE name = ?', ('张老师',)),
+        'greetings_by_contact': ('SELECT * FROM greetings WHERE contact_id = ?', (1,))
+    }
+
+    with database.temp_database(init=False) as path:
+        # 模拟旧版本数据库：只有基础表，没有索引
+        conn = database.get_connection()
+        database.create_tables(conn)
+        conn.execute("INSERT INTO contacts (name, relation, notes) VALUES ('张老师', '师生', '老师')")
+        conn.execute("INSERT INTO chats (contact_id, content) VALUES (1, '记得交作业')")
+        conn.execute("INSERT INTO chats (contact_id, content, timestamp) VALUES (1, '旧消息', '2023-11-14 22:13:20')")
+        conn.execute("DELETE FROM chats WHERE content = '旧消息'")
+        conn.execute("INSERT INTO chats (contact_id, content, timestamp) VALUES (1, '旧消息', '2023-11-14 22:13:20')")
+        conn.commit()
+        assert database.get_schema_version(conn) == 0
+
+        before = {name: explain(conn, sql, params) for name, (sql, params) in queries.items()}
+        # 没有全文索引时搜索退回 LIKE 查询
+        assert ChatManager().search_chats('作业')['total'] == 1
+
+        database.init_database()
+        assert database.get_schema_version(conn) == database.SCHEMA_VERSION
+
+        after = {name: explain(conn, sql, params) for name, (sql, params) in queries.items()}
+
+        for name in queries:
+            print(f'   {name}:')
+            print(f'      升级前: {before[name]}')
+            print(f'      升级后: {after[name]}')
+            assert any(detail.startswith('SCAN') for detail in before[name])
+            assert all(detail.startswith('SEARCH') for detail in after[name])
+        assert 'USE TEMP B-TREE FOR ORDER BY' in before['get_chats_by_contact_id']
+
+        # 原有数据保留，重复执行迁移不做任何事
+        assert conn.execute('SELECT COUNT(*) FROM chats').fetchone()[0] == 2
+
+        # 时间文本转换为整数秒，id 和自增序号保留，重建后的表上全文索引仍然有效
+        row = conn.execute("SELECT id, timestamp FROM chats WHERE content = '旧消息'").fetchone()
+        assert (row['id'], row['timestamp']) == (3, 1700000000)
+        assert isinstance(conn.execute("SELECT timestamp FROM chats WHERE id = 1").fetchone()[0], int)
+        # 迁移为已有聊天记录建立了全文索引
+        assert database.fts_available(conn)
+        assert [chat['content'] for chat in ChatManager().search_chats('作业')['results']] == ['记得交作业']
+        assert ChatManager().save_chat(1, '新的作业') == 4
+        assert ChatManager().search_chats('作业')['total'] == 2
+
+        # 表结构中没有调用本程序函数的触发器：其它 SQLite 客户端可以直接写入，本程序下次写入时补建索引
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger'").fetchone()[0] == 0
+        other = sqlite3.connect(path)
+        other.execute("INSERT INTO chats (contact_id, content, timestamp) VALUES (1, '其它程序写入的作业', 0)")
+        other.commit()
+        other.close()
+        assert ChatManager().search_chats('作业')['total'] == 2
+        assert ChatManager().save_chat(1, '又一份作业') == 6
+        assert ChatManager().search_chats('作业')['total'] == 4
+        assert database.migrate(conn) == []
+        print('   迁移测试通过')
+
+def test_chat_import():
+    print('\n=== 微信聊天记录导入测试 ===\n')
+
+    import database
+    from chat_importer import ChatImporter
+    from index import WeChatSync
+    from wechatDBFinder import WeChatDBFinder
+
+    with database.temp_database(init=False) as path:
+        tmp = os.path.dirname(path)
+        source = os.path.join(tmp, 'MSG0.db')
+        wechat = sqlite3.connect(source)
+        wechat.execute('CREATE TABLE rcontact (UserName TEXT, Alias TEXT, NickName TEXT, Remark TEXT)')
+        wechat.execute("INSERT INTO rcontact VALUES ('wxid_teacher', '', '张三', '张老师')")
+        wechat.execute('CREATE TABLE MSG (localId INTEGER PRIMARY KEY, StrTalker TEXT, StrContent TEXT, CreateTime INTEGER, Type INTEGER)')
+        wechat.executemany('INSERT INTO MSG (StrTalker, StrContent, CreateTime, Type) VALUES (?, ?, ?, ?)', [
+            ('wxid_teacher', '记得下周交论文', 1700000000, 1),
+            ('wxid_teacher', '<img/>', 1700000001, 3),
+            ('123@chatroom', '群消息', 1700000002, 1)
+        ])
+        wechat.commit()
+
+        database.init_database()
+        # 启动时的后台同步：在后台线程中找到源数据库并导入联系人
+        finder = WeChatDBFinder(search_roots=[(tmp, 0, '')], cache_path='')
+        sync = WeChatSync(finder=finder)
+        opened = len(database.connection_manager._connections)
+        sync.start()
+        sync.join()
+        assert '新增 1 位' in sync.status, sync.status
+        assert len(database.connection_manager._connections) == opened, '后台同步线程结束时应释放连接'
+        importer = ChatImporter(finder=finder)
+
+        stats = importer.import_messages(source)
+        assert (stats['imported'], stats['skipped'], stats['unmapped']) == (1, 1, 1)
+        conn = database.get_connection()
+        chat = conn.execute('SELECT * FROM chats').fetchone()
+        assert chat['content'] == '记得下周交论文' and chat['timestamp'] == 1700000000
+        assert ChatManager().search_chats('论文')['total'] == 1, '批量导入的消息应建立全文索引'
+
+        # 断点续传：没有新消息时不重复导入，追加的消息只导入一次
+        assert importer.import_messages(source)['imported'] == 0
+        wechat.execute("INSERT INTO MSG (StrTalker, StrContent, CreateTime, Type) VALUES ('wxid_teacher', '新年快乐', 1700000100, 1)")
+        wechat.commit()
+        wechat.close()
+        assert importer.import_messages(source)['imported'] == 1
+        assert conn.execute('SELECT COUNT(*) FROM chats').fetchone()[0] == 2
+        assert ChatManager().search_chats('新年')['total'] == 1
+
+        # 首次导入之后才添加的联系人：进度之前被跳过的消息补导一次，之后不再重复
+        wechat = sqlite3.connect(source)
+        wechat.executemany('INSERT INTO MSG (StrTalker, StrContent, CreateTime, Type) VALUES (?, ?, ?, ?)', [
+            ('wxid_friend', '周末一起爬山', 1700000200, 1),
+            ('wxid_friend', '<img/>', 1700000201, 3),
+            ('wxid_friend', '记得带水', 1700000202, 1)
+        ])
+        wechat.commit()
+        stats = importer.import_messages(source)
+        assert (stats['imported'], stats['unmapped'], stats['skipped']) == (0, 2, 1)
+        conn.execute("INSERT INTO contacts (name, relation, wechat_id) VALUES ('李四', '朋友', 'wxid_friend')")
+        conn.commit()
+        wechat.execute("INSERT INTO MSG (StrTalker, StrContent, CreateTime, Type) VALUES ('wxid_friend', '到山脚了', 1700000300, 1)")
+        wechat.commit()
+        wechat.close()
+        stats = importer.import_messages(source)
+        assert (stats['imported'], stats['backfilled'], stats['unmapped']) == (3, 2, 0), stats
+        friend_chats = conn.execute("SELECT c.content, c.timestamp FROM chats c JOIN contacts ct ON ct.id = c.contact_id "
+                                    "WHERE ct.wechat_id = 'wxid_friend' ORDER BY c.timestamp").fetchall()
+        assert [tuple(row) for row in friend_chats] == [('周末一起爬山', 1700000200), ('记得带水', 1700000202), ('到山脚了', 1700000300)]
+        assert importer.import_messages(source)['imported'] == 0
+        assert ChatManager().search_chats('爬山')['total'] == 1
+        # 会话很多时按会话分段读取
+        from wechatDBFinder import USERNAME_CHUNK_SIZE
+        talkers = [f'wxid_{i}' for i in range(2 * USERNAME_CHUNK_SIZE)] + ['wxid_friend']
+        assert [message.content for message in finder.iter_messages(source, talkers=talkers)] == \
+            ['周末一起爬山', '<img/>', '记得带水', '到山脚了']
+        # 仍然没有对应联系人的群聊保持记录，等待以后补导
+        assert [row['talker'] for row in conn.execute('SELECT talker FROM import_unmapped')] == ['123@chatroom']
+        print('   聊天记录导入、断点续传和新增联系人后的补导正常')
+
+def test_discovery():
+    print('\n=== 微信数据库查找测试 ===\n')
+
+    import tempfile
+    from wechatDBFinder import WeChatDBFinder
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'WeChat Files')
+        for account in ('wxid_a', 'wxid_b'):
+            os.makedirs(os.path.join(root, account, 'Msg'))
+            open(os.path.join(root, account, 'Msg', 'MSG0.db'), 'wb').close()
+        os.makedirs(os.path.join(root, 'All Users'))
+        cache_path = os.path.join(tmp, 'paths.json')
+        roots = [(root, 1, 'Msg')]
+
+        finder = WeChatDBFinder(search_roots=roots, cache_path=cache_path)
+        assert finder._wechat_db_paths is None, '构造时不应扫描目录'
+        assert len(finder.find_contacts_db()) == 2
+        assert os.path.exists(cache_path)
+
+        # 新增账号和数据库后，目录 mtime 变化使缓存失效
+        os.makedirs(os.path.join(root, 'wxid_c', 'Msg'))
+        open(os.path.join(root, 'wxid_c', 'Msg', 'MSG0.db'), 'wb').close()
+        open(os.path.join(root, 'wxid_a', 'Msg', 'MSG1.db'), 'wb').close()
+        finder = WeChatDBFinder(search_roots=roots, cache_path=cache_path)
+        listed = []
+        list_db_files = finder._list_db_files
+        finder._list_db_files = lambda directory: listed.append(directory) or list_db_files(directory)
+        paths = finder.wechat_db_paths
+        assert len(paths) == 4, paths
+        assert sorted(listed) == [os.path.join(root, 'wxid_a', 'Msg'), os.path.join(root, 'wxid_c', 'Msg')]
+
+        # 目录都未变时不再列出任何目录，也不重写缓存文件
+        finder = WeChatDBFinder(search_roots=roots, cache_path=cache_path)
+        finder._list_db_files = finder._list_subdirs = lambda directory: listed.append(directory) or []
+        listed.clear()
+        saved_at = os.stat(cache_path).st_mtime_ns
+        assert finder.wechat_db_paths == paths and listed == []
+        assert os.stat(cache_path).st_mtime_ns == saved_at
+        assert WeChatDBFinder(search_roots=roots, cache_path='', max_workers=4).wechat_db_paths == paths
+    print('目录扫描、缓存命中和失效正确')
+
+def test_multi_source_extraction():
+    print('\n=== 多个微信数据库联系人合并测试 ===\n')
+
+    import database
+    from contact_sync import ContactSync
+    from index import WeChatSync
+    from wechatDBFinder import WeChatDBFinder
+
+    with database.temp_database(init=False) as path:
+        tmp = os.path.dirname(path)
+        sources = {
+            'MSG0.db': [('wxid_a', '', '阿明', ''), ('wxid_b', '', '李四', '李老师')],
+            'MSG1.db': [('wxid_a', 'ming', '阿明', '明哥'), ('wxid_c', '', '王五', '王同事')]
+        }
+        for file_name, rows in sources.items():
+            wechat = sqlite3.connect(os.path.join(tmp, file_name))
+            wechat.execute('CREATE TABLE rcontact (UserName TEXT, Alias TEXT, NickName TEXT, Remark TEXT)')
+            wechat.executemany('INSERT INTO rcontact VALUES (?, ?, ?, ?)', rows)
+            wechat.commit()
+            wechat.close()
+        # 损坏的文件和不是微信数据库的文件
+        with open(os.path.join(tmp, 'MSG2.db'), 'wb') as f:
+            f.write(b'not a database' * 100)
+        other = sqlite3.connect(os.path.join(tmp, 'Contact.db'))
+        other.execute('CREATE TABLE notes (text TEXT)')
+        other.close()
+
+        finder = WeChatDBFinder(search_roots=[(tmp, 0, '')], cache_path='')
+        paths = sorted(finder.contact_db_candidates())
+        assert len(paths) == 4, paths
+        database.init_database()
+        counts = ContactSync(finder=finder, max_workers=3).sync(paths)
+        conn = database.get_connection()
+        contacts = {row['wechat_id']: row for row in conn.execute('SELECT * FROM contacts')}
+        assert sorted(contacts) == ['wxid_a', 'wxid_b', 'wxid_c']
+        # 先出现的记录为准，空字段用后面数据库中的值补全
+        assert (contacts['wxid_a']['name'], contacts['wxid_a']['notes']) == ('明哥', '明哥')
+        by_file = {os.path.basename(source['path']): source for source in counts['sources']}
+        assert by_file['MSG0.db']['status'] == by_file['MSG1.db']['status'] == 'synced'
+        assert by_file['MSG0.db']['changed'] == 2 and by_file['MSG1.db']['changed'] == 2
+        assert by_file['MSG2.db']['status'] == 'error' and by_file['MSG2.db']['error']
+        assert by_file['Contact.db']['status'] == 'unverified' and not by_file['Contact.db']['error']
+        assert [source['path'] for source in counts['sources']] == paths, '统计按数据库顺序排列'
+
+        # 启动时的同步（WeChatSync）重新导入，状态中报告读取失败的数据库
+        conn.execute('DELETE FROM contacts')
+        conn.execute('DELETE FROM contact_sync_state')
+        conn.execute('DELETE FROM contact_sync_rows')
+        conn.commit()
+        sync = WeChatSync(finder=finder)
+        sync.run()
+        assert '新增 3 位' in sync.status and '1 个数据库读取失败' in sync.status, sync.status
+        print('   并发读取、按微信 id 合并和单个数据库出错隔离正常')
+
+def test_contact_sync():
+    print('\n=== 微信联系人增量同步测试 ===\n')
+
+    import database
+    from contact_sync import ContactSync
+    from wechatDBFinder import WeChatDBFinder
+
+    with database.temp_database(init=False) as path:
+        tmp = os.path.dirname(path)
+        source = os.path.join(tmp, 'MSG0.db')
+        wechat = sqlite3.connect(source)
+        wechat.execute('CREATE TABLE rcontact (UserName TEXT, Alias TEXT, NickName TEXT, Remark TEXT)')
+        wechat.executemany('INSERT INTO rcontact VALUES (?, ?, ?, ?)', [
+            ('wxid_teacher', '', '张三', '张老师'), ('wxid_friend', '', '王五', ''), ('wxid_gone', '', '赵六', '')
+        ])
+        wechat.execute('CREATE TABLE MSG (localId INTEGER PRIMARY KEY, StrTalker TEXT, StrContent TEXT)')
+        wechat.commit()
+
+        database.init_database()
+        conn = database.get_connection()
+        conn.execute("INSERT INTO contacts (name, phone, relation, notes) VALUES ('张老师', '138', '师生', '我的数学老师')")
+        conn.commit()
+
+        class CountingFinder(WeChatDBFinder):
+            """记录从源数据库逐行读取的联系人行数"""
+            rows_read = 0
+
+            def _iter_contact_batches(self, *args):
+                for rows in super()._iter_contact_batches(*args):
+                    self.rows_read += len(rows)
+                    yield rows
+
+        finder = CountingFinder(cache_path='')
+        sync = ContactSync(finder=finder)
+        counts = sync.sync([source])
+        assert (counts['inserted'], counts['linked'], counts['updated']) == (2, 1, 0), counts
+        teacher = conn.execute("SELECT * FROM contacts WHERE wechat_id = 'wxid_teacher'").fetchone()
+        assert (teacher['id'], teacher['phone'], teacher['notes']) == (1, '138', '我的数学老师'), '按姓名关联时保留本地内容'
+
+        # 源数据库没有变化：不读取源数据库，也不写本地数据库
+        changes = conn.total_changes
+        counts = sync.sync([source])
+        assert counts['sources'][0]['status'] == 'unchanged' and conn.total_changes == changes
+
+        # 只有消息表变化：联系人表摘要相同，不逐行读取
+        wechat.execute("INSERT INTO MSG (StrTalker, StrContent) VALUES ('wxid_friend', '新年好')")
+        wechat.commit()
+        read = finder.rows_read
+        counts = sync.sync([source])
+        assert counts['sources'][0]['status'] == 'synced' and counts['sources'][0]['mode'] == 'digest'
+        assert counts['sources'][0]['changed'] == 0 and finder.rows_read == read
+        assert (counts['inserted'], counts['updated'], counts['unchanged']) == (0, 0, 3)
+
+        # 只追加了联系人：只读取追加的行，追加的重复微信 id 以表中先出现的行为准
+        wechat.executemany('INSERT INTO rcontact VALUES (?, ?, ?, ?)',
+                           [('wxid_new', '', '孙七', ''), ('wxid_teacher', '', '张三', '重复的行')])
+        wechat.commit()
+        read = finder.rows_read
+        counts = sync.sync([source])
+        assert counts['sources'][0]['mode'] == 'append' and counts['sources'][0]['changed'] == 1, counts
+        assert finder.rows_read - read == 2
+        assert (counts['inserted'], counts['updated']) == (1, 0), counts
+
+        # 修改备注和删除联系人：逐行比较，只写入修改过的一位，删除的联系人在本地保留
+        wechat.execute("UPDATE rcontact SET Remark = '同事王五' WHERE UserName = 'wxid_friend'")
+        wechat.execute("DELETE FROM rcontact WHERE UserName = 'wxid_gone'")
+        wechat.commit()
+        wechat.close()
+        counts = sync.sync([source])
+        assert counts['sources'][0]['mode'] == 'full'
+        assert (counts['inserted'], counts['updated']) == (0, 1), counts
+        assert counts['sources'][0]['deleted'] == 1
+        friend = conn.execute("SELECT * FROM contacts WHERE wechat_id = 'wxid_friend'").fetchone()
+        assert (friend['name'], friend['notes'], friend['relation']) == ('同事王五', '王五', '同事')
+        assert conn.execute("SELECT COUNT(*) FROM contacts WHERE wechat_id = 'wxid_gone'").fetchone()[0] == 1
+        state = conn.execute('SELECT max_rowid, row_count FROM contact_sync_state').fetchone()
+        assert (state['max_rowid'], state['row_count']) == (5, 4)
+
+        # 同一联系人只在排在后面的数据库中有变化：与前面数据库（文件未变）中的记录合并，前面的为准
+        other = os.path.join(tmp, 'MSG1.db')
+        wechat = sqlite3.connect(other)
+        wechat.execute('CREATE TABLE rcontact (UserName TEXT, Alias TEXT, NickName TEXT, Remark TEXT)')
+        wechat.execute("INSERT INTO rcontact VALUES ('wxid_friend', 'wangwu', '小王', '老王')")
+        wechat.commit()
+        wechat.close()
+        counts = sync.sync([source, other])
+        assert [result['status'] for result in counts['sources']] == ['unchanged', 'synced']
+        assert (counts['inserted'], counts['updated']) == (0, 1), counts
+        friend = conn.execute("SELECT * FROM contacts WHERE wechat_id = 'wxid_friend'").fetchone()
+        assert friend['name'] == '同事王五', '排在前面的数据库为准'
+        print('   文件指纹、内容摘要、逐行哈希和按微信 id 的 upsert 正常')
+
+def test_contact_directory():
+    print('\n=== 联系人目录测试 ===\n')
+
+    import database
+    from contact_directory import ContactDirectory, ContactRecord, lazy_pinyin
+    from contact_sync import ContactSync
+    from index import find_contact
+    from user_interaction import UserInteraction
+    from wechatDBFinder import WeChatDBFinder
+
+    with database.temp_database() as path:
+        conn = database.get_connection()
+        conn.executemany('INSERT INTO contacts (name, relation, notes) VALUES (?, ?, ?)', [
+            ('张老师', '师生', '数学老师'), ('张伟', '朋友', ''), ('李经理', '上下级', ''), ('张老师', '同事', '')
+        ])
+        conn.commit()
+
+        directory = ContactDirectory()
+        assert len(directory) == 4
+        contact = directory.get('张老师')
+        assert (contact['id'], contact['relation']) == (1, '师生'), '同名时取 id 最小的一条'
+        assert not hasattr(contact, '__dict__')
+        try:
+            contact['missing']
+            assert False, '未知字段应抛出 KeyError'
+        except KeyError:
+            pass
+        assert [record.name for record in directory.prefix('张')] == ['张伟', '张老师']
+        assert directory.prefix('王') == []
+        assert [record.name for record in directory.fuzzy('李经里')] == ['李经理']
+        if lazy_pinyin is None:
+            assert directory.pinyin('zls') == []
+        else:
+            assert [record.name for record in directory.pinyin('zls')] == ['张老师']
+
+        # 新增和改名后各种查找立即一致
+        directory.add(ContactRecord(5, '王同事', relation='同事'))
+        assert directory.get('王同事').id == 5
+        assert [record.name for record in directory.prefix('王')] == ['王同事']
+        directory.update(1, name='张教授')
+        assert directory.get('张老师').id == 4 and directory.get('张教授').id == 1
+        directory.update(4, name='张老板')
+        assert directory.get('张老师') is None
+        assert [record.name for record in directory.prefix('张')] == ['张伟', '张教授', '张老板']
+
+        # 同步微信联系人后默认目录重新载入；找不到时给出相近的姓名
+        from contact_directory import default_directory
+        assert default_directory.get('刘同学') is None
+        source = os.path.join(os.path.dirname(path), 'MSG0.db')
+        wechat = sqlite3.connect(source)
+        wechat.execute('CREATE TABLE rcontact (UserName TEXT, Alias TEXT, NickName TEXT, Remark TEXT)')
+        wechat.execute("INSERT INTO rcontact VALUES ('wxid_liu', '', '', '刘同学')")
+        wechat.commit()
+        wechat.close()
+        ContactSync(finder=WeChatDBFinder(cache_path='')).sync([source])
+        assert default_directory.get('刘同学')['wechat_id'] == 'wxid_liu'
+        assert find_contact(UserInteraction(), '刘同') is None
+        print('   精确、前缀、模糊查找和写入后的一致性正常')
+
+def test_contact_matrix():
+    print('\n=== 联系人 × 分类矩阵测试 ===\n')
+
+    import time
+    import database
+    import contact_matrix
+    from contact_matrix import CATEGORIES, CategoryMatrix, read_npy
+
+    with database.temp_database() as path:
+        tmp = os.path.dirname(path)
+        conn = database.get_connection()
+        conn.executemany('INSERT INTO contacts (name, relation) VALUES (?, ?)',
+                         [('张老师', '师生'), ('李经理', '上下级'), ('王同事', '同事'), ('没聊过', '朋友')])
+        now = int(time.time())
+        half_life = contact_matrix.HALF_LIFE
+        conn.executemany('INSERT INTO chats (contact_id, content, timestamp) VALUES (?, ?, ?)', [
+            (1, '毕业论文的学习计划', now - half_life),
+            (1, '记得考试', now - half_life),
+            (2, '项目任务很多，工作很忙', now),
+            (3, '工作上感谢帮助', now - 4 * half_life),
+            (3, '今天天气很好', now)
+        ])
+        conn.commit()
+
+        matrix = CategoryMatrix.build(now=now)
+        assert len(matrix) == 4
+        teacher = matrix.summary(1)
+        assert teacher['messages'] == 2 and teacher['last_timestamp'] == now - half_life
+        assert teacher['category_counts'] == {'学习': 3, '规划': 1, '重要事项': 1}
+        assert abs(teacher['category_weights']['学习'] - 1.5) < 1e-9, '一个半衰期前的消息权重为 0.5'
+        assert teacher['top_categories'][0] == '学习'
+        assert matrix.summary(4) == {'messages': 0, 'last_timestamp': None, 'category_counts': {},
+                                     'category_weights': {}, 'top_categories': []}
+        assert matrix.summary(99) is None
+
+        # 按“工作”排名：李经理最近提到 3 次，王同事很久以前提到 1 次；不加权时只看次数
+        assert [contact_id for contact_id, _ in matrix.top(5, category='工作')] == [2, 3]
+        assert matrix.top(1, category='工作') == [(2, 3.0)]
+        assert [contact_id for contact_id, _ in matrix.top(5)] == [2, 1, 3], '没有命中的联系人不参与排名'
+        assert [contact_id for contact_id, _ in matrix.top(5, weighted=False)] == [1, 2, 3]
+        assert matrix.scores(category='学习', weighted=False) == [3.0, 0.0, 0.0, 0.0]
+        assert matrix.category_totals()['工作'] == 4
+        try:
+            matrix.top(category='未知')
+            assert False, '未知分类应抛出 KeyError'
+        except KeyError:
+            pass
+
+        # 保存后内存映射载入，结果相同；新增聊天记录后 load_or_build 重新构建
+        path = os.path.join(tmp, 'category_matrix.npy')
+        matrix.save(path)
+        data, rows, columns = read_npy(path)
+        assert (rows, columns) == (4, 3 + 2 * len(CATEGORIES)) and data[columns] == 2.0
+        loaded = CategoryMatrix.load(path)
+        assert loaded.is_current() and loaded.top(5) == matrix.top(5) and loaded.summary(1) == teacher
+        assert CategoryMatrix.load_or_build(path).built_at == now
+        conn.execute("INSERT INTO chats (contact_id, content) VALUES (4, '祝你生日快乐')")
+        conn.commit()
+        assert not loaded.is_current()
+        rebuilt = CategoryMatrix.load_or_build(path)
+        assert rebuilt.summary(4)['category_counts'] == {'节日': 1}
+        assert loaded.summary(1) == teacher, '替换文件后已载入的矩阵不受影响'
+        print('   分类统计、近期加权排名和 .npy 保存载入正常')
+
+def test_important_matters():
+    print('\n=== 重要事项前 K 条测试 ===\n')
+
+    import time
+    import database
+    from chat_analyzer import (ChatAnalyzer, IMPORTANT_TOP_K, RECENCY_UNIT, RECENT_LIMIT, SNIPPET_LENGTH,
+                               make_snippet)
+    from chat_manager import ChatManager
+
+    with database.temp_database():
+        conn = database.get_connection()
+        conn.execute("INSERT INTO contacts (name, relation) VALUES ('张老师', '师生')")
+        now = int(time.time())
+        long_message = '今天天气很好' * 20 + '务必记得把论文的重要部分发给我' + '哈哈' * 20
+        rows = [(f'记得第{i}件事', now - RECENCY_UNIT * 12 + i) for i in range(50)]
+        rows += [('务必记得重要的毕业考试', now - RECENCY_UNIT), ('记得', now), (long_message, now - 10)]
+        rows += [(f'闲聊{i}', now - i - 1) for i in range(30)]
+        conn.executemany('INSERT INTO chats (contact_id, content, timestamp) VALUES (1, ?, ?)', rows)
+        conn.commit()
+
+        analyzer = ChatAnalyzer()
+        chat_manager = ChatManager(analyzer=analyzer)
+        analysis = analyzer.analyze_contact(1)
+        matters = analysis['important_matters']
+        assert len(matters) == IMPORTANT_TOP_K, '只保留评分最高的几条'
+        assert [matter.score for matter in matters] == sorted((matter.score for matter in matters), reverse=True)
+        # 标记相同时关键词密度高的排在前面（即使早一个月）；三个标记的消息排在只有“记得”的新消息前面；一年前的排在最后
+        assert matters[0].snippet == '务必记得重要的毕业考试'
+        assert matters[1].snippet == make_snippet(long_message, ['务必']) and matters[2].snippet == '记得'
+        assert [matter.snippet for matter in matters[3:]] == ['记得第49件事', '记得第48件事']
+        # 近期得分相对最新的消息：最新的“记得”只有标记强度 1 分，一年前的约扣 12 分
+        assert abs(matters[2].score - 1.0) < 1e-6 and -12 < matters[3].score < -10
+        assert len(matters[1].snippet) == SNIPPET_LENGTH and '务必' in matters[1].snippet
+        assert len(analysis['recent_activities']) == RECENT_LIMIT
+        assert analysis['recent_activities'][0] == '记得'
+        assert all(len(activity) <= SNIPPET_LENGTH for activity in analysis['recent_activities'])
+
+        # 全量分析、持久化状态重新载入后的增量分析结果一致
+        full = analyzer.analyze(chat_manager.get_chats_by_contact_id(1))
+        assert full['important_matters'] == matters
+        assert full['recent_activities'] == analysis['recent_activities']
+        fresh = ChatAnalyzer()
+        assert fresh.analyze_contact(1)['important_matters'] == matters
+        chat_manager.save_chat(1, '务必务必重要重要记得记得的工作')
+        updated = fresh.analyze_contact(1)['important_matters']
+        assert updated[0].snippet == '务必务必重要重要记得记得的工作' and len(updated) == IMPORTANT_TOP_K
+
+        # 拜年微信的话题取评分最高的一条，与列表顺序无关
+        from greeting_generator import GreetingGenerator
+        from template_engine import Template
+        topic = GreetingGenerator(analyzer=fresh)._render(Template('{topic}'), {'name': '张老师', 'relation': '师生'},
+                                                          {'important_matters': list(reversed(updated))})
+        assert topic == '务必务必重要重要记得记得的工作...'
+        print('   评分排序、前 K 条、片段截断和增量分析一致性正常')
+
+def test_chat_writer():
+    print('\n=== 成组提交写入队列测试 ===\n')
+
+    import asyncio
+    import threading
+    import time
+    import database
+    from chat_analyzer import ChatAnalyzer
+    from chat_manager import ChatManager
+
+    with database.temp_database():
+        conn = database.get_connection()
+        conn.executemany('INSERT INTO contacts (name) VALUES (?)', [('张老师',), ('李经理',)])
+        conn.commit()
+        chat_manager = ChatManager(analyzer=ChatAnalyzer())
+        assert chat_manager.analyze_contact(1)['important_matters'] == []
+
+        # 多个线程同时提交：每条得到自己的 id，攒满一批立即写入
+        writer = chat_manager.open_writer(batch_size=50, flush_interval=5)
+        futures = {}
+
+        def produce(worker):
+            for i in range(100):
+                content = f'线程{worker}的第{i}条消息'
+                futures[content] = writer.submit(worker % 2 + 1, content, 1700000000 + i)
+
+        threads = [threading.Thread(target=produce, args=(worker,)) for worker in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ids = {content: future.result(timeout=10) for content, future in futures.items()}
+        assert len(set(ids.values())) == 400 and writer.batches == 8
+        rows = dict(conn.execute('SELECT content, id FROM chats'))
+        assert rows == ids
+        assert conn.execute('SELECT timestamp FROM chats WHERE id = ?', (ids['线程0的第7条消息'],)).fetchone()[0] == 1700000007
+        assert chat_manager.search_chats('线程3的第99条')['total'] == 1, '批量写入后建立全文索引'
+
+        # 不足一批时由 flush 或等待时间触发写入；写入后分析结果随之更新
+        future = writer.submit(1, '记得明年继续指导我的毕业论文')
+        writer.flush()
+        assert future.done() and writer.batches == 9
+        assert chat_manager.analyze_contact(1)['important_matters'][0].snippet == '记得明年继续指导我的毕业论文'
+        writer.close()
+
+        with chat_manager.open_writer(batch_size=1000, flush_interval=0.01) as writer:
+            chat_id = writer.submit(2, '按时间写入').result(timeout=5)
+            assert conn.execute('SELECT content FROM chats WHERE id = ?', (chat_id,)).fetchone()[0] == '按时间写入'
+
+            async def save_all():
+                return await asyncio.gather(*(writer.save_async(2, f'协程消息{i}') for i in range(20)))
+
+            assert len(set(asyncio.run(save_all()))) == 20
+
+            # 关闭时写完已提交但尚未写入的记录
+            writer.flush_interval = 60
+            pending = writer.submit_many([(1, f'待写入{i}') for i in range(10)])
+        assert all(future.result(timeout=0) for future in pending)
+        assert writer.closed
+        try:
+            writer.submit(1, '关闭后提交')
+            assert False, '关闭后提交应抛出 RuntimeError'
+        except RuntimeError:
+            pass
+        assert conn.execute("SELECT COUNT(*) FROM chats WHERE content LIKE '待写入%'").fetchone()[0] == 10
+
+        # 整批写入失败时每条记录的 Future 都得到异常
+        with chat_manager.open_writer() as writer:
+            conn.execute('CREATE TRIGGER reject BEFORE INSERT ON chats BEGIN SELECT RAISE(ABORT, \'拒绝写入\'); END')
+            conn.commit()
+            failed = writer.submit(1, '会失败的消息')
+            try:
+                failed.result(timeout=5)
+                assert False, '写入失败应抛出异常'
+            except sqlite3.DatabaseError:
+                pass
+        conn.execute('DROP TRIGGER reject')
+        conn.commit()
+
+        # 关闭后写入线程的连接随之释放，反复打开写入队列不会累积连接
+        opened = len(database.connection_manager._connections)
+        for _ in range(20):
+            with chat_manager.open_writer(flush_interval=0.001) as writer:
+                writer.submit(1, '短暂的写入队列').result(timeout=5)
+        assert len(database.connection_manager._connections) == opened
+        print('   多线程提交、按条数和时间成组提交、协程提交和关闭时写完队列正常')
+
+def test_profiling():
+    print('\n=== 分阶段计时测试 ===\n')
+
+    import json
+    import tempfile
+    from profiling import Profiler, percentile
+
+    profiler = Profiler()
+
+    @profiler.timed('render')
+    def render(value):
+        return value * 2
+
+    # 未启用时不记录任何数据
+    assert render(1) == 2
+    with profiler.stage('analysis'):
+        pass
+    profiler.count('contacts.read', 10)
+    assert profiler.summary() == {'stages': {}, 'counters': {}}
+
+    assert profiler.enable_from_env({'SPRINGWISH_PROFILE': '0'}) is False
+    assert profiler.enable_from_env({'SPRINGWISH_PROFILE': '1', 'SPRINGWISH_PROFILE_STAGE': 'render'}) is True
+    assert profiler.output is None and profiler.cprofile_stage == 'render'
+    profiler.enable(cprofile_stage='render', report_at_exit=False)
+    for i in range(20):
+        assert render(i) == i * 2
+    with profiler.stage('analysis'):
+        sum(range(1000))
+    profiler.count('contacts.read', 10)
+    profiler.count('contacts.read', 5)
+
+    summary = profiler.summary()
+    assert summary['stages']['render']['count'] == 20 and summary['stages']['analysis']['count'] == 1
+    assert summary['stages']['render']['p50'] <= summary['stages']['render']['p95'] <= summary['stages']['render']['max']
+    assert summary['counters'] == {'contacts.read': 15}
+    assert percentile([1, 2, 3, 4], 0.5) == 2 and percentile([1, 2, 3, 4], 0.95) == 4 and percentile([], 0.5) == 0.0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'profile.json')
+        profiler.dump(path)
+        with open(path, encoding='utf-8') as f:
+            dumped = json.load(f)
+        assert dumped['stages']['render']['count'] == 20
+        assert os.path.exists(dumped['cprofile_file']), 'cProfile 采样应另存为 .prof 文件'
+    profiler.disable()
+    print('   计时、计数、百分位数和 JSON 输出正常')
+
+
 if __name__ == '__main__':
-    test()
\ No newline at end of file
+    test()
+    test_relation_rules()
+    test_keyset_pagination()
+    test_candidate_prefetch()
+    test_generate_batch()
+    test_keyword_matcher()
+    test_incremental_analysis()
+    test_analysis_cache()
+    test_templates()
+    test_chat_search()
+    test_time_windows()
+    test_transactions()
+    test_migrations()
+    test_chat_import()
+    test_discovery()
+    test_multi_source_extraction()
+    test_contact_sync()
+    test_contact_directory()
+    test_contact_matrix()
+    test_important_matters()
+    test_chat_writer()
+    test_profiling()
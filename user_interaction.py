@@ -32,8 +32,17 @@ class UserInteraction:
         """显示错误信息"""
         print(f"\n❌ {message}")
 
-    def show_menu(self, options):
-        """显示菜单"""
+    def show_progress(self, done, total, elapsed):
+        """在同一行刷新显示进度和速度（total 为 None 时只显示已完成数）"""
+        rate = done / elapsed if elapsed > 0 else 0
+        count = f"{done}/{total}" if total is not None else f"{done}"
+        end = '\n' if total is not None and done >= total else ''
+        print(f"\r⏳ 已完成 {count} ({rate:.0f} 条/秒)", end=end, flush=True)
+
+    def show_menu(self, options, status=None):
+        """显示菜单（status 为后台任务的状态，显示在菜单上方）"""
+        if status:
+            print(f"\n🔄 {status}")
         print('\n请选择操作：')
         for i, option in enumerate(options, 1):
             print(f"{i}. {option}")
@@ -3,65 +3,249 @@
 
 import os
 import platform
+import sqlite3
 import sys
+from collections import namedtuple
+from itertools import islice
+import profiling
+
+# 从微信消息表读出的一条聊天记录
+MessageRecord = namedtuple('MessageRecord', ['table', 'local_id', 'talker', 'content', 'create_time', 'is_sender', 'msg_type'])
+
+# 不同版本微信消息表中各字段可能使用的列名（按优先级，不区分大小写）
+MESSAGE_COLUMNS = {
+    'local_id': ['localId', 'msgId', 'MesLocalID'],
+    'talker': ['StrTalker', 'talker', 'UsrName'],
+    'content': ['StrContent', 'content', 'Message', 'msgContent'],
+    'create_time': ['CreateTime', 'createTime', 'msgCreateTime'],
+    'is_sender': ['IsSender', 'isSend', 'Des'],
+    'msg_type': ['Type', 'type', 'msgType', 'messageType']
+}
+
+# 微信数据库路径缓存文件（按目录 mtime 失效）
+PATH_CACHE_FILE = os.path.join(os.path.dirname(__file__), 'data', 'wechat_paths.json')
+
+# 路径缓存格式版本，格式变化时旧缓存作废
+PATH_CACHE_VERSION = 2
+
+# 每次 fetchmany 读取的默认行数
+DEFAULT_BATCH_SIZE = 1000
+
+# 联系人表中读取的列（依次对应 username, nickname, alias, remark）
+CONTACT_COLUMNS = ('UserName', 'NickName', 'Alias', 'Remark')
+
+# 按微信 id 查询联系人时每条 SQL 的参数个数
+USERNAME_CHUNK_SIZE = 500
+
+
+def open_readonly(db_path, immutable=False):
+    """以只读 URI 打开 SQLite 数据库；immutable=True 时不加锁也不检查变更（源文件不会被写入时使用）"""
+    from pathlib import Path
+
+    uri = Path(os.path.abspath(db_path)).as_uri() + '?mode=ro'
+    if immutable:
+        uri += '&immutable=1'
+    return sqlite3.connect(uri, uri=True)
+
+
+def quote_identifier(name):
+    """转义表名/列名"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def display_name_of(contact):
+    """联系人的显示名称：备注 > 昵称 > 微信号"""
+    return contact['remark'] or contact['nickname'] or contact['alias'] or "未知"
+
+
+def contact_from_row(row):
+    """把 iter_contact_rows 产出的 (username, nickname, alias, remark) 转换为联系人字典"""
+    username, nickname, alias, remark = row
+    return {
+        "username": username,
+        "nickname": nickname,
+        "alias": alias,
+        "remark": remark,
+        "display_name": remark or nickname or alias or "未知"
+    }
+
+
+def merge_contacts(contact_lists):
+    """按微信 id 合并多个数据库的联系人（按列表顺序）
+
+    先出现的记录为准，其中为空的字段用后面的值补全；没有微信 id 的按显示名称去重。
+    """
+    merged = {}
+    for contacts in contact_lists:
+        for contact in contacts:
+            key = contact['username'] or ('', contact['display_name'])
+            existing = merged.get(key)
+            if existing is None:
+                merged[key] = contact
+                continue
+            filled = False
+            for field in ('nickname', 'alias', 'remark'):
+                if not existing[field] and contact[field]:
+                    existing[field] = contact[field]
+                    filled = True
+            if filled:
+                existing['display_name'] = display_name_of(existing)
+    return list(merged.values())
+
 
 class WeChatDBFinder:
     """微信数据库查找器"""
 
-    def __init__(self):
+    def __init__(self, search_roots=None, cache_path=None, max_workers=1):
         self.platform = platform.system()
-        self.wechat_db_paths = self.get_wechat_db_paths()
+        # search_roots: [(根目录, 账号目录层数, 数据库子目录名)]，默认按操作系统确定
+        self.search_roots = search_roots
+        # cache_path 为 None 时使用 PATH_CACHE_FILE，为空字符串时不缓存
+        self.cache_path = PATH_CACHE_FILE if cache_path is None else cache_path
+        # 目录扫描默认串行（本地磁盘上线程池的开销大于收益），网络盘等高延迟目录可调大
+        self.max_workers = max_workers
+        self._wechat_db_paths = None
+
+    @property
+    def wechat_db_paths(self):
+        """微信数据库路径列表（首次访问时才查找）"""
+        if self._wechat_db_paths is None:
+            self._wechat_db_paths = self.get_wechat_db_paths()
+        return self._wechat_db_paths
+
+    def get_search_roots(self):
+        """根据操作系统获取微信数据目录：[(根目录, 账号目录层数, 数据库子目录名)]"""
+        if self.search_roots is not None:
+            return self.search_roots
 
-    def get_wechat_db_paths(self):
-        """根据操作系统获取微信数据库可能的路径"""
-        paths = []
         user_home = os.path.expanduser('~')
-
         if self.platform == 'Windows':
-            # Windows 平台微信数据库路径
-            wechat_dir = os.path.join(user_home, 'Documents', 'WeChat Files')
-            if os.path.exists(wechat_dir):
-                for wechat_id in os.listdir(wechat_dir):
-                    msg_dir = os.path.join(wechat_dir, wechat_id, 'Msg')
-                    if os.path.exists(msg_dir):
-                        for msg_file in os.listdir(msg_dir):
-                            if msg_file.endswith('.db'):
-                                paths.append(os.path.join(msg_dir, msg_file))
-        elif self.platform == 'Darwin':  # macOS
-            # macOS 平台微信数据库路径
+            # Windows 平台：WeChat Files/<微信号>/Msg
+            return [(os.path.join(user_home, 'Documents', 'WeChat Files'), 1, 'Msg')]
+        if self.platform == 'Darwin':  # macOS
+            # macOS 平台：<版本>/<微信号>/Message
             library_dir = os.path.join(user_home, 'Library', 'Containers', 'com.tencent.xinWeChat', 'Data', 'Library', 'Application Support', 'com.tencent.xinWeChat')
-            if os.path.exists(library_dir):
-                for version in os.listdir(library_dir):
-                    version_dir = os.path.join(library_dir, version)
-                    if os.path.isdir(version_dir):
-                        for wechat_id in os.listdir(version_dir):
-                            message_dir = os.path.join(version_dir, wechat_id, 'Message')
-                            if os.path.exists(message_dir):
-                                for msg_file in os.listdir(message_dir):
-                                    if msg_file.endswith('.db'):
-                                        paths.append(os.path.join(message_dir, msg_file))
-        elif self.platform == 'Linux':
-            # Linux 平台微信数据库路径
+            return [(library_dir, 2, 'Message')]
+        if self.platform == 'Linux':
+            # Linux 平台（wine）：WeChat Files/<微信号>/Msg
             wechat_dir = os.path.join(user_home, '.wine', 'drive_c', 'users', os.path.basename(user_home), 'Documents', 'WeChat Files')
-            if os.path.exists(wechat_dir):
-                for wechat_id in os.listdir(wechat_dir):
-                    msg_dir = os.path.join(wechat_dir, wechat_id, 'Msg')
-                    if os.path.exists(msg_dir):
-                        for msg_file in os.listdir(msg_dir):
-                            if msg_file.endswith('.db'):
-                                paths.append(os.path.join(msg_dir, msg_file))
+            return [(wechat_dir, 1, 'Msg')]
+
+        print(f"未支持的操作系统: {self.platform}")
+        return []
+
+    @profiling.timed('discovery')
+    def get_wechat_db_paths(self):
+        """查找所有微信数据库文件
+
+        目录用 os.scandir 遍历（max_workers 大于 1 时各账号的数据库目录并发扫描）。扫描结果按目录 mtime 缓存到文件：
+        目录 mtime 未变时直接复用缓存中该目录的数据库完整路径，不再列出目录、也不逐个拼接路径，
+        只有新增、删除过文件的目录才重新列出；没有目录变化时不重写缓存文件。
+        """
+        cache = self._load_path_cache()
+        new_cache = {'version': PATH_CACHE_VERSION, 'dirs': {}, 'files': {}}
+
+        msg_dirs = []
+        for root, depth, subdir in self.get_search_roots():
+            msg_dirs.extend(self._find_account_dirs(root, depth, subdir, cache, new_cache))
+
+        def scan(msg_dir):
+            try:
+                mtime = os.stat(msg_dir).st_mtime_ns
+            except OSError:
+                return msg_dir, None, None
+            if cache['dirs'].get(msg_dir) == mtime and msg_dir in cache['files']:
+                return msg_dir, mtime, cache['files'][msg_dir]
+            return msg_dir, mtime, [os.path.join(msg_dir, name) for name in self._list_db_files(msg_dir)]
+
+        if len(msg_dirs) > 1 and self.max_workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(scan, msg_dirs))
         else:
-            print(f"未支持的操作系统: {self.platform}")
+            results = [scan(msg_dir) for msg_dir in msg_dirs]
 
+        paths = []
+        for msg_dir, mtime, files in results:
+            if mtime is None:
+                continue
+            new_cache['dirs'][msg_dir] = mtime
+            new_cache['files'][msg_dir] = files
+            paths.extend(files)
+
+        # 各目录 mtime 都未变时缓存内容不变，不必逐项比较文件列表
+        if new_cache['dirs'] != cache['dirs']:
+            self._save_path_cache(new_cache)
         return paths
 
+    def _find_account_dirs(self, root, depth, subdir, cache, new_cache):
+        """逐层列出账号目录，返回存在的数据库子目录；目录 mtime 未变时复用缓存的子目录列表"""
+        level = [root]
+        for _ in range(depth):
+            next_level = []
+            for directory in level:
+                try:
+                    mtime = os.stat(directory).st_mtime_ns
+                except OSError:
+                    continue
+                if cache['dirs'].get(directory) == mtime and directory in cache['files']:
+                    children = cache['files'][directory]
+                else:
+                    children = self._list_subdirs(directory)
+                new_cache['dirs'][directory] = mtime
+                new_cache['files'][directory] = children
+                next_level.extend(os.path.join(directory, name) for name in children)
+            level = next_level
+        return [os.path.join(directory, subdir) for directory in level]
+
+    def _list_subdirs(self, directory):
+        try:
+            with os.scandir(directory) as entries:
+                return sorted(entry.name for entry in entries if entry.is_dir())
+        except OSError:
+            return []
+
+    def _list_db_files(self, directory):
+        try:
+            with os.scandir(directory) as entries:
+                return sorted(entry.name for entry in entries if entry.name.endswith('.db') and entry.is_file())
+        except OSError:
+            return []
+
+    def _load_path_cache(self):
+        empty = {'version': PATH_CACHE_VERSION, 'dirs': {}, 'files': {}}
+        if not self.cache_path:
+            return empty
+        import json
+
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                cache = json.load(f)
+            if (cache.get('version') == PATH_CACHE_VERSION
+                    and isinstance(cache.get('dirs'), dict) and isinstance(cache.get('files'), dict)):
+                return cache
+        except (OSError, ValueError, AttributeError):
+            pass
+        return empty
+
+    def _save_path_cache(self, cache):
+        if not self.cache_path:
+            return
+        import json
+
+        try:
+            tmp_path = self.cache_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"保存微信数据库路径缓存失败: {e}")
+
     def find_contacts_db(self):
-        """查找联系人数据库"""
+        """查找联系人数据库（首次调用时才扫描微信数据目录）"""
         print("正在查找微信联系人数据库...")
-        contact_db_paths = []
-        for db_path in self.wechat_db_paths:
-            if 'MSG' in os.path.basename(db_path) or 'Contact' in os.path.basename(db_path) or 'EnMicroMsg' in os.path.basename(db_path):
-                contact_db_paths.append(db_path)
+        contact_db_paths = self.contact_db_candidates()
 
         if contact_db_paths:
             print(f"找到 {len(contact_db_paths)} 个可能的微信数据库:")
@@ -72,110 +256,143 @@ class WeChatDBFinder:
             print("未找到微信联系人数据库")
             return None
 
+    def contact_db_candidates(self):
+        """按文件名筛选可能包含联系人的数据库（不输出信息，可在后台线程调用）"""
+        return [db_path for db_path in self.wechat_db_paths
+                if any(mark in os.path.basename(db_path) for mark in ('MSG', 'Contact', 'EnMicroMsg'))]
+
     def verify_db(self, db_path):
         """验证数据库文件是否为微信数据库"""
         try:
-            import sqlite3
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
+            return self.has_wechat_tables(db_path)
+        except Exception as e:
+            print(f"验证数据库失败: {e}")
+            return False
 
-            # 尝试查询常见的微信表
+    def has_wechat_tables(self, db_path):
+        """数据库中是否有常见的微信表（不输出信息，打不开或已损坏时抛出异常）"""
+        conn = open_readonly(db_path)
+        try:
             common_tables = ['contact', 'user', 'chat', 'message', 'rcontact']
-            tables = []
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            for row in cursor.fetchall():
-                table_name = row[0]
-                for common_name in common_tables:
-                    if common_name.lower() in table_name.lower():
-                        tables.append(table_name)
+            for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table';"):
+                if any(common_name in row[0].lower() for common_name in common_tables):
+                    return True
+            return False
+        finally:
+            conn.close()
 
+    def find_contact_table(self, conn):
+        """查找联系人表（微信电脑版通常使用 rcontact 表）"""
+        for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table';"):
+            if 'rcontact' in row[0].lower():
+                return row[0]
+        return None
+
+    def contact_selection(self, conn, contact_table):
+        """联系人表 (username, nickname, alias, remark) 的查询表达式，以及表中是否有 UserName 列
+
+        缺少的列和 NULL 在 SQL 中转换为空字符串，其它类型转换为文字，Python 侧不再逐个字段转换。
+        """
+        columns = [column[1] for column in conn.execute(f"PRAGMA table_info({quote_identifier(contact_table)})")]
+        selected = [f"COALESCE(CAST({quote_identifier(name)} AS TEXT), '')" if name in columns else "''"
+                    for name in CONTACT_COLUMNS]
+        return selected, CONTACT_COLUMNS[0] in columns
+
+    def contact_rows_text(self, conn, contact_table, until_rowid=None, after_rowid=None):
+        """联系人表 (username, nickname, alias, remark) 按 rowid 顺序拼接成的字符串（字段以 \\x1f、行以 \\x1e 分隔）
+
+        until_rowid / after_rowid 限定只拼接 rowid 不超过 / 大于它的行。各行在 SQLite 中拼接，Python 不逐行转换，
+        用于比较联系人表的内容摘要。
+        """
+        selected, _ = self.contact_selection(conn, contact_table)
+        conditions, params = [], []
+        if until_rowid is not None:
+            conditions.append('rowid <= ?')
+            params.append(until_rowid)
+        if after_rowid is not None:
+            conditions.append('rowid > ?')
+            params.append(after_rowid)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        text = conn.execute(f"SELECT group_concat(row, char(30)) FROM (SELECT {' || char(31) || '.join(selected)} AS row "
+                            f"FROM {quote_identifier(contact_table)} {where} ORDER BY rowid)", params).fetchone()[0]
+        return text or ''
+
+    def iter_contact_rows(self, db_path, batch_size=DEFAULT_BATCH_SIZE, immutable=False, after_rowid=None, usernames=None):
+        """逐批读取联系人表，依次产出 (username, nickname, alias, remark) 元组（内存占用与表大小无关）
+
+        行按 rowid 顺序产出；after_rowid 不为 None 时只读取其后追加的行；usernames 不为 None 时只读取这些微信 id 的行。
+        """
+        for rows in self._iter_contact_batches(db_path, batch_size, immutable, after_rowid, usernames, False):
+            yield from rows
+
+    def iter_contact_fields(self, db_path, batch_size=DEFAULT_BATCH_SIZE, immutable=False, after_rowid=None):
+        """逐批读取联系人表，依次产出每批 [(username, 'nickname\\x1falias\\x1fremark'), ...]（按 rowid 顺序）
+
+        除微信 id 外的字段在 SQL 中拼接好，调用方可以整批计算哈希，不必逐行转换。
+        """
+        yield from self._iter_contact_batches(db_path, batch_size, immutable, after_rowid, None, True)
+
+    def _iter_contact_batches(self, db_path, batch_size, immutable, after_rowid, usernames, joined):
+        conn = open_readonly(db_path, immutable)
+        try:
+            contact_table = self.find_contact_table(conn)
+            if not contact_table:
+                return
+
+            # 字段位置只解析一次
+            selected, has_username = self.contact_selection(conn, contact_table)
+            if joined:
+                selected = [selected[0], ' || char(31) || '.join(selected[1:])]
+            sql = f"SELECT {', '.join(selected)} FROM {quote_identifier(contact_table)}"
+            if usernames is not None:
+                if not has_username:
+                    return
+                usernames = list(usernames)
+                column = quote_identifier(CONTACT_COLUMNS[0])
+                queries = [(f"{sql} WHERE {column} IN ({','.join('?' * len(chunk))}) ORDER BY rowid", chunk)
+                           for chunk in (usernames[i:i + USERNAME_CHUNK_SIZE]
+                                         for i in range(0, len(usernames), USERNAME_CHUNK_SIZE))]
+            elif after_rowid is not None:
+                queries = [(f'{sql} WHERE rowid > ? ORDER BY rowid', (after_rowid,))]
+            else:
+                queries = [(f'{sql} ORDER BY rowid', ())]
+
+            for query, params in queries:
+                cursor = conn.execute(query, params)
+                while True:
+                    with profiling.stage('extract.contacts'):
+                        rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    profiling.count('contacts.read', len(rows))
+                    yield rows
+        finally:
             conn.close()
-            return len(tables) > 0
-        except Exception as e:
-            print(f"验证数据库失败: {e}")
-            return False
+
+    def iter_contacts(self, db_path, batch_size=DEFAULT_BATCH_SIZE, immutable=False):
+        """逐批读取联系人表，依次产出联系人字典（内存占用与表大小无关）"""
+        for row in self.iter_contact_rows(db_path, batch_size, immutable):
+            yield contact_from_row(row)
 
     def extract_contacts(self, db_path):
         """从微信数据库中提取联系人信息（针对微信电脑版 MSG.db 优化）"""
         print(f"正在从数据库中提取联系人信息: {db_path}")
 
         try:
-            import sqlite3
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-
-            # 查找联系人表（微信电脑版通常使用 rcontact 表）
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            contact_table = None
-            for row in cursor.fetchall():
-                table_name = row[0]
-                if 'rcontact' in table_name.lower():
-                    contact_table = table_name
-                    break
-
-            if not contact_table:
-                print("未找到 rcontact 表")
+            conn = open_readonly(db_path)
+            try:
+                contact_table = self.find_contact_table(conn)
+                if not contact_table:
+                    print("未找到 rcontact 表")
+                    return None
+                columns = [column[1] for column in conn.execute(f"PRAGMA table_info({quote_identifier(contact_table)})")]
+            finally:
                 conn.close()
-                return None
 
             print(f"联系人表: {contact_table}")
 
-            # 读取联系人表字段
-            cursor.execute(f"PRAGMA table_info({contact_table})")
-            columns = [column[1] for column in cursor.fetchall()]
-
-            print("联系人表字段:")
-            for i, column in enumerate(columns, 1):
-                print(f"{i}. {column}")
-
-            # 查询所有联系人记录
-            cursor.execute(f"SELECT * FROM {contact_table}")
-            contacts = cursor.fetchall()
-            print(f"\n查询到 {len(contacts)} 位联系人:")
-
-            extracted_contacts = []
-
-            for i, contact in enumerate(contacts, 1):
-                # 分析微信电脑版 rcontact 表字段
-                name = ""
-                alias = ""
-                remark = ""
-
-                try:
-                    # 根据微信电脑版数据库字段结构提取信息
-                    if "NickName" in columns:
-                        name_idx = columns.index("NickName")
-                        if name_idx < len(contact):
-                            name = str(contact[name_idx])
-                    if "Alias" in columns:
-                        alias_idx = columns.index("Alias")
-                        if alias_idx < len(contact):
-                            alias = str(contact[alias_idx])
-                    if "Remark" in columns:
-                        remark_idx = columns.index("Remark")
-                        if remark_idx < len(contact):
-                            remark = str(contact[remark_idx])
-
-                    # 确定显示名称
-                    display_name = remark if remark else name if name else alias if alias else "未知"
-
-                    # 输出信息
-                    contact_info = f"{i}. {display_name}"
-                    if (name or alias) and remark and name != remark and alias != remark:
-                        contact_info += f" ({name or alias})"
-
-                    print(contact_info)
-
-                    extracted_contacts.append({
-                        "nickname": name,
-                        "alias": alias,
-                        "remark": remark,
-                        "display_name": display_name
-                    })
-                except Exception as e:
-                    print(f"分析联系人 {i} 时出错: {e}")
-
-            conn.close()
+            extracted_contacts = list(self.iter_contacts(db_path))
+            print(f"查询到 {len(extracted_contacts)} 位联系人")
 
             return {
                 'table_name': contact_table,
@@ -187,49 +404,108 @@ class WeChatDBFinder:
             print(f"提取联系人信息失败: {e}")
             return None
 
-    def find_chat_records(self, db_path):
-        """从微信数据库中提取聊天记录"""
+    def find_message_tables(self, conn):
+        """查找聊天记录相关的表"""
+        chat_tables = []
+        for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table';"):
+            table_name = row[0]
+            if 'message' in table_name.lower() or 'msg' in table_name.lower() or 'chat' in table_name.lower():
+                chat_tables.append(table_name)
+        return chat_tables
+
+    def resolve_message_columns(self, conn, table):
+        """解析消息表中各字段对应的列名，找不到的字段为 None"""
+        columns = {column[1].lower(): column[1] for column in conn.execute(f"PRAGMA table_info({quote_identifier(table)})")}
+        resolved = {}
+        for field, candidates in MESSAGE_COLUMNS.items():
+            resolved[field] = next((columns[name.lower()] for name in candidates if name.lower() in columns), None)
+        return resolved
+
+    def iter_messages(self, db_path, batch_size=DEFAULT_BATCH_SIZE, tables=None, immutable=False, after_ids=None,
+                      until_ids=None, talkers=None):
+        """以只读方式逐批读取所有消息表，依次产出 MessageRecord
+
+        每张表的字段位置只解析一次，结果用 fetchmany 分批取出，内存占用与数据库大小无关。
+        没有内容列的表会被跳过；没有消息 id 列时使用 rowid。
+        after_ids 为 {表名: 消息 id}，只读取 id 更大的消息（用于断点续传）；until_ids 同样按表限定 id 的上限（含）。
+        talkers 不为空时只读取这些会话的消息（没有会话列的表会被跳过），会话按 USERNAME_CHUNK_SIZE 分段查询，
+        每段内按 id 排序。
+        """
+        after_ids = after_ids or {}
+        talkers = list(talkers) if talkers else None
+        until_ids = until_ids or {}
+        conn = open_readonly(db_path, immutable)
+        try:
+            for table in tables or self.find_message_tables(conn):
+                columns = self.resolve_message_columns(conn, table)
+                if not columns['content'] or talkers and not columns['talker']:
+                    continue
+
+                id_column = quote_identifier(columns['local_id']) if columns['local_id'] else 'rowid'
+                selected = [id_column] + [quote_identifier(columns[field]) if columns[field] else 'NULL'
+                                          for field in ('talker', 'content', 'create_time', 'is_sender', 'msg_type')]
+                where = [f'{id_column} > ?']
+                params = [after_ids.get(table, -1)]
+                if table in until_ids:
+                    where.append(f'{id_column} <= ?')
+                    params.append(until_ids[table])
+                sql = f"SELECT {', '.join(selected)} FROM {quote_identifier(table)} WHERE {' AND '.join(where)}"
+                if talkers:
+                    # 会话很多时分段查询，避免超出 SQLite 的参数个数上限
+                    column = quote_identifier(columns['talker'])
+                    queries = [(f"{sql} AND {column} IN ({','.join('?' * len(chunk))}) ORDER BY {id_column}",
+                                params + chunk)
+                               for chunk in (talkers[i:i + USERNAME_CHUNK_SIZE]
+                                             for i in range(0, len(talkers), USERNAME_CHUNK_SIZE))]
+                else:
+                    queries = [(f'{sql} ORDER BY {id_column}', params)]
+
+                for query, query_params in queries:
+                    cursor = conn.execute(query, query_params)
+                    while True:
+                        with profiling.stage('extract.messages'):
+                            rows = cursor.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        profiling.count('messages.read', len(rows))
+                        for row in rows:
+                            yield MessageRecord(table, *row)
+        finally:
+            conn.close()
+
+    def find_chat_records(self, db_path, limit=10):
+        """从微信数据库中提取聊天记录（列出消息表并读取第一张表的前 limit 条作为样例）"""
         print(f"正在从数据库中提取聊天记录: {db_path}")
 
         try:
-            import sqlite3
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-
-            # 查找聊天记录相关的表
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            chat_tables = []
-            for row in cursor.fetchall():
-                table_name = row[0]
-                if 'message' in table_name.lower() or 'msg' in table_name.lower() or 'chat' in table_name.lower():
-                    chat_tables.append(table_name)
-
-            if not chat_tables:
-                print("未找到聊天记录相关的表")
+            conn = open_readonly(db_path)
+            try:
+                chat_tables = self.find_message_tables(conn)
+                if not chat_tables:
+                    print("未找到聊天记录相关的表")
+                    return None
+                first_table = chat_tables[0]
+                columns = [column[1] for column in conn.execute(f"PRAGMA table_info({quote_identifier(first_table)})")]
+            finally:
                 conn.close()
-                return None
 
             print(f"找到 {len(chat_tables)} 个聊天记录相关的表:")
             for i, table_name in enumerate(chat_tables, 1):
                 print(f"{i}. {table_name}")
 
-            # 读取第一个表的信息
-            first_table = chat_tables[0]
-            cursor.execute(f"PRAGMA table_info({first_table})")
-            columns = [column[1] for column in cursor.fetchall()]
             print(f"\n表 '{first_table}' 的字段:")
             for i, column in enumerate(columns, 1):
                 print(f"{i}. {column}")
 
-            # 尝试查询聊天记录数据
-            cursor.execute(f"SELECT * FROM {first_table} LIMIT 10")
-            records = cursor.fetchall()
+            messages = self.iter_messages(db_path, batch_size=limit, tables=[first_table])
+            try:
+                records = list(islice(messages, limit))
+            finally:
+                messages.close()
             print(f"\n查询到 {len(records)} 条聊天记录:")
             for i, record in enumerate(records, 1):
                 print(f"{i}. {record}")
 
-            conn.close()
-
             return {
                 'tables': chat_tables,
                 'first_table': first_table,